@@ -16,14 +16,30 @@ def _lineTbl_now(self, i):
     return "<table>" + "".join(i) + "</table>"
 
 
-def statList(self, lim, span):
-    flunked, revisited, passed, easy = self.col.db.first("""
-    select
-    sum(case when ease = 1 and type == 1 then 1 else 0 end), /* flunked */
-    sum(case when ease = 2 and type == 1 then 1 else 0 end), /* revisited */
-    sum(case when ease = 3 and type == 1 then 1 else 0 end), /* passed */
-    sum(case when ease = 4 and type == 1 then 1 else 0 end) /* easy */
-    from revlog where id > ? and due == day""" + lim, span)
+def statList(self, lim, period):
+    daily = self._daily()
+    if daily:
+        # revlog_daily holds the same counts per day
+        today, lims = daily
+        lims.append("type = 1 and ontime")
+        if period != float('inf'):
+            lims.append("day > %d" % (today - period))
+        flunked, revisited, passed, easy = self.col.db.first("""
+        select
+        sum(case when ease = 1 then cnt else 0 end), /* flunked */
+        sum(case when ease = 2 then cnt else 0 end), /* revisited */
+        sum(case when ease = 3 then cnt else 0 end), /* passed */
+        sum(case when ease = 4 then cnt else 0 end) /* easy */
+        from revlog_daily where """ + " and ".join(lims))
+    else:
+        span = (self.col.sched.dayCutoff - 86400 * period) * 1000
+        flunked, revisited, passed, easy = self.col.db.first("""
+        select
+        sum(case when ease = 1 and type == 1 then 1 else 0 end), /* flunked */
+        sum(case when ease = 2 and type == 1 then 1 else 0 end), /* revisited */
+        sum(case when ease = 3 and type == 1 then 1 else 0 end), /* passed */
+        sum(case when ease = 4 and type == 1 then 1 else 0 end) /* easy */
+        from revlog where id > ? and due == day""" + lim, span)
 
     # sum(case when ivl > 0 and type == 0 then 1 else 0 end), /* learned */
     # sum(case when ivl > 0 and type == 2 then 1 else 0 end) /* relearned */
@@ -45,8 +61,8 @@ def todayStats_new(self):
     if lim:
         lim = " and " + lim
 
-    pastDay = statList(self, lim, (self.col.sched.dayCutoff - 86400) * 1000)
-    pastWeek = statList(self, lim, (self.col.sched.dayCutoff - 86400 * 7) * 1000)
+    pastDay = statList(self, lim, 1)
+    pastWeek = statList(self, lim, 7)
 
     if self.type == 0:
         period = 31;
@@ -58,7 +74,7 @@ def todayStats_new(self):
         period = float('inf');
         name = "All time:"
 
-    pastPeriod = statList(self, lim, (self.col.sched.dayCutoff - 86400 * period) * 1000)
+    pastPeriod = statList(self, lim, period)
 
     return "<br><br><table style='text-align: center'><tr><td style='padding: 5px'>" \
            + "<span>Past day:</span>" + pastDay + "</td><td style='padding: 5px'>" \
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""The revlog loaded once as column arrays, so the sections of a stats
+report can share it instead of each scanning the revlog table.
+
+The aggregates mirror the SQL in anki.stats and advanced_stats.compute,
+including SQLite's integer casts and rounding, so either can be used. NumPy is optional; callers
+should fall back to SQL when available() is False."""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# rows fetched from the cursor at a time while loading
+LOAD_CHUNK = 100000
+
+COLUMNS = ("id", "cid", "ease", "ivl", "lastIvl", "time", "type")
+
+
+def available():
+    return np is not None
+
+
+def _trunc_div(a, b):
+    "Integer division rounding towards zero, like SQLite."
+    return np.sign(a) * (np.abs(a) // b)
+
+
+class RevlogColumns:
+    """Revlog rows matching LIM (a SQL condition, or "") as arrays named
+    after the columns, ordered by id.
+
+    If SINCE (ms) is given, only reviews after it are kept, plus any older
+    review where the card left learning for the first time, which the
+    progress graphs need."""
+
+    def __init__(self, db, lim="", since=None):
+        lims = []
+        if lim:
+            lims.append(lim)
+        if since is not None:
+            lims.append("(id > %d or (ivl > 0 and lastIvl < 0))" % since)
+        where = "where " + " and ".join(lims) if lims else ""
+        self.since = since
+        count = db.scalar("select count() from revlog %s" % where)
+        data = np.empty((count, len(COLUMNS)), dtype=np.int64)
+        cur = db.execute("select %s from revlog %s order by id" % (
+            ", ".join(COLUMNS), where))
+        pos = 0
+        while pos < count:
+            rows = cur.fetchmany(LOAD_CHUNK)
+            if not rows:
+                break
+            data[pos:pos+len(rows)] = rows
+            pos += len(rows)
+        cur.close()
+        data = data[:pos]
+        for n, name in enumerate(COLUMNS):
+            setattr(self, name, np.ascontiguousarray(data[:, n]))
+
+    def __len__(self):
+        return len(self.id)
+
+    def _after(self, since):
+        "Mask of reviews with an id greater than SINCE (ms), or all."
+        if since is None:
+            return np.ones(len(self.id), dtype=bool)
+        return self.id > since
+
+    def first_id(self):
+        "Id of the earliest review, or None."
+        if not len(self.id):
+            return None
+        return int(self.id[0])
+
+    def covers(self, since):
+        "True if every review after SINCE (ms, or None for all) is loaded."
+        return self.since is None or (since is not None and since >= self.since)
+
+    def reviews(self, day_cutoff_seconds, bucket_size_days, id_cutoff=None):
+        """(id, bucket_index, cid, ivl, lastIvl) arrays for advanced_stats.compute,
+        with the same filter and bucketing as its SQL."""
+        m = np.ones(len(self.id), dtype=bool)
+        if id_cutoff:
+            m = (self.id >= id_cutoff) | ((self.ivl > 0) & (self.lastIvl < 0))
+        x = (self.id[m] / 1000.0 - day_cutoff_seconds) / 86400.0 / bucket_size_days + 0.5
+        # SQLite rounds halves away from zero
+        bucket = (np.sign(x) * np.floor(np.abs(x) + 0.5)).astype(np.int64)
+        return self.id[m], bucket, self.cid[m], self.ivl[m], self.lastIvl[m]
+
+    def hour_retention(self, cut, since, min_count=30):
+        "(hour, % correct, count) rows of _hourRet()."
+        m = self._after(since) & (self.type <= 2)
+        secs = cut - _trunc_div(self.id[m], 1000)
+        hour = 23 - np.fmod(np.trunc(secs / 3600.0).astype(np.int64), 24)
+        hours, inv, counts = np.unique(hour, return_inverse=True, return_counts=True)
+        correct = np.bincount(inv, weights=self.ease[m] != 1, minlength=len(hours))
+        rows = []
+        for h, ok, cnt in zip(hours.tolist(), correct.tolist(), counts.tolist()):
+            if cnt > min_count:
+                rows.append((h, ok / float(cnt) * 100, cnt))
+        return rows
@@ -14,6 +14,14 @@
 
 from collections import namedtuple, defaultdict
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Number of rows fetched at a time by the streaming mode of get_stats.
+STREAM_CHUNK = 100000
+
 
 # an individual review of a card with a bucket_index representing the time period the review
 # occurred in (e.g. which day, month, etc.)
@@ -48,26 +56,10 @@ class ProgressStats:
 BucketStats = namedtuple('BucketStats', ['bucket_index', 'stats'])
 
 
-def _get_reviews(bucket_size_days, day_cutoff_seconds, num_buckets=None, additional_filter=None,
-                 db_conn=None, db_table=None):
-    """Fetches all the reviews over a period of time and buckets them by (bucket_index, cid), where
-    cid is the card ID and bucket_index where 0 is today, -1 is yesterday, etc.
-
-    bucket_size_days represents the size of each bucket measusured in days.  So a value of 1 buckets per day,
-    a value of 7 buckets per week, etc.
-
-    day_cutoff_seconds is the cutoff measured in seconds since epoch for the start of the next day.  So, for example,
-    if the cutoff is 4 am then this should be tomorrow at 4 am.
-
-    num_buckets is the (optional) number of buckets, which indicates how many reviews to fetch.  Enough reviews are
-    fetched to fill all the buckets.  So, for example, if bucket_size_days is 1 and num_buckets is 30 this fetches
-    the last month of reviews.
-
-    db_conn and db_table are the connection or table used to fetch from the review logs.  Only one should be specified.
-
-    additional_filter is an (optiona) filter added to the SQL WHERE clause that limits which reviews to fetch.
-    This can be used to limit the reviews to a particular deck, for example.
-    """
+def _query_reviews(bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter, db_conn, db_table,
+                   order="rl.id ASC"):
+    """Runs the query for the reviews _get_reviews needs, ordered by order.  Returns the id cutoff (see below) and
+    a cursor over rows of (id, bucket_index, cid, ease, ivl, lastIvl, type)."""
 
     if not db_conn and not db_table:
         raise ValueError("Required either connection or table")
@@ -111,7 +103,7 @@ def _get_reviews(bucket_size_days, day_cutoff_seconds, num_buckets=None, additio
     if db_conn:
         func = db_conn.execute
     else:
-        func = db_table.all
+        func = db_table.execute
 
     query = """\
       SELECT rl.id,
@@ -120,10 +112,36 @@ def _get_reviews(bucket_size_days, day_cutoff_seconds, num_buckets=None, additio
              rl.cid, rl.ease, rl.ivl, rl.lastIvl, rl.type
       FROM revlog rl
       %s
-      ORDER BY rl.id ASC;
-      """ % (where_clause)
+      ORDER BY %s;
+      """ % (where_clause, order)
+
+    return id_cutoff, func(query, bucket_size_days=bucket_size_days, day_cutoff_seconds=day_cutoff_seconds)
+
+
+
+def _get_reviews(bucket_size_days, day_cutoff_seconds, num_buckets=None, additional_filter=None,
+                 db_conn=None, db_table=None):
+    """Fetches all the reviews over a period of time and buckets them by (bucket_index, cid), where
+    cid is the card ID and bucket_index where 0 is today, -1 is yesterday, etc.
+
+    bucket_size_days represents the size of each bucket measusured in days.  So a value of 1 buckets per day,
+    a value of 7 buckets per week, etc.
+
+    day_cutoff_seconds is the cutoff measured in seconds since epoch for the start of the next day.  So, for example,
+    if the cutoff is 4 am then this should be tomorrow at 4 am.
+
+    num_buckets is the (optional) number of buckets, which indicates how many reviews to fetch.  Enough reviews are
+    fetched to fill all the buckets.  So, for example, if bucket_size_days is 1 and num_buckets is 30 this fetches
+    the last month of reviews.
 
-    result = func(query, bucket_size_days=bucket_size_days, day_cutoff_seconds=day_cutoff_seconds)
+    db_conn and db_table are the connection or table used to fetch from the review logs.  Only one should be specified.
+
+    additional_filter is an (optiona) filter added to the SQL WHERE clause that limits which reviews to fetch.
+    This can be used to limit the reviews to a particular deck, for example.
+    """
+
+    id_cutoff, result = _query_reviews(bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter,
+                                       db_conn, db_table)
 
     # Maps cid to the id where the card was first learned.
     first_learned = {}
@@ -215,8 +233,145 @@ def _new_bucket_stats(bucket_index):
     return BucketStats(bucket_index=bucket_index, stats=ProgressStats())
 
 
+def _get_stats_by_bucket(bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter, db_conn, db_table):
+    """Computes the ProgressStats of each bucket one card and bucket at a time, for when NumPy isn't available."""
+
+    all_reviews_for_bucket = _get_reviews(
+        bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter,
+        db_conn=db_conn, db_table=db_table)
+
+    stats_by_bucket = {}
+    last_ivl_by_cid = {}
+
+    # sort by bucket
+    for key in sorted(all_reviews_for_bucket, key=lambda k: k[0]):
+        # Get reviews for a particular card in a particular bucket.
+        # The key is (bucket_index, cid).
+        card_reviews = all_reviews_for_bucket[key]
+
+        bucket_index, cid = key
+
+        last_ivl = last_ivl_by_cid.get(cid, 0)
+
+        bucket_stats = stats_by_bucket.get(bucket_index)
+        if not bucket_stats:
+            bucket_stats = _new_bucket_stats(bucket_index)
+            stats_by_bucket[bucket_index] = bucket_stats
+
+        if _has_matured(card_reviews, last_ivl):
+            bucket_stats.stats.matured_cards += 1
+
+        bucket_stats.stats.matured_reviews += _num_matured(card_reviews)
+
+        if _has_lost_matured(card_reviews, last_ivl):
+            bucket_stats.stats.lost_matured_card += 1
+
+        if _has_learned(card_reviews):
+            bucket_stats.stats.learned_cards += 1
+
+        last_ivl_by_cid[cid] = card_reviews.reviews[-1].ivl
+
+    return stats_by_bucket
+
+
+def _add_array_stats(stats_by_bucket, ids, bucket_index, cid, ivl, last_ivl, id_cutoff):
+    """Adds the ProgressStats of reviews given as NumPy arrays to stats_by_bucket.  This computes the same
+    predicates as _has_matured, _num_matured, _has_lost_matured and _has_learned, but over every (bucket, card)
+    segment at once.  Every review of a card that _get_reviews would fetch must be included."""
+
+    # Order by card and then time, so the reviews of a card in a bucket are contiguous segments.
+    order = np.lexsort((ids, cid))
+    ids, bucket_index, cid, ivl, last_ivl = (a[order] for a in (ids, bucket_index, cid, ivl, last_ivl))
+
+    # The review where each card was first learned.
+    first_learned = np.zeros(len(ids), dtype=bool)
+    learned = np.flatnonzero((ivl > 0) & (last_ivl < 0))
+    if len(learned):
+        _, first = np.unique(cid[learned], return_index=True)
+        first_learned[learned[first]] = True
+
+    # Reviews before the cutoff were only needed for first_learned.
+    if id_cutoff:
+        keep = ids >= id_cutoff
+        ids, bucket_index, cid, ivl, last_ivl, first_learned = (
+            a[keep] for a in (ids, bucket_index, cid, ivl, last_ivl, first_learned))
+    if not len(ids):
+        return
+
+    new_segment = np.ones(len(ids), dtype=bool)
+    new_segment[1:] = (cid[1:] != cid[:-1]) | (bucket_index[1:] != bucket_index[:-1])
+    starts = np.flatnonzero(new_segment)
+    ends = np.append(starts[1:], len(ids)) - 1
+
+    # The interval the card ended its previous bucket with, falling back to the lastIvl of the segment's first
+    # review like _has_matured does.
+    prev_ivl = np.zeros(len(starts), dtype=ivl.dtype)
+    prev_ivl[1:] = np.where(cid[starts[1:]] == cid[starts[:-1]], ivl[ends[:-1]], 0)
+    prev_ivl = np.where(prev_ivl == 0, last_ivl[starts], prev_ivl)
+    end_ivl = ivl[ends]
+
+    per_segment = (
+        (prev_ivl < 21) & (end_ivl >= 21),
+        np.add.reduceat(((last_ivl < 21) & (ivl >= 21)).astype(np.int64), starts),
+        (prev_ivl >= 21) & (end_ivl < 21),
+        np.add.reduceat(first_learned.astype(np.int64), starts) > 0,
+    )
+    buckets, inverse = np.unique(bucket_index[starts], return_inverse=True)
+    totals = [np.bincount(inverse, weights=v, minlength=len(buckets)).astype(np.int64).tolist()
+              for v in per_segment]
+    for n, b in enumerate(buckets.tolist()):
+        bucket_stats = stats_by_bucket.get(b)
+        if not bucket_stats:
+            bucket_stats = _new_bucket_stats(b)
+            stats_by_bucket[b] = bucket_stats
+        bucket_stats.stats.matured_cards += totals[0][n]
+        bucket_stats.stats.matured_reviews += totals[1][n]
+        bucket_stats.stats.lost_matured_card += totals[2][n]
+        bucket_stats.stats.learned_cards += totals[3][n]
+
+
+def _get_stats_by_bucket_np(bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter, db_conn,
+                            db_table, revlog, chunk_size):
+    """Computes the ProgressStats of each bucket with NumPy.  The reviews are read from revlog if it has them all,
+    else from the database, chunk_size rows at a time if it's set."""
+
+    stats_by_bucket = {}
+
+    if revlog is not None:
+        id_cutoff = None
+        if num_buckets:
+            id_cutoff = (day_cutoff_seconds - (bucket_size_days * num_buckets * 86400)) * 1000
+        if revlog.covers(id_cutoff):
+            ids, bucket_index, cid, ivl, last_ivl = revlog.reviews(day_cutoff_seconds, bucket_size_days, id_cutoff)
+            _add_array_stats(stats_by_bucket, ids, bucket_index, cid, ivl, last_ivl, id_cutoff)
+            return stats_by_bucket
+
+    # Fetch in card order, so each chunk only needs to hold back the reviews of its last card, which may continue
+    # in the next chunk.
+    id_cutoff, cursor = _query_reviews(bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter,
+                                       db_conn, db_table, order="rl.cid, rl.id")
+    pending = np.empty((0, 7), dtype=np.int64)
+    while True:
+        rows = cursor.fetchmany(chunk_size) if chunk_size else cursor.fetchall()
+        if rows and chunk_size:
+            pending = np.concatenate((pending, np.array(rows, dtype=np.int64)))
+            split = int(np.argmax(pending[:, 2] == pending[-1, 2]))
+        else:
+            if rows:
+                pending = np.concatenate((pending, np.array(rows, dtype=np.int64)))
+            split = len(pending)
+        if split:
+            done = pending[:split]
+            _add_array_stats(stats_by_bucket, done[:, 0], done[:, 1], done[:, 2], done[:, 4], done[:, 5], id_cutoff)
+            pending = pending[split:]
+        if not rows or not chunk_size:
+            break
+
+    return stats_by_bucket
+
+
 def get_stats(bucket_size_days, day_cutoff_seconds, num_buckets=None, additional_filter=None,
-              db_conn=None, db_table=None):
+              db_conn=None, db_table=None, revlog=None, chunk_size=None):
     """Returns progress statistics bucketed by bucket_size_days.  The statistics are:
 
     matured_cards: number of cards that went from young to mature
@@ -239,6 +394,13 @@ def get_stats(bucket_size_days, day_cutoff_seconds, num_buckets=None, additional
 
     additional_filter is an (optiona) filter added to the SQL WHERE clause that limits which reviews to fetch.
     This can be used to limit the reviews to a particular deck, for example.
+
+    revlog is an (optional) columns.RevlogColumns already loaded with additional_filter.  If it holds every
+    review needed, it is used instead of querying the database.
+
+    chunk_size (optional) streams the reviews from the database this many rows at a time, so memory use stays
+    flat however long the review history is.  revlog and chunk_size need NumPy; without it the reviews are
+    processed one card and bucket at a time.
     """
 
     stats_by_name = defaultdict(list)
@@ -248,50 +410,20 @@ def get_stats(bucket_size_days, day_cutoff_seconds, num_buckets=None, additional
         min_bucket_index = -1 * num_buckets + 1
     max_bucket_index = 0
 
-    all_reviews_for_bucket = _get_reviews(
-        bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter,
-        db_conn=db_conn, db_table=db_table)
+    if np is not None:
+        stats_by_bucket = _get_stats_by_bucket_np(
+            bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter, db_conn, db_table,
+            revlog, chunk_size)
+    else:
+        stats_by_bucket = _get_stats_by_bucket(
+            bucket_size_days, day_cutoff_seconds, num_buckets, additional_filter, db_conn, db_table)
 
     # If there is no review data then return empty dictionary. No graphs should be plotted.
-    if not all_reviews_for_bucket:
+    if not stats_by_bucket:
         return stats_by_name
 
-    stats_by_bucket = {}
-    last_ivl_by_cid = {}
-
-    # sort by bucket
-    for key in sorted(all_reviews_for_bucket, key=lambda k: k[0]):
-        # Get reviews for a particular card in a particular bucket.
-        # The key is (bucket_index, cid).
-        card_reviews = all_reviews_for_bucket[key]
-
-        bucket_index, cid = key
-
-        last_ivl = last_ivl_by_cid.get(cid, 0)
-
-        if bucket_index < min_bucket_index:
-            min_bucket_index = bucket_index
-
-        if bucket_index > max_bucket_index:
-            max_bucket_index = bucket_index
-
-        bucket_stats = stats_by_bucket.get(bucket_index)
-        if not bucket_stats:
-            bucket_stats = _new_bucket_stats(bucket_index)
-            stats_by_bucket[bucket_index] = bucket_stats
-
-        if _has_matured(card_reviews, last_ivl):
-            bucket_stats.stats.matured_cards += 1
-
-        bucket_stats.stats.matured_reviews += _num_matured(card_reviews)
-
-        if _has_lost_matured(card_reviews, last_ivl):
-            bucket_stats.stats.lost_matured_card += 1
-
-        if _has_learned(card_reviews):
-            bucket_stats.stats.learned_cards += 1
-
-        last_ivl_by_cid[cid] = card_reviews.reviews[-1].ivl
+    min_bucket_index = min(min_bucket_index, *stats_by_bucket)
+    max_bucket_index = max(max_bucket_index, *stats_by_bucket)
 
     for bucket_index in range(min_bucket_index, max_bucket_index + 1):
         # Fill in days missing reviews with zero values
@@ -14,7 +14,7 @@
 
 import inspect
 import math
-from .compute import get_stats
+from .compute import get_stats, STREAM_CHUNK
 from anki.lang import _
 
 
@@ -56,7 +56,8 @@ def ProgressGraphs(*args):
     stats = get_stats(
         db_table=self.col.db,
         bucket_size_days=bucket_size_days, num_buckets=num_buckets,
-        day_cutoff_seconds=self.col.sched.dayCutoff, additional_filter=self._revlogLimit())
+        day_cutoff_seconds=self.col.sched.dayCutoff, additional_filter=self._revlogLimit(),
+        revlog=getattr(self, "_revlog", None), chunk_size=STREAM_CHUNK)
 
     result = _plot(self,
                     stats["learned_cards"],
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+The rows of the card list in the browser.
+
+Rather than loading a Card and its Note for every cell, the rows are read a
+page at a time with a single query, and kept as tuples with the columns of
+both. Only the most recently used ones are kept, so scrolling through a long
+search doesn't hold on to the whole collection.
+
+Rendering the question and answer is much slower than reading the row, so
+those columns are rendered separately: asking for one that isn't ready
+queues it, and renderPending() renders a few of the queue at a time.
+"""
+
+from collections import namedtuple, OrderedDict
+
+from anki.consts import *
+from anki.utils import htmlToTextLine, splitFields
+
+# cards read from the DB at a time
+ROW_PAGE = 100
+# rows remembered
+ROW_CACHE = 5000
+# questions and answers waiting to be rendered; older requests are dropped,
+# as those rows have most likely been scrolled past
+QA_PENDING = 200
+
+# the card's columns have the same names as on Card, so code for either works
+CardRow = namedtuple("CardRow", """
+id nid did odid ord type queue due ivl factor reps lapses mod flags
+mid nmod tags flds""")
+
+_rowSql = """
+select c.id, c.nid, c.did, c.odid, c.ord, c.type, c.queue, c.due, c.ivl,
+c.factor, c.reps, c.lapses, c.mod, c.flags, n.mid, n.mod, n.tags, n.flds
+from cards c, notes n where c.nid = n.id and c.id in %s"""
+
+class CardRows:
+
+    def __init__(self, col, page=ROW_PAGE, size=ROW_CACHE):
+        self.col = col
+        self.page = page
+        self.size = size
+        # id -> CardRow
+        self._rows = OrderedDict()
+        # id -> (question, answer)
+        self._qa = OrderedDict()
+        # id -> row number, most recently asked for last
+        self._pending = OrderedDict()
+
+    def clear(self):
+        self._rows.clear()
+        self._qa.clear()
+        self._pending.clear()
+
+    def invalidate(self, cids):
+        """Forget the rows of CIDS, eg after their note was edited. True if
+        any of them were loaded."""
+        found = False
+        for id in cids:
+            if self._rows.pop(id, None) is not None:
+                found = True
+            if self._qa.pop(id, None) is not None:
+                found = True
+        return found
+
+    # Rows
+    ##########################################################################
+
+    def row(self, ids, n):
+        "The CardRow for IDS[N], reading its page of IDS if necessary."
+        id = ids[n]
+        row = self._rows.get(id)
+        if row:
+            self._rows.move_to_end(id)
+            return row
+        start = n - n % self.page
+        missing = [i for i in ids[start:start+self.page] if i not in self._rows]
+        with self.col.db.idSet(missing) as sids:
+            for r in self.col.db.execute(_rowSql % sids):
+                self._add(self._rows, r[0], CardRow(*r))
+        return self._rows[id]
+
+    def _add(self, cache, id, value):
+        cache[id] = value
+        cache.move_to_end(id)
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+
+    def model(self, row):
+        return self.col.models.get(row.mid)
+
+    def template(self, row):
+        m = self.model(row)
+        if m['type'] == MODEL_STD:
+            return m['tmpls'][row.ord]
+        return m['tmpls'][0]
+
+    def sortField(self, row):
+        "The text of the row's sort field."
+        m = self.model(row)
+        return splitFields(row.flds)[self.col.models.sortIdx(m)]
+
+    # Question and answer
+    ##########################################################################
+
+    def qa(self, ids, n):
+        """The (question, answer) columns of IDS[N] as text, or None if they
+        haven't been rendered yet, in which case they're queued."""
+        id = ids[n]
+        qa = self._qa.get(id)
+        if qa:
+            self._qa.move_to_end(id)
+            return qa
+        self._pending[id] = n
+        self._pending.move_to_end(id)
+        if len(self._pending) > QA_PENDING:
+            self._pending.popitem(last=False)
+        return None
+
+    def hasPending(self):
+        return bool(self._pending)
+
+    def renderPending(self, ids, count=20):
+        """Render up to COUNT of the queued questions and answers, the most
+        recently asked for first. Returns the row numbers rendered."""
+        done = []
+        while self._pending and len(done) < count:
+            id, n = self._pending.popitem()
+            if n >= len(ids) or ids[n] != id:
+                # the list changed since it was asked for
+                continue
+            self._add(self._qa, id, self.renderQA(self.row(ids, n)))
+            done.append(n)
+        return done
+
+    def renderQA(self, row):
+        "The (question, answer) columns of ROW, as the browser shows them."
+        m = self.model(row)
+        t = self.template(row)
+        data = [row.id, row.nid, row.mid, row.odid or row.did, row.ord,
+                row.tags, row.flds, row.flags]
+        qa = self.col._renderQA(data, t.get('bqfmt'), t.get('bafmt'))
+        css = "<style>%s</style>" % m['css']
+        q = htmlToTextLine(css + qa['q'])
+        a = htmlToTextLine(css + qa['a'])
+        if not t.get('bafmt') and a.startswith(q):
+            # strip the question from the answer
+            a = a[len(q):].strip()
+        return q, a
@@ -22,6 +22,14 @@ from anki.consts import *
 
 class Card:
 
+    # the collection keeps many cards around, see anki.identitymap
+    __slots__ = ("col", "timerStarted", "_qa", "_note", "id", "nid", "did",
+                 "ord", "mod", "usn", "type", "queue", "due", "ivl", "factor",
+                 "reps", "lapses", "left", "odue", "odid", "flags", "data",
+                 "crt",
+                 # set by the schedulers while answering
+                 "wasNew", "lastIvl", "lastFactor")
+
     @classmethod
     def create(cls, col, nid, ord, did, due):
         card = Card(col)
@@ -119,6 +127,7 @@ class Card:
                 self.nid, self.did, self.ord, self.mod, self.usn, self.type, self.queue, self.due, self.ivl,
                 self.factor, self.reps, self.lapses,
                 self.left, self.odue, self.odid, self.flags, self.data, self.id)
+        self.col._cards.flushed(self)
         self.col.log(self)
 
     def flushSched(self):
@@ -135,6 +144,7 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
             self.mod, self.usn, self.type, self.queue, self.due, self.ivl,
             self.factor, self.reps, self.lapses,
             self.left, self.odue, self.odid, self.did, self.id)
+        self.col._cards.flushed(self)
         self.col.log(self)
 
     def q(self, reload=False, browser=False):
@@ -160,6 +170,9 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
 
     def note(self, reload=False):
         if not self._note or reload:
+            if reload:
+                # not the remembered note, which may have unsaved changes
+                self.col._notes.pop(self.nid)
             self._note = self.col.getNote(self.nid)
         return self._note
 
@@ -197,12 +210,10 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
             return True
 
     def __repr__(self):
-        d = dict(self.__dict__)
-        # remove non-useful elements
-        del d['_note']
-        del d['_qa']
-        del d['col']
-        del d['timerStarted']
+        # skip non-useful elements
+        d = dict((k, getattr(self, k)) for k in self.__slots__
+                 if hasattr(self, k) and k not in (
+                         '_note', '_qa', 'col', 'timerStarted'))
         return pprint.pformat(d, width=300)
 
     def userFlag(self):
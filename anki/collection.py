@@ -12,6 +12,7 @@ import datetime
 import copy
 import traceback
 import json
+import functools
 
 from anki.lang import _, ngettext
 from anki.schedulers import SCHEDULERS
@@ -23,12 +24,19 @@ from anki.models import ModelManager
 from anki.media import MediaManager
 from anki.decks import DeckManager
 from anki.tags import TagManager
+from anki.revlogdaily import RevlogDaily
+from anki.registry import Registry
+from anki.mediarefs import MediaRefs
+from anki.identitymap import IdentityMap
+from anki.searchindex import SearchIndex
+from anki.db import IntegrityError
 from anki.consts import *
 from anki.errors import AnkiError
 from anki.sound import stripSounds
 import anki.latex  # sets up hook
 import anki.cards
 import anki.notes
+import anki.rendering
 import anki.template
 import anki.find
 
@@ -53,10 +61,19 @@ defaultConf = {
 }
 
 
+@functools.lru_cache(maxsize=anki.template.template.TEMPLATE_CACHE)
+def _clozeFormat(format, type, ord):
+    "Point the cloze: tags in FORMAT at cloze ORD of question or answer TYPE."
+    if type == "q":
+        format = re.sub("{{(?!type:)(.*?)cloze:", r"{{\1cq-%d:" % ord, format)
+        return format.replace("<%cloze:", "<%%cq:%d:" % ord)
+    format = re.sub("{{(.*?)cloze:", r"{{\1ca-%d:" % ord, format)
+    return format.replace("<%cloze:", "<%%ca:%d:" % ord)
+
 # this is initialized by storage.Collection
 class _Collection:
 
-    def __init__(self, db, server=False, log=False):
+    def __init__(self, db, server=False, log=False, searchIndex=False):
         self._debugLog = log
         self.db = db
         self.path = db._path
@@ -69,6 +86,20 @@ class _Collection:
         self.models = ModelManager(self)
         self.decks = DeckManager(self)
         self.tags = TagManager(self)
+        self.registry = Registry(self)
+        self.mediaRefs = MediaRefs(self)
+        self._cards = IdentityMap(self, lambda id: anki.cards.Card(self, id))
+        self._notes = IdentityMap(self, lambda id: anki.notes.Note(self, id=id))
+        self._searches = anki.find.SearchCache(self)
+        self.revlogDaily = RevlogDaily(self)
+        # last revlog id handed out, or None to read it from the db
+        self._revlogId = None
+        # an anki.journal.AnswerJournal when answers are journaled
+        self.journal = None
+        # an anki.searchindex.SearchIndex when searches use one
+        self.searchIndex = None
+        if searchIndex and not server:
+            self._attachSearchIndex()
         self.load()
         if not self.crt:
             d = datetime.datetime.today()
@@ -120,6 +151,15 @@ conf, models, decks, dconf, tags from col""")
         self.models.load(models)
         self.decks.load(decks, dconf)
         self.tags.load(tags)
+        self.registry.load()
+        self.mediaRefs.load()
+        if self.searchIndex:
+            self.searchIndex.load()
+
+    def _attachSearchIndex(self):
+        index = SearchIndex(self)
+        if index.attach():
+            self.searchIndex = index
 
     def isFirstVersionSchedulerUsed(self):
         return self.conf['usedScheduler'] == 'anki.sched.Scheduler'
@@ -139,6 +179,10 @@ is only necessary if you modify properties of this object or the conf dict."""
 crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             self.crt, self.mod, self.scm, self.dty,
             self._usn, self.ls, json.dumps(self.conf))
+        self.registry.stamp(self.mod)
+        self.mediaRefs.stamp(self.mod)
+        if self.searchIndex:
+            self.searchIndex.stamp(self.mod)
 
     def save(self, name=None, mod=None):
         "Flush, commit DB, and take out another write lock."
@@ -150,6 +194,8 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         if self.db.mod:
             self.flush(mod=mod)
             self.db.commit()
+            if self.journal:
+                self.journal.committed()
             self.lock()
             self.db.mod = False
         self._markOp(name)
@@ -171,15 +217,22 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         "Disconnect from DB."
         if self.db:
             if save:
+                self.registry.compact()
                 self.save()
             else:
                 self.db.rollback()
+            if self.journal:
+                self.journal.close()
+                self.journal = None
             if not self.server:
                 self.db.setAutocommit(True)
                 self.db.execute("pragma journal_mode = delete")
                 self.db.setAutocommit(False)
             self.db.close()
             self.db = None
+            self._cards.clear()
+            self._notes.clear()
+            self._searches.clear()
             self.media.close()
             self._closeLog()
 
@@ -188,11 +241,21 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         import anki.db
         if not self.db:
             self.db = anki.db.DB(self.path)
+            if self.searchIndex:
+                self.searchIndex.attach()
+                self.searchIndex.load()
+            # the temp triggers went with the old connection
+            self.mediaRefs.load()
             self.media.connect()
             self._openLog()
 
     def rollback(self):
         self.db.rollback()
+        self._cards.clear()
+        self._notes.clear()
+        self._searches.clear()
+        if self.journal:
+            self.journal.discard()
         self.load()
         self.lock()
 
@@ -234,10 +297,12 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
     ##########################################################################
 
     def getCard(self, id):
-        return anki.cards.Card(self, id)
+        "The card with ID. Repeated calls may return the same object."
+        return self._cards.get(id)
 
     def getNote(self, id):
-        return anki.notes.Note(self, id=id)
+        "The note with ID. Repeated calls may return the same object."
+        return self._notes.get(id)
 
     # Utils
     ##########################################################################
@@ -327,66 +392,66 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
     def genCards(self, nids):
         "Generate cards for non-empty templates, return ids to remove."
         # build map of (nid,ord) so we don't create dupes
-        snids = ids2str(nids)
-        have = {}
-        dids = {}
-        dues = {}
-        for id, nid, ord, did, due, odue, odid in self.db.execute(
-                "select id, nid, ord, did, due, odue, odid from cards where nid in " + snids):
-            # existing cards
-            if nid not in have:
-                have[nid] = {}
-            have[nid][ord] = id
-            # if in a filtered deck, add new cards to original deck
-            if odid != 0:
-                did = odid
-            # and their dids
-            if nid in dids:
-                if dids[nid] and dids[nid] != did:
-                    # cards are in two or more different decks; revert to
-                    # model default
-                    dids[nid] = None
-            else:
-                # first card or multiple cards in same deck
-                dids[nid] = did
-            # save due
-            if odid != 0:
-                due = odue
-            if nid not in dues:
-                dues[nid] = due
-        # build cards for each note
-        data = []
-        ts = maxID(self.db)
-        now = intTime()
-        rem = []
-        usn = self.usn()
-        for nid, mid, flds in self.db.execute(
-                "select id, mid, flds from notes where id in " + snids):
-            model = self.models.get(mid)
-            avail = self.models.availOrds(model, flds)
-            did = dids.get(nid) or model['did']
-            due = dues.get(nid)
-            # add any missing cards
-            for t in self._tmplsFromOrds(model, avail):
-                doHave = nid in have and t['ord'] in have[nid]
-                if not doHave:
-                    # check deck is not a cram deck
-                    did = t['did'] or did
-                    if self.decks.isDyn(did):
-                        did = 1
-                    # if the deck doesn't exist, use default instead
-                    did = self.decks.get(did)['id']
-                    # use sibling due# if there is one, else use a new id
-                    if due is None:
-                        due = self.nextID("pos")
-                    data.append((ts, nid, did, t['ord'],
-                                 now, usn, due))
-                    ts += 1
-            # note any cards that need removing
-            if nid in have:
-                for ord, id in list(have[nid].items()):
-                    if ord not in avail:
-                        rem.append(id)
+        with self.db.idSet(nids) as snids:
+            have = {}
+            dids = {}
+            dues = {}
+            for id, nid, ord, did, due, odue, odid in self.db.execute(
+                    "select id, nid, ord, did, due, odue, odid from cards where nid in " + snids):
+                # existing cards
+                if nid not in have:
+                    have[nid] = {}
+                have[nid][ord] = id
+                # if in a filtered deck, add new cards to original deck
+                if odid != 0:
+                    did = odid
+                # and their dids
+                if nid in dids:
+                    if dids[nid] and dids[nid] != did:
+                        # cards are in two or more different decks; revert to
+                        # model default
+                        dids[nid] = None
+                else:
+                    # first card or multiple cards in same deck
+                    dids[nid] = did
+                # save due
+                if odid != 0:
+                    due = odue
+                if nid not in dues:
+                    dues[nid] = due
+            # build cards for each note
+            data = []
+            ts = maxID(self.db)
+            now = intTime()
+            rem = []
+            usn = self.usn()
+            for nid, mid, flds in self.db.execute(
+                    "select id, mid, flds from notes where id in " + snids):
+                model = self.models.get(mid)
+                avail = self.models.availOrds(model, flds)
+                did = dids.get(nid) or model['did']
+                due = dues.get(nid)
+                # add any missing cards
+                for t in self._tmplsFromOrds(model, avail):
+                    doHave = nid in have and t['ord'] in have[nid]
+                    if not doHave:
+                        # check deck is not a cram deck
+                        did = t['did'] or did
+                        if self.decks.isDyn(did):
+                            did = 1
+                        # if the deck doesn't exist, use default instead
+                        did = self.decks.get(did)['id']
+                        # use sibling due# if there is one, else use a new id
+                        if due is None:
+                            due = self.nextID("pos")
+                        data.append((ts, nid, did, t['ord'],
+                                     now, usn, due))
+                        ts += 1
+                # note any cards that need removing
+                if nid in have:
+                    for ord, id in list(have[nid].items()):
+                        if ord not in avail:
+                            rem.append(id)
         # bulk update
         self.db.executemany("""
 insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""",
@@ -463,17 +528,18 @@ insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""",
         "Bulk delete cards by ID."
         if not ids:
             return
-        sids = ids2str(ids)
-        nids = self.db.list("select nid from cards where id in " + sids)
-        # remove cards
-        self._logRem(ids, REM_CARD)
-        self.db.execute("delete from cards where id in " + sids)
+        with self.db.idSet(ids) as sids:
+            nids = self.db.list("select nid from cards where id in " + sids)
+            # remove cards
+            self._logRem(ids, REM_CARD)
+            self.db.execute("delete from cards where id in " + sids)
         # then notes
         if not notes:
             return
-        nids = self.db.list("""
+        with self.db.idSet(nids) as snids:
+            nids = self.db.list("""
 select id from notes where id in %s and id not in (select nid from cards)""" %
-                            ids2str(nids))
+                                snids)
         self._remNotes(nids)
 
     def emptyCids(self):
@@ -491,6 +557,33 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
                 c=ords, f=flds.replace("\x1f", " / "))
         return rep
 
+    # Review log
+    ##########################################################################
+
+    def nextRevlogId(self):
+        """Return a new revlog id: the current time in ms, or if reviews
+        have been logged in this ms already, the next free one."""
+        if self._revlogId is None:
+            self._revlogId = self.db.scalar("select max(id) from revlog") or 0
+        self._revlogId = max(intTime(1000), self._revlogId + 1)
+        return self._revlogId
+
+    def logReview(self, cid, ease, ivl, lastIvl, factor, time, type, due, day):
+        "Add a review of card CID to the revlog, and return its id."
+        row = (cid, self.usn(), ease, ivl, lastIvl, factor, time, type, due, day)
+        try:
+            rid = self.nextRevlogId()
+            self.db.execute(
+                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)", rid, *row)
+        except IntegrityError:
+            # logged by something else; start again after it
+            self._revlogId = None
+            rid = self.nextRevlogId()
+            self.db.execute(
+                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)", rid, *row)
+        self.revlogDaily.add(rid)
+        return rid
+
     # Field checksums and sorting fields
     ##########################################################################
 
@@ -500,17 +593,17 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
 
     def updateFieldCache(self, nids):
         "Update field checksums and sort cache, after find&replace, etc."
-        snids = ids2str(nids)
         r = []
-        for (nid, mid, flds) in self._fieldData(snids):
-            fields = splitFields(flds)
-            model = self.models.get(mid)
-            if not model:
-                # note points to invalid model
-                continue
-            r.append((stripHTMLMedia(fields[self.models.sortIdx(model)]),
-                      fieldChecksum(fields[0]),
-                      nid))
+        with self.db.idSet(nids) as snids:
+            for (nid, mid, flds) in self._fieldData(snids):
+                fields = splitFields(flds)
+                model = self.models.get(mid)
+                if not model:
+                    # note points to invalid model
+                    continue
+                r.append((stripHTMLMedia(fields[self.models.sortIdx(model)]),
+                          fieldChecksum(fields[0]),
+                          nid))
         # apply, relying on calling code to bump usn+mod
         self.db.executemany("update notes set sfld=?, csum=? where id=?", r)
 
@@ -518,6 +611,18 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
     ##########################################################################
 
     def renderQA(self, ids=None, type="card"):
+        return list(self.iterRenderQA(ids, type))
+
+    def iterRenderQA(self, ids=None, type="card", workers=None):
+        """Yield the question and answer of each card, as _renderQA()
+        does. Large numbers of cards are rendered in WORKERS processes."""
+        where = self._qaWhere(ids, type)
+        count = self.db.scalar(
+            "select count() from cards c, notes f where c.nid == f.id " + where)
+        return anki.rendering.renderQA(
+            self, self._qaData(where), count, workers)
+
+    def _qaWhere(self, ids, type):
         # gather metadata
         if type == "card":
             where = "and c.id in " + ids2str(ids)
@@ -529,18 +634,17 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
             where = ""
         else:
             raise Exception()
-        return [self._renderQA(row)
-                for row in self._qaData(where)]
+        return where
 
-    def _renderQA(self, data, qfmt=None, afmt=None):
-        "Returns hash of id, question, answer."
+    def _renderQA(self, data, qfmt=None, afmt=None, answer=True):
+        "Returns hash of id, question, and unless ANSWER is false, answer."
         # data is [cid, nid, mid, did, ord, tags, flds, cardFlags]
         # unpack fields and create dict
         flist = splitFields(data[6])
         fields = {}
         model = self.models.get(data[2])
-        for (name, (idx, conf)) in list(self.models.fieldMap(model).items()):
-            fields[name] = flist[idx]
+        for f in model['flds']:
+            fields[f['name']] = flist[f['ord']]
         fields['Tags'] = data[5].strip()
         fields['Type'] = model['name']
         fields['Deck'] = self.decks.name(data[3])
@@ -556,17 +660,10 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
         d = dict(id=data[0])
         qfmt = qfmt or template['qfmt']
         afmt = afmt or template['afmt']
-        for (type, format) in (("q", qfmt), ("a", afmt)):
-            if type == "q":
-                format = re.sub("{{(?!type:)(.*?)cloze:",
-                                r"{{\1cq-%d:" % (data[4] + 1), format)
-                format = format.replace("<%cloze:", "<%%cq:%d:" % (
-                        data[4] + 1))
-            else:
-                format = re.sub("{{(.*?)cloze:", r"{{\1ca-%d:" % (data[4] + 1),
-                                format)
-                format = format.replace("<%cloze:", "<%%ca:%d:" % (
-                        data[4] + 1))
+        formats = (("q", qfmt), ("a", afmt)) if answer else (("q", qfmt),)
+        for (type, format) in formats:
+            format = _clozeFormat(format, type, data[4] + 1)
+            if type == "a":
                 fields['FrontSide'] = stripSounds(d['q'])
             fields = runFilter("mungeFields", fields, model, data, self)
             html = anki.template.render(format, fields)
@@ -601,6 +698,9 @@ where c.nid == f.id
     def findCards(self, query, order=False):
         return anki.find.Finder(self).findCards(query, order)
 
+    def iterFindCards(self, query, order=False, page=anki.find.SEARCH_PAGE):
+        return anki.find.Finder(self).iterCards(query, order, page)
+
     def findNotes(self, query):
         return anki.find.Finder(self).findNotes(query)
 
@@ -682,6 +782,7 @@ where c.nid == f.id
         last = self.db.scalar(
             "select id from revlog where cid = ? "
             "order by id desc limit 1", c.id)
+        self.revlogDaily.remove(last)
         self.db.execute("delete from revlog where id = ?", last)
         # restore any siblings
         self.db.execute(
@@ -692,6 +793,8 @@ where c.nid == f.id
         type = ("new", "lrn", "rev")[n]
         self.sched._updateStats(c, type, -1)
         self.sched.reps -= 1
+        if self.journal:
+            self.journal.undone(c, last)
         return c.id
 
     def _markOp(self, name):
@@ -771,6 +874,9 @@ and type = 0""", intTime(), self.usn())
         curs.execute("update revlog set ivl=round(ivl),lastIvl=round(lastIvl) where ivl!=round(ivl) or lastIvl!=round(lastIvl)")
         if curs.rowcount:
             problems.append("Fixed %d review history entries with v2 scheduler bug." % curs.rowcount)
+            self.revlogDaily.invalidate()
+        # bring the review summaries up to date
+        self.revlogDaily.today()
         # and finally, optimize
         self.optimize()
         newSize = os.stat(self.path)[stat.ST_SIZE]
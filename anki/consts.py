@@ -49,6 +49,8 @@ STARTING_FACTOR = 2500
 SCHEMA_VERSION = 14
 SYNC_ZIP_SIZE = int(2.5*1024*1024)
 SYNC_ZIP_COUNT = 25
+# media zips being downloaded at once
+SYNC_MEDIA_INFLIGHT = 4
 SYNC_BASE = "https://sync%s.ankiweb.net/"
 SYNC_VER = 9
 
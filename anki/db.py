@@ -3,28 +3,61 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import os
+import re
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
 from sqlite3 import dbapi2 as sqlite, Cursor
 
 DBError = sqlite.Error
+IntegrityError = sqlite.IntegrityError
+
+# number of distinct sql strings remembered by each DB
+STATEMENT_CACHE = 256
+# literal id lists at least this long are bound as a single parameter
+ID_LIST_MIN = 20
+
+_writeRe = re.compile(r"\s*(insert|update|delete|replace)\b", re.I)
+# an ids2str() list, eg "in (1,2,3)"
+_idListRe = re.compile(r"\bin\s*\((\s*-?\d+(?:\s*,\s*-?\d+)*\s*)\)", re.I)
+# positional placeholders, skipping over quoted strings
+_placeholderRe = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\?")
 
 class DB:
-    def __init__(self, path, timeout=0):
-        self._db = sqlite.connect(path, timeout=timeout)
+    # rewrite long literal id lists so the statement text stays the same
+    bindIdLists = True
+
+    def __init__(self, path, timeout=0, readonly=False):
+        if readonly:
+            # eg a second connection reading from another thread
+            self._db = sqlite.connect(
+                "file:%s?mode=ro" % pathname2url(path), timeout=timeout,
+                cached_statements=STATEMENT_CACHE, uri=True)
+        else:
+            self._db = sqlite.connect(path, timeout=timeout,
+                                      cached_statements=STATEMENT_CACHE)
         self._db.execute('PRAGMA temp_store = MEMORY;')
         self._db.text_factory = self._textFactory
         self._path = path
         self.echo = os.environ.get("DBECHO")
         self.mod = False
+        # sql -> True if it modifies the db
+        self._stmts = OrderedDict()
+        # temp tables not currently used by idSet()
+        self._freeIdTables = []
+        self._idTableCount = 0
+        # rows written to idSet()'s tables, see changes()
+        self._idSetChanges = 0
 
     def execute(self, sql, *a, **ka):
-        s = sql.strip().lower()
+        sql, a, ka, write = self._prepare(sql, a, ka)
         # mark modified?
-        for stmt in "insert", "update", "delete":
-            if s.startswith(stmt):
-                self.mod = True
-        t = time.time()
+        if write:
+            self.mod = True
+        if self.echo:
+            t = time.time()
         if ka:
             # execute("...where id = :id", id=5)
             res = self._db.execute(sql, ka)
@@ -38,9 +71,85 @@ class DB:
                 print(a, ka)
         return res
 
+    def _prepare(self, sql, a, ka):
+        "Return (sql, args, kwargs, isWrite), binding any long id lists."
+        write = self._stmts.get(sql)
+        if write is not None:
+            self._stmts.move_to_end(sql)
+            return sql, a, ka, write
+        write = bool(_writeRe.match(sql))
+        if self.bindIdLists:
+            lists = [m for m in _idListRe.finditer(sql)
+                     if m.group(1).count(",") >= ID_LIST_MIN - 1]
+            if lists:
+                # the list changes from call to call, so don't cache it
+                sql, a, ka = self._bindIdLists(sql, a, ka, lists)
+                return sql, a, ka, write
+        self._stmts[sql] = write
+        if len(self._stmts) > STATEMENT_CACHE:
+            self._stmts.popitem(last=False)
+        return sql, a, ka, write
+
+    def _bindIdLists(self, sql, a, ka, lists):
+        "Replace each literal list with a json array parameter."
+        if not ka:
+            placeholders = [m.start() for m in _placeholderRe.finditer(sql)
+                            if m.group() == "?"]
+            a = list(a)
+        buf = []
+        last = 0
+        for n, m in enumerate(lists):
+            ids = "[%s]" % m.group(1)
+            if ka:
+                name = "_ids%d" % n
+                ka[name] = ids
+                param = ":" + name
+            else:
+                idx = len([p for p in placeholders if p < m.start()]) + n
+                a.insert(idx, ids)
+                param = "?"
+            buf.append(sql[last:m.start()])
+            buf.append("in (select value from json_each(%s))" % param)
+            last = m.end()
+        buf.append(sql[last:])
+        return "".join(buf), a, ka
+
+    @contextmanager
+    def idSet(self, ids):
+        """Yield an operand for 'in' which matches IDS, eg
+        "select nid from cards where id in %s" % sids.
+
+        Large sets are bulk loaded into a temp table for the duration of
+        the block rather than formatted into the sql. The table is reused,
+        so don't keep cursors on it open past the block."""
+        ids = list(ids)
+        if len(ids) < ID_LIST_MIN:
+            yield "(%s)" % ",".join(str(i) for i in ids)
+            return
+        if self._freeIdTables:
+            name = self._freeIdTables.pop()
+        else:
+            name = "_idset%d" % self._idTableCount
+            self._idTableCount += 1
+        # a rollback may have discarded the table
+        self._db.execute(
+            "create temp table if not exists %s (id integer primary key)" % name)
+        old = self._db.total_changes
+        self._db.executemany("insert or ignore into temp.%s values (?)" % name,
+                             ((i,) for i in ids))
+        self._idSetChanges += self._db.total_changes - old
+        try:
+            yield "temp." + name
+        finally:
+            old = self._db.total_changes
+            self._db.execute("delete from temp.%s" % name)
+            self._idSetChanges += self._db.total_changes - old
+            self._freeIdTables.append(name)
+
     def executemany(self, sql, l):
         self.mod = True
-        t = time.time()
+        if self.echo:
+            t = time.time()
         self._db.executemany(sql, l)
         if self.echo:
             print(sql, "%0.3fms" % ((time.time() - t)*1000))
@@ -48,7 +157,8 @@ class DB:
                 print(l)
 
     def commit(self):
-        t = time.time()
+        if self.echo:
+            t = time.time()
         self._db.commit()
         if self.echo:
             print("commit %0.3fms" % ((time.time() - t)*1000))
@@ -97,6 +207,11 @@ class DB:
     def totalChanges(self):
         return self._db.total_changes
 
+    def changes(self):
+        """Like totalChanges(), but without the rows written to idSet()'s
+        tables, so it only moves when the collection itself changes."""
+        return self._db.total_changes - self._idSetChanges
+
     def interrupt(self):
         self._db.interrupt()
 
@@ -2,7 +2,7 @@
 # Copyright: Ankitects Pty Ltd and contributors
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import copy, operator
+import bisect, copy, operator
 import unicodedata
 import json
 
@@ -96,10 +96,15 @@ class DeckManager:
 
     def __init__(self, col):
         self.col = col
+        self._tree = None
+        # (kind, id) of changed decks and confs, see anki.registry
+        self._dirty = set()
 
     def load(self, decks, dconf):
         self.decks = json.loads(decks)
         self.dconf = json.loads(dconf)
+        self._tree = None
+        self._dirty = set()
         # set limits to within bounds
         found = False
         for c in list(self.dconf.values()):
@@ -113,18 +118,37 @@ class DeckManager:
             self.changed = False
 
     def save(self, g=None):
-        "Can be called with either a deck or a deck configuration."
+        """Can be called with either a deck or a deck configuration.
+        Without one, the whole registry is rewritten."""
+        # searches by deck may now match different cards
+        self.col._searches.clear()
         if g:
             g['mod'] = intTime()
             g['usn'] = self.col.usn()
-        self.changed = True
+            self._markDirty(g)
+        else:
+            self.changed = True
+
+    def _markDirty(self, g):
+        id = str(g['id'])
+        if self.decks.get(id) is g:
+            self._dirty.add(("deck", id))
+        elif self.dconf.get(id) is g:
+            self._dirty.add(("dconf", id))
+        else:
+            self.changed = True
 
     def flush(self):
         if self.changed:
             self.col.db.execute("update col set decks=?, dconf=?",
                                  json.dumps(self.decks),
                                  json.dumps(self.dconf))
+            self.col.registry.clear(("deck", "dconf"))
             self.changed = False
+            self._dirty = set()
+        elif self._dirty:
+            self.col.registry.write(self._dirty)
+            self._dirty = set()
 
     # Deck save/load
     #############################################################
@@ -135,9 +159,9 @@ class DeckManager:
             type = defaultDeck
         name = name.replace('"', '')
         name = unicodedata.normalize("NFC", name)
-        for id, g in list(self.decks.items()):
-            if unicodedata.normalize("NFC", g['name'].lower()) == name.lower():
-                return int(id)
+        g = self._hierarchy().byLowerName.get(name.lower())
+        if g:
+            return int(g['id'])
         if not create:
             return None
         g = copy.deepcopy(type)
@@ -151,6 +175,12 @@ class DeckManager:
                 break
         g['id'] = id
         self.decks[str(id)] = g
+        if self._tree is not None:
+            if self._tree.hasDescendants(name):
+                # decks left without this parent need linking back to it
+                self._tree = None
+            else:
+                self._tree.add(g)
         self.save(g)
         self.maybeAddToActive()
         runHook("newDeck")
@@ -180,6 +210,7 @@ class DeckManager:
                     name = base + suffix
                     if not self.byName(name):
                         deck['name'] = name
+                        self._tree = None
                         self.save(deck)
                         break
                     suffix += "1"
@@ -211,6 +242,7 @@ class DeckManager:
                 self.col.remCards(cids)
         # delete the deck and add a grave
         del self.decks[str(did)]
+        self._tree = None
         # ensure we have an active deck
         if did in self.active():
             self.select(int(list(self.decks.keys())[0]))
@@ -253,16 +285,15 @@ class DeckManager:
 
     def byName(self, name):
         "Get deck with NAME."
-        for m in list(self.decks.values()):
-            if m['name'] == name:
-                return m
+        return self._hierarchy().nameMap.get(name)
 
     def update(self, g):
         "Add or update an existing deck. Used for syncing and merging."
         self.decks[str(g['id'])] = g
+        self._tree = None
         self.maybeAddToActive()
         # mark registry changed, but don't bump mod time
-        self.save()
+        self._markDirty(g)
 
     def rename(self, g, newName):
         "Rename deck prefix to NAME if not exists. Updates children."
@@ -283,6 +314,7 @@ class DeckManager:
                 self.save(grp)
         # adjust name
         g['name'] = newName
+        self._tree = None
         # ensure we have parents again, as we may have renamed parent->child
         newName = self._ensureParents(newName)
         self.save(g)
@@ -364,7 +396,7 @@ class DeckManager:
 
     def updateConf(self, g):
         self.dconf[str(g['id'])] = g
-        self.save()
+        self._markDirty(g)
 
     def confId(self, name, cloneFrom=None):
         "Create a new configuration and return id."
@@ -467,12 +499,14 @@ class DeckManager:
             if deck['name'] in names:
                 print("fix duplicate deck name", deck['name'].encode("utf8"))
                 deck['name'] += "%d" % intTime(1000)
+                self._tree = None
                 self.save(deck)
 
             # ensure no sections are blank
             if not all(deck['name'].split("::")):
                 print("fix deck with missing sections", deck['name'].encode("utf8"))
                 deck['name'] = "recovered%d" % intTime(1000)
+                self._tree = None
                 self.save(deck)
 
             # immediate parent must exist
@@ -513,16 +547,15 @@ class DeckManager:
         actv = self.children(did)
         actv.sort()
         self.col.conf['activeDecks'] = [did] + [a[1] for a in actv]
-        self.changed = True
+        self.col.setMod()
 
     def children(self, did):
         "All children of did, as (name, id)."
-        name = self.get(did)['name']
-        actv = []
-        for g in self.all():
-            if g['name'].startswith(name + "::"):
-                actv.append((g['name'], g['id']))
-        return actv
+        tree = self._hierarchy()
+        did = int(did)
+        if did not in tree.children:
+            did = self.get(did)['id']
+        return list(tree.children[did])
 
     def childDids(self, did, childMap):
         def gather(node, arr):
@@ -535,40 +568,23 @@ class DeckManager:
         return arr
 
     def childMap(self):
-        nameMap = self.nameMap()
-        childMap = {}
-
-        # go through all decks, sorted by name
-        for deck in sorted(self.all(), key=operator.itemgetter("name")):
-            node = {}
-            childMap[deck['id']] = node
-
-            # add note to immediate parent
-            parts = deck['name'].split("::")
-            if len(parts) > 1:
-                immediateParent = "::".join(parts[:-1])
-                pid = nameMap[immediateParent]['id']
-                childMap[pid][deck['id']] = node
-
-        return childMap
+        "Nested {did: {child did: {...}}} of all decks. Do not modify."
+        return self._hierarchy().childMap
 
     def parents(self, did, nameMap=None):
         "All parents of did."
-        # get parent and grandparent names
+        # nameMap is no longer needed, as the hierarchy is cached
+        pids = self._hierarchy().parents.get(int(did))
+        if pids is not None:
+            return [self.decks[str(pid)] for pid in pids]
+        # unknown deck, or a parent is missing and needs to be created
         parents = []
         for part in self.get(did)['name'].split("::")[:-1]:
             if not parents:
                 parents.append(part)
             else:
                 parents.append(parents[-1] + "::" + part)
-        # convert to objects
-        for c, p in enumerate(parents):
-            if nameMap:
-                deck = nameMap[p]
-            else:
-                deck = self.get(self.id(p))
-            parents[c] = deck
-        return parents
+        return [self.get(self.id(p)) for p in parents]
 
     def parentsByName(self, name):
         "All existing parents of name"
@@ -587,7 +603,14 @@ class DeckManager:
         return parents
 
     def nameMap(self):
-        return dict((d['name'], d) for d in self.decks.values())
+        "{name: deck} of all decks. Do not modify."
+        return self._hierarchy().nameMap
+
+    def _hierarchy(self):
+        "The deck tree, rebuilt after decks are added, renamed or removed."
+        if self._tree is None:
+            self._tree = _DeckTree(self.decks)
+        return self._tree
 
     # Sync handling
     ##########################################################################
@@ -610,3 +633,49 @@ class DeckManager:
 
     def isDyn(self, did):
         return self.get(did)['dyn']
+
+
+class _DeckTree:
+    "Precomputed parent/child lookups for a snapshot of the deck list."
+
+    def __init__(self, decks):
+        self.nameMap = {}
+        self.byLowerName = {}
+        # did -> ancestor dids, top level first; None if one is missing
+        self.parents = {}
+        # did -> all descendants as (name, did), sorted by name
+        self.children = {}
+        self.childMap = {}
+        # parents sort before their children, so they're always seen first
+        for deck in sorted(decks.values(), key=operator.itemgetter('name')):
+            self.add(deck)
+
+    def hasDescendants(self, name):
+        "True if there are decks under NAME, whether or not it exists."
+        prefix = name + "::"
+        return any(n.startswith(prefix) for n in self.nameMap)
+
+    def add(self, deck):
+        """Add a deck whose parents have already been added, and which has no
+        children yet."""
+        name = deck['name']
+        did = deck['id']
+        self.nameMap[name] = deck
+        self.byLowerName.setdefault(
+            unicodedata.normalize("NFC", name.lower()), deck)
+        self.children[did] = []
+        node = self.childMap[did] = {}
+        parts = name.split("::")
+        pids = []
+        parent = None
+        for i in range(1, len(parts)):
+            parent = self.nameMap.get("::".join(parts[:i]))
+            if not parent:
+                pids = None
+                continue
+            bisect.insort(self.children[parent['id']], (name, did))
+            if pids is not None:
+                pids.append(parent['id'])
+        self.parents[did] = pids
+        if parent:
+            self.childMap[parent['id']][did] = node
@@ -156,40 +156,40 @@ class AnkiExporter(Exporter):
         # copy cards, noting used nids
         nids = {}
         data = []
-        for row in self.src.db.execute(
-            "select * from cards where id in "+ids2str(cids)):
-            nids[row[1]] = True
-            data.append(row)
-            # clear flags
-            row = list(row)
-            row[-2] = 0
-        self.dst.db.executemany(
-            "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            data)
+        with self.src.db.idSet(cids) as scids:
+            for row in self.src.db.execute(
+                "select * from cards where id in "+scids):
+                nids[row[1]] = True
+                data.append(row)
+                # clear flags
+                row = list(row)
+                row[-2] = 0
+            self.dst.db.executemany(
+                "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                data)
+            # card history and revlog
+            if self.includeSched:
+                data = self.src.db.all(
+                    "select * from revlog where cid in "+scids)
+                self.dst.db.executemany(
+                    "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
+                    data)
         # notes
-        strnids = ids2str(list(nids.keys()))
         notedata = []
-        for row in self.src.db.all(
-            "select * from notes where id in "+strnids):
-            # remove system tags if not exporting scheduling info
-            if not self.includeSched:
-                row = list(row)
-                row[5] = self.removeSystemTags(row[5])
-            notedata.append(row)
+        with self.src.db.idSet(nids.keys()) as snids:
+            for row in self.src.db.all(
+                "select * from notes where id in "+snids):
+                # remove system tags if not exporting scheduling info
+                if not self.includeSched:
+                    row = list(row)
+                    row[5] = self.removeSystemTags(row[5])
+                notedata.append(row)
         self.dst.db.executemany(
             "insert into notes values (?,?,?,?,?,?,?,?,?,?,?)",
             notedata)
         # models used by the notes
-        mids = self.dst.db.list("select distinct mid from notes where id in "+
-                                strnids)
-        # card history and revlog
-        if self.includeSched:
-            data = self.src.db.all(
-                "select * from revlog where cid in "+ids2str(cids))
-            self.dst.db.executemany(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
-                data)
-        else:
+        mids = set(row[2] for row in notedata)
+        if not self.includeSched:
             # need to reset card state
             self.dst.sched.resetCards(cids)
         # models - start with zero
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import math
+from collections import deque
+from heapq import heappush, heappop
+
+
+class FairQueue:
+    """Interleave (cid, did) pairs so each deck's cards are spread evenly.
+
+    The decks form a tree, given by the ancestors of each deck, and every
+    node is a weighted round-robin over its subdecks and its own cards: a
+    child which has handed out `used` of its `total` cards is next due at
+    virtual time (used + 0.5) / total. So the top level decks are drained in
+    proportion to their share of the queue, then each deck's subdecks in
+    proportion to their share of it, and so on. Ties are broken by the
+    original position of the card, and the order of the cards within a deck
+    is always preserved.
+
+    Spreading a deck out mustn't push its cards too far back either, as the
+    queue is sorted by priority, so a card is never handed out more than
+    about sqrt(n) places after its original position, n being the number of
+    cards added.
+
+    Popping a card costs O(h log d) for a tree of height h with at most d
+    subdecks per deck, and more cards can be added with extend() at any time
+    without rebuilding the queue."""
+
+    def __init__(self, cards=(), parents=None):
+        # the tree: a deck's own cards are in a leaf (did,), which is a
+        # child of the deck's node did, which is a child of its parent's
+        # node, or of the root None
+        self._parent = {}
+        self._depth = {None: 0}
+        self._heaps = {None: []}
+        # (did,) -> deque of (original position, cid)
+        self._pending = {}
+        self._total = {}
+        self._used = {}
+        # heap entries are (virtual time, position of the child's next card,
+        # version, child); entries whose version is out of date are skipped
+        self._version = {}
+        # (position, leaf) of the leaves' first cards, oldest first
+        self._fronts = []
+        self._pos = 0
+        self._out = 0
+        self._len = 0
+        self.extend(cards, parents)
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        while self._len:
+            yield self.pop()
+
+    def extend(self, cards, parents=None):
+        """Add (cid, did) pairs, keeping the cards already handed out.
+        PARENTS maps a did to the ids of its ancestors, top level first;
+        decks without an entry are treated as top level."""
+        parents = parents or {}
+        touched = set()
+        for cid, did in cards:
+            leaf = (did,)
+            if leaf not in self._pending:
+                self._addDeck(did, parents.get(did, ()))
+            pending = self._pending[leaf]
+            if not pending:
+                heappush(self._fronts, (self._pos, leaf))
+            pending.append((self._pos, cid))
+            node = leaf
+            while node is not None:
+                self._total[node] += 1
+                touched.add(node)
+                node = self._parent[node]
+            self._pos += 1
+            self._len += 1
+        # shares changed, so the old heap entries are stale; children first,
+        # as a node's entry depends on its children's
+        for node in sorted(touched, key=self._depth.get, reverse=True):
+            self._push(node)
+
+    def pop(self):
+        "Return the next card id. Raises IndexError if empty."
+        if not self._len:
+            raise IndexError("pop from empty FairQueue")
+        leaf = self._overdue()
+        if leaf is None:
+            # follow the next child down from the root
+            node = None
+            while node not in self._pending:
+                node = self._top(node)[3]
+            leaf = node
+        pos, cid = self._pending[leaf].popleft()
+        if self._pending[leaf]:
+            heappush(self._fronts, (self._pending[leaf][0][0], leaf))
+        self._out += 1
+        self._len -= 1
+        node = leaf
+        while node is not None:
+            self._used[node] += 1
+            self._push(node)
+            node = self._parent[node]
+        return cid
+
+    def _addDeck(self, did, ancestors):
+        parent = None
+        for node in list(ancestors) + [did, (did,)]:
+            if node not in self._parent:
+                self._parent[node] = parent
+                self._depth[node] = self._depth[parent] + 1
+                self._total[node] = 0
+                self._used[node] = 0
+                self._version[node] = 0
+                if node == (did,):
+                    self._pending[node] = deque()
+                else:
+                    self._heaps[node] = []
+            parent = node
+
+    def _overdue(self):
+        "The leaf whose first card is overdue, if any."
+        bound = max(1, int(math.sqrt(self._pos)))
+        fronts = self._fronts
+        while fronts:
+            pos, leaf = fronts[0]
+            pending = self._pending[leaf]
+            if not pending or pending[0][0] != pos:
+                # handed out since
+                heappop(fronts)
+                continue
+            if pos + bound <= self._out:
+                return leaf
+            return None
+        return None
+
+    def _top(self, node):
+        "The current heap entry of NODE's next child, or None."
+        heap = self._heaps[node]
+        while heap and heap[0][2] != self._version[heap[0][3]]:
+            heappop(heap)
+        return heap[0] if heap else None
+
+    def _push(self, node):
+        self._version[node] += 1
+        if self._used[node] == self._total[node]:
+            return
+        if node in self._pending:
+            nextPos = self._pending[node][0][0]
+        else:
+            nextPos = self._top(node)[1]
+        vtime = (self._used[node] + 0.5) / self._total[node]
+        heappush(self._heaps[self._parent[node]],
+                 (vtime, nextPos, self._version[node], node))
@@ -5,11 +5,21 @@
 import re
 import sre_constants
 import unicodedata
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
 
 from anki.utils import ids2str, splitFields, joinFields, intTime, fieldChecksum, stripHTMLMedia
 from anki.consts import *
 from anki.hooks import *
+from anki.db import DBError
 
+# searches remembered by each collection
+SEARCH_CACHE = 10
+# distinct query strings whose tokens are remembered
+TOKEN_CACHE = 1000
+# card ids read from the DB at a time by iterCards()
+SEARCH_PAGE = 1000
 
 # Find
 ##########################################################################
@@ -33,96 +43,162 @@ class Finder:
             flag=self._findFlag,
         )
         self.search['is'] = self._findCardState
+        builtin = dict(self.search)
         runHook("search", self.search)
+        # commands added or replaced by add-ons, whose results can't be cached
+        self._hooked = set(cmd for cmd, fn in self.search.items()
+                           if builtin.get(cmd) is not fn)
+        # id sets used by the query being built; see _idSet()
+        self._idSets = None
 
     def findCards(self, query, order=False):
         "Return a list of card ids for QUERY."
         tokens = self._tokenize(query)
-        preds, args = self._where(tokens)
-        if preds is None:
-            raise Exception("invalidSearch")
-        order, rev = self._order(order)
-        sql = self._query(preds, order)
-        try:
-            res = self.col.db.list(sql, *args)
-        except:
-            # invalid grouping
-            return []
-        if rev:
+        cache = self._cache(tokens)
+        if cache:
+            res = cache.get("card", tokens, order)
+            if res is not None:
+                return res
+            prev = cache.narrowable("card", tokens, order)
+        with self._queryIdSets():
+            if cache and prev:
+                # only check the new terms against the last results
+                ptokens, pres = prev
+                preds, args = self._where(tokens[len(ptokens):])
+                if preds is None:
+                    raise Exception("invalidSearch")
+                sql = self._query("c.id in %s and (%s)" % (
+                    self._idSet(pres), preds or "1"), "")
+            else:
+                preds, args = self._where(tokens)
+                if preds is None:
+                    raise Exception("invalidSearch")
+                sortOrder, rev = self._order(order)
+                sql = self._query(preds, sortOrder)
+            try:
+                res = self.col.db.list(sql, *args)
+            except:
+                # invalid grouping
+                return []
+        if cache and prev:
+            res = set(res)
+            res = [id for id in pres if id in res]
+        elif rev:
             res.reverse()
+        if cache:
+            cache.put("card", tokens, order, res)
         return res
 
+    def iterCards(self, query, order=False, page=SEARCH_PAGE):
+        """Yield the card ids for QUERY in lists of up to PAGE, as they're
+        read from the DB, so the first can be shown before the search is
+        done. Stops early if the DB is interrupted."""
+        tokens = self._tokenize(query)
+        cache = self._cache(tokens)
+        if cache:
+            res = cache.get("card", tokens, order)
+            if res is not None:
+                yield res
+                return
+        res = []
+        with self._queryIdSets():
+            preds, args = self._where(tokens)
+            if preds is None:
+                raise Exception("invalidSearch")
+            sortOrder, rev = self._order(order)
+            if rev:
+                # a reversed list can't be streamed, so sort the other way
+                sortOrder = " order by " + ", ".join(
+                    term + " desc" for term in
+                    sortOrder[len(" order by "):].split(","))
+            # the caller may change the collection between pages, so the
+            # results are only cached if it didn't
+            state = cache and cache._state()
+            try:
+                cur = self.col.db.execute(self._query(preds, sortOrder), *args)
+            except DBError:
+                # invalid grouping, or interrupted
+                return
+            try:
+                while True:
+                    try:
+                        ids = [r[0] for r in cur.fetchmany(page)]
+                    except DBError:
+                        # interrupted
+                        return
+                    if not ids:
+                        break
+                    res.extend(ids)
+                    yield ids
+            finally:
+                cur.close()
+            unchanged = cache and cache._state() == state
+        if unchanged:
+            cache.put("card", tokens, order, res)
+
     def findNotes(self, query):
         tokens = self._tokenize(query)
-        preds, args = self._where(tokens)
-        if preds is None:
-            return []
-        if preds:
-            preds = "(" + preds + ")"
-        else:
-            preds = "1"
-        sql = """
+        cache = self._cache(tokens)
+        if cache:
+            res = cache.get("note", tokens)
+            if res is not None:
+                return res
+            prev = cache.narrowable("note", tokens)
+        with self._queryIdSets():
+            if cache and prev:
+                ptokens, pres = prev
+                preds, args = self._where(tokens[len(ptokens):])
+            else:
+                preds, args = self._where(tokens)
+            if preds is None:
+                return []
+            if preds:
+                preds = "(" + preds + ")"
+            else:
+                preds = "1"
+            if cache and prev:
+                preds = "n.id in %s and %s" % (self._idSet(pres), preds)
+            sql = """
 select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
-        try:
-            res = self.col.db.list(sql, *args)
-        except:
-            # invalid grouping
-            return []
+            try:
+                res = self.col.db.list(sql, *args)
+            except:
+                # invalid grouping
+                return []
+        if cache and prev:
+            res = set(res)
+            res = [id for id in pres if id in res]
+        if cache:
+            cache.put("note", tokens, None, res)
         return res
 
+    def _cache(self, tokens):
+        "The collection's SearchCache, if the results of TOKENS can be cached."
+        for token in tokens:
+            if ":" in token and token.split(":", 1)[0].lower() in self._hooked:
+                return None
+        return self.col._searches
+
+    @contextmanager
+    def _queryIdSets(self):
+        "Release the id sets used by the enclosed query when it's done."
+        with ExitStack() as self._idSets:
+            try:
+                yield
+            finally:
+                self._idSets = None
+
+    def _idSet(self, ids):
+        "An operand for 'in' which stays valid until the query has run."
+        if self._idSets is None:
+            return ids2str(ids)
+        return self._idSets.enter_context(self.col.db.idSet(ids))
+
     # Tokenizing
     ######################################################################
 
     def _tokenize(self, query):
-        inQuote = False
-        tokens = []
-        token = ""
-        for c in query:
-            # quoted text
-            if c in ("'", '"'):
-                if inQuote:
-                    if c == inQuote:
-                        inQuote = False
-                    else:
-                        token += c
-                elif token:
-                    # quotes are allowed to start directly after a :
-                    if token[-1] == ":":
-                        inQuote = c
-                    else:
-                        token += c
-                else:
-                    inQuote = c
-            # separator (space and ideographic space)
-            elif c in (" ", '\u3000'):
-                if inQuote:
-                    token += c
-                elif token:
-                    # space marks token finished
-                    tokens.append(token)
-                    token = ""
-            # nesting
-            elif c in ("(", ")"):
-                if inQuote:
-                    token += c
-                else:
-                    if c == ")" and token:
-                        tokens.append(token)
-                        token = ""
-                    tokens.append(c)
-            # negation
-            elif c == "-":
-                if token:
-                    token += c
-                elif not tokens or tokens[-1] != "-":
-                    tokens.append("-")
-            # normal character
-            else:
-                token += c
-        # if we finished in a token, add it
-        if token:
-            tokens.append(token)
-        return tokens
+        return list(_tokens(query))
 
     # Query building
     ######################################################################
@@ -344,7 +420,16 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         val = val.replace("*", "%")
         args.append("%"+val+"%")
         args.append("%"+val+"%")
-        return "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
+        like = "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
+        nids = self._indexCandidates(val)
+        if nids is not None:
+            return "n.id in %s and %s" % (self._idSet(nids), like)
+        return like
+
+    def _indexCandidates(self, val, column=None):
+        "The nids the search index narrows a search for VAL down to, or None."
+        if self.col.searchIndex:
+            return self.col.searchIndex.candidates(val, column)
 
     def _findNids(self, args):
         (val, args) = args
@@ -401,7 +486,7 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                     ids.update(dids(d['id']))
         if not ids:
             return
-        sids = ids2str(ids)
+        sids = self._idSet(ids)
         return "c.did in %s or c.odid in %s" % (sids, sids)
 
     def _findTemplate(self, args):
@@ -443,11 +528,13 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         # gather nids
         regex = re.escape(val).replace("_", ".").replace(re.escape("%"), ".*")
         nids = []
-        for (id,mid,flds) in self.col.db.execute("""
+        sql = """
 select id, mid, flds from notes
-where mid in %s and flds like ? escape '\\'""" % (
-                         ids2str(list(mods.keys()))),
-                         "%"+val+"%"):
+where mid in %s and flds like ? escape '\\'""" % ids2str(list(mods.keys()))
+        cands = self._indexCandidates(val, "flds")
+        if cands is not None:
+            sql += " and id in %s" % self._idSet(cands)
+        for (id,mid,flds) in self.col.db.execute(sql, "%"+val+"%"):
             flds = splitFields(flds)
             ord = mods[str(mid)][1]
             strg = flds[ord]
@@ -458,7 +545,7 @@ where mid in %s and flds like ? escape '\\'""" % (
                 return
         if not nids:
             return "0"
-        return "n.id in %s" % ids2str(nids)
+        return "n.id in %s" % self._idSet(nids)
 
     def _findDupes(self, args):
         # caller must call stripHTMLMedia on passed val
@@ -476,6 +563,150 @@ where mid in %s and flds like ? escape '\\'""" % (
                 nids.append(nid)
         return "n.id in %s" % ids2str(nids)
 
+@functools.lru_cache(maxsize=TOKEN_CACHE)
+def _tokens(query):
+    inQuote = False
+    tokens = []
+    token = ""
+    for c in query:
+        # quoted text
+        if c in ("'", '"'):
+            if inQuote:
+                if c == inQuote:
+                    inQuote = False
+                else:
+                    token += c
+            elif token:
+                # quotes are allowed to start directly after a :
+                if token[-1] == ":":
+                    inQuote = c
+                else:
+                    token += c
+            else:
+                inQuote = c
+        # separator (space and ideographic space)
+        elif c in (" ", '\u3000'):
+            if inQuote:
+                token += c
+            elif token:
+                # space marks token finished
+                tokens.append(token)
+                token = ""
+        # nesting
+        elif c in ("(", ")"):
+            if inQuote:
+                token += c
+            else:
+                if c == ")" and token:
+                    tokens.append(token)
+                    token = ""
+                tokens.append(c)
+        # negation
+        elif c == "-":
+            if token:
+                token += c
+            elif not tokens or tokens[-1] != "-":
+                tokens.append("-")
+        # normal character
+        else:
+            token += c
+    # if we finished in a token, add it
+    if token:
+        tokens.append(token)
+    return tuple(tokens)
+
+# Search cache
+##########################################################################
+
+class SearchCache:
+    """The results of recent searches, so repeating a search, eg when the
+    browser is refreshed, returns them without going to the DB, and adding
+    terms to the end of one only checks its results against them.
+
+    Results are only reused while nothing has been written to the DB since,
+    and the day, current deck and sort order are unchanged. The deck and
+    model managers clear the cache when they change."""
+
+    def __init__(self, col, size=SEARCH_CACHE):
+        self.col = col
+        self._size = size
+        # (kind, tokens, order) -> (state, ids)
+        self._results = OrderedDict()
+
+    def _state(self):
+        return (self.col.db.changes(), self.col.sched.dayCutoff,
+                self.col.conf['curDeck'], self.col.conf['sortType'],
+                self.col.conf['sortBackwards'])
+
+    def get(self, kind, tokens, order=None):
+        "A copy of the cached results of TOKENS, or None."
+        key = (kind, tuple(tokens), order)
+        ent = self._results.get(key)
+        if ent and ent[0] == self._state():
+            self._results.move_to_end(key)
+            return list(ent[1])
+        return None
+
+    def narrowable(self, kind, tokens, order=None):
+        """(tokens, ids) of the longest cached search which TOKENS only adds
+        terms to, or None."""
+        state = self._state()
+        best = None
+        for (k, prev, o), (s, ids) in self._results.items():
+            if (k == kind and o == order and s == state and
+                    (not best or len(prev) > len(best[0])) and
+                    _narrows(prev, tokens)):
+                best = (prev, ids)
+        return best
+
+    def put(self, kind, tokens, order, ids):
+        "Called with the results of a search."
+        key = (kind, tuple(tokens), order)
+        self._results[key] = (self._state(), list(ids))
+        self._results.move_to_end(key)
+        if len(self._results) > self._size:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        self._results.clear()
+
+def _narrows(prev, tokens):
+    """True if TOKENS is PREV and'd with more terms, so its results are
+    those of PREV that match the extra terms."""
+    if not prev or len(tokens) <= len(prev) or tuple(tokens[:len(prev)]) != prev:
+        return False
+    if _depth(prev) != 0 or prev[-1] == "-" or prev[-1].lower() == "or":
+        return False
+    # neither part may be or'd at the top level, as "and" binds tighter:
+    # "a or b c" is "a or (b and c)"
+    return not _orsAtTop(prev) and not _orsAtTop(tokens[len(prev):])
+
+def _orsAtTop(tokens):
+    "True if TOKENS has an 'or' outside parentheses, or unbalanced ones."
+    depth = 0
+    for token in tokens:
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+            if depth < 0:
+                return True
+        elif depth == 0 and token.lower() == "or":
+            return True
+    return depth != 0
+
+def _depth(tokens):
+    "How many parentheses TOKENS leaves open, or -1 if it closes too many."
+    depth = 0
+    for token in tokens:
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+            if depth < 0:
+                return -1
+    return depth
+
 # Find and replace
 ##########################################################################
 
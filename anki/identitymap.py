@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+from collections import OrderedDict
+
+# cards or notes remembered by each map
+IDENTITY_MAP_SIZE = 20000
+
+class IdentityMap:
+    """The cards or notes most recently loaded or flushed, so asking for the
+    same id again returns the same object without going to the DB.
+
+    An object is only handed out while nothing else has been written to the
+    DB since it was loaded or flushed, as the write may have changed it. After
+    that the next lookup loads a new one."""
+
+    def __init__(self, col, load, size=IDENTITY_MAP_SIZE):
+        self.col = col
+        self._load = load
+        self._size = size
+        # id -> (db changes when loaded, object)
+        self._objs = OrderedDict()
+
+    def get(self, id):
+        changes = self.col.db.changes()
+        ent = self._objs.get(id)
+        if ent and ent[0] == changes:
+            self._objs.move_to_end(id)
+            return ent[1]
+        obj = self._load(id)
+        self._add(changes, obj)
+        return obj
+
+    def flushed(self, obj):
+        "Called after OBJ has been written to the DB."
+        self._add(self.col.db.changes(), obj)
+
+    def _add(self, changes, obj):
+        self._objs[obj.id] = (changes, obj)
+        self._objs.move_to_end(obj.id)
+        if len(self._objs) > self._size:
+            self._objs.popitem(last=False)
+
+    def pop(self, id):
+        "Forget ID, so the next get() loads it from the DB."
+        self._objs.pop(id, None)
+
+    def clear(self):
+        self._objs.clear()
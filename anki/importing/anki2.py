@@ -175,6 +175,7 @@ class Anki2Importer(Importer):
             "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
             update)
         self.dst.updateFieldCache(dirty)
+        self.dst.mediaRefs.update(dirty)
         self.dst.tags.registerNotes(dirty)
 
     # determine if note is a duplicate, and adjust mid and/or guid as required
@@ -367,8 +368,7 @@ class Anki2Importer(Importer):
         # apply
         self.dst.db.executemany("""
 insert or ignore into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", cards)
-        self.dst.db.executemany("""
-insert or ignore into revlog values (?,?,?,?,?,?,?,?,?,?,?)""", revlog)
+        self.dst.revlogDaily.merge(revlog)
 
     # Media
     ######################################################################
@@ -184,6 +184,7 @@ class NoteImporter(Importer):
         self.addUpdates(updates)
         # make sure to update sflds, etc
         self.col.updateFieldCache(self._ids)
+        self.col.mediaRefs.update(self._ids)
         # generate cards
         if self.col.genCards(self._ids):
             self.log.insert(0, _(
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+The answer journal makes reviews durable without committing the collection
+after every answer.
+
+Between saves the collection keeps a transaction open, so an answer only
+costs a few writes into it; the fsync happens when the transaction is
+committed. Without the journal that is every 5 minutes, and a crash loses
+everything answered since. With it, each answer also appends a line with
+the card's new scheduling state, its revlog entry and the deck counters to
+a file next to the collection, and the collection is saved every BATCH
+answers or INTERVAL seconds. The file is only written to, never synced, so
+it survives the program crashing, which is the common case.
+
+The file starts with the collection's mod time as of the last commit. When
+the collection is opened, a journal which matches is replayed and then
+removed; one that doesn't was left behind after its answers were
+committed, or belongs to a different copy of the collection.
+"""
+
+import os
+import json
+import time
+
+# save the collection after this many answers
+JOURNAL_BATCH = 25
+# or when the first unsaved answer is this many seconds old
+JOURNAL_INTERVAL = 30
+
+# as written by Card.flushSched()
+_cardCols = ("mod", "usn", "type", "queue", "due", "ivl", "factor", "reps",
+             "lapses", "left", "odue", "odid", "did", "id")
+_deckKeys = ("newToday", "revToday", "lrnToday", "timeToday")
+
+def journalPath(col):
+    return col.path + "-answers"
+
+class AnswerJournal:
+
+    def __init__(self, col, batch=JOURNAL_BATCH, interval=JOURNAL_INTERVAL):
+        self.col = col
+        self.batch = batch
+        self.interval = interval
+        self.path = journalPath(col)
+        self._file = None
+        self._count = 0
+        self._since = None
+
+    # Recording
+    ##########################################################################
+
+    def answered(self, card):
+        "Record the answer to CARD, which has just been flushed."
+        revlog = self.col.db.first(
+            "select * from revlog where cid = ? order by id desc limit 1",
+            card.id)
+        self._append(card, revlog=revlog and list(revlog))
+        if (self._count >= self.batch or
+                time.time() - self._since >= self.interval):
+            self.col.save()
+
+    def undone(self, card, rid):
+        "Record that the answer to CARD logged as RID was undone."
+        self._append(card, removed=rid)
+
+    def _append(self, card, revlog=None, removed=None):
+        if not self._file:
+            self._file = open(self.path, "w", encoding="utf8")
+            self._write(dict(mod=self.col.mod))
+            self._since = time.time()
+        decks = [self.col.decks.get(card.did)] + self.col.decks.parents(card.did)
+        self._write(dict(
+            card=[getattr(card, k) for k in _cardCols],
+            revlog=revlog, removed=removed,
+            decks=[[g['id']] + [g[k] for k in _deckKeys] for g in decks]))
+        self._count += 1
+
+    def _write(self, obj):
+        self._file.write(json.dumps(obj) + "\n")
+        # hand it to the OS, but don't wait for the disk
+        self._file.flush()
+
+    # Finishing
+    ##########################################################################
+
+    def committed(self):
+        "Called after the collection is committed."
+        self.discard()
+
+    def discard(self):
+        "Forget the journal, eg after its answers were committed or rolled back."
+        if self._file:
+            self._file.close()
+            self._file = None
+            os.unlink(self.path)
+        self._count = 0
+        self._since = None
+
+    close = discard
+
+# Replaying
+##########################################################################
+
+def replay(col):
+    """Apply any answers journaled after the last commit of COL. True if
+    there were any."""
+    path = journalPath(col)
+    if not os.path.exists(path):
+        return False
+    with open(path, encoding="utf8") as f:
+        lines = f.read().split("\n")
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # the last line may have been cut off
+            break
+    applied = False
+    if records and records[0].get("mod") == col.mod:
+        for rec in records[1:]:
+            _apply(col, rec)
+            applied = True
+        if applied:
+            col.save()
+    os.unlink(path)
+    return applied
+
+def _apply(col, rec):
+    col.db.execute("""update cards set
+mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
+lapses=?, left=?, odue=?, odid=?, did=? where id = ?""", *rec['card'])
+    if rec['revlog']:
+        col.revlogDaily.merge([rec['revlog']])
+    if rec['removed']:
+        col.revlogDaily.remove(rec['removed'])
+        col.db.execute("delete from revlog where id = ?", rec['removed'])
+    for row in rec['decks']:
+        g = col.decks.get(row[0], default=False)
+        if g:
+            g.update(zip(_deckKeys, row[1:]))
+            col.decks.save(g)
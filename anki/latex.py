@@ -39,28 +39,40 @@ def stripLatex(text):
 
 def mungeQA(html, type, fields, model, data, col):
     "Convert TEXT with embedded latex tags to image links."
+    return _mungeLatex(html, lambda latex: _imgLink(col, latex, model))
+
+def linkImages(html, model):
+    """Like mungeQA(), but link to the images whether they exist or not,
+    without building them."""
+    def link(latex):
+        fname = _imgName(_latexFromHtml(None, latex), model)
+        return '<img class=latex src="%s">' % fname
+    return _mungeLatex(html, link)
+
+def _mungeLatex(html, link):
     for match in regexps['standard'].finditer(html):
-        html = html.replace(match.group(), _imgLink(col, match.group(1), model))
+        html = html.replace(match.group(), link(match.group(1)))
     for match in regexps['expression'].finditer(html):
-        html = html.replace(match.group(), _imgLink(
-            col, "$" + match.group(1) + "$", model))
+        html = html.replace(match.group(), link("$" + match.group(1) + "$"))
     for match in regexps['math'].finditer(html):
-        html = html.replace(match.group(), _imgLink(
-            col,
-            "\\begin{displaymath}" + match.group(1) + "\\end{displaymath}", model))
+        html = html.replace(match.group(), link(
+            "\\begin{displaymath}" + match.group(1) + "\\end{displaymath}"))
     return html
 
-def _imgLink(col, latex, model):
-    "Return an img link for LATEX, creating if necesssary."
-    txt = _latexFromHtml(col, latex)
-
+def _imgName(txt, model):
+    "The file the latex TXT is rendered to."
     if model.get("latexsvg", False):
         ext = "svg"
     else:
         ext = "png"
+    return "latex-%s.%s" % (checksum(txt.encode("utf8")), ext)
+
+def _imgLink(col, latex, model):
+    "Return an img link for LATEX, creating if necesssary."
+    txt = _latexFromHtml(col, latex)
 
     # is there an existing file?
-    fname = "latex-%s.%s" % (checksum(txt.encode("utf8")), ext)
+    fname = _imgName(txt, model)
     link = '<img class=latex src="%s">' % fname
     if os.path.exists(fname):
         return link
@@ -11,13 +11,29 @@ import zipfile
 import pathlib
 import json
 import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
 
 from anki.utils import checksum, isWin, isMac
 from anki.db import DB, DBError
 from anki.consts import *
-from anki.latex import mungeQA
+from anki.latex import mungeQA, linkImages
 from anki.lang import _
 
+# threads checksumming new and changed files
+MEDIA_HASH_THREADS = 4
+# the files given to a thread at a time: up to this many, or this many bytes
+MEDIA_HASH_BATCH = 256
+MEDIA_HASH_BATCH_SIZE = 4*1024*1024
+
+def _nfc(name):
+    "NAME in NFC form, skipping the normalization of ASCII names."
+    try:
+        name.encode("ascii")
+        return name
+    except UnicodeEncodeError:
+        return unicodedata.normalize("NFC", name)
+
 class MediaManager:
 
     soundRegexps = [r"(?i)(\[sound:(?P<fname>[^]]+)\])"]
@@ -31,6 +47,9 @@ class MediaManager:
 
     def __init__(self, col, server):
         self.col = col
+        self._watcher = None
+        # true if startWatching() was called, so a reconnect watches again
+        self._watching = False
         if server:
             self._dir = None
             return
@@ -60,6 +79,10 @@ class MediaManager:
         if create:
             self._initDB()
         self.maybeUpgrade()
+        self._initStats()
+        if self._watching:
+            # changes while closed weren't seen, so the next call scans
+            self.startWatching()
 
     def _initDB(self):
         self.db.executescript("""
@@ -75,6 +98,18 @@ create index idx_media_dirty on media (dirty);
 create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
 """)
 
+    def _initStats(self):
+        # the size, mtime in nanoseconds and inode of each file when it was
+        # last checksummed; other clients don't know about it, so it's only
+        # trusted for files the media table has
+        self.db.execute("""
+create table if not exists media_stat (
+ fname text not null primary key,
+ size int not null,
+ mtime int not null,
+ ino int not null
+) without rowid""")
+
     def maybeUpgrade(self):
         oldpath = self.dir()+".db"
         if os.path.exists(oldpath):
@@ -105,6 +140,9 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     def close(self):
         if self.col.server:
             return
+        if self._watcher:
+            self._watcher.close()
+            self._watcher = None
         self.db.close()
         self.db = None
         # change cwd back to old location
@@ -124,19 +162,6 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     def dir(self):
         return self._dir
 
-    def _isFAT32(self):
-        if not isWin:
-            return
-        # pylint: disable=import-error
-        import win32api, win32file
-        try:
-            name = win32file.GetVolumeNameForVolumeMountPoint(self._dir[:3])
-        except:
-            # mapped & unmapped network drive; pray that it's not vfat
-            return
-        if win32api.GetVolumeInformation(name)[4].lower().startswith("fat"):
-            return True
-
     # Adding media
     ##########################################################################
     # opath must be in unicode
@@ -193,7 +218,9 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     # String manipulation
     ##########################################################################
 
-    def filesInStr(self, mid, string, includeRemote=False):
+    def filesInStr(self, mid, string, includeRemote=False, build=True):
+        """The media STRING refers to. Missing latex images are built unless
+        BUILD is false, in which case they're included anyway."""
         l = []
         model = self.col.models.get(mid)
         strings = []
@@ -205,7 +232,10 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
             strings = [string]
         for string in strings:
             # handle latex
-            string = mungeQA(string, None, None, model, None, self.col)
+            if build:
+                string = mungeQA(string, None, None, model, None, self.col)
+            else:
+                string = linkImages(string, model)
             # extract filenames
             for reg in self.regexps:
                 for match in re.finditer(reg, string):
@@ -262,78 +292,85 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     ##########################################################################
 
     def check(self, local=None):
-        "Return (missingFiles, unusedFiles)."
-        mdir = self.dir()
-        # gather all media references in NFC form
-        allRefs = set()
-        for nid, mid, flds in self.col.db.execute("select id, mid, flds from notes"):
-            noteRefs = self.filesInStr(mid, flds)
-            # check the refs are in NFC
-            for f in noteRefs:
-                # if they're not, we'll need to fix them first
-                if f != unicodedata.normalize("NFC", f):
-                    self._normalizeNoteRefs(nid)
-                    noteRefs = self.filesInStr(mid, flds)
-                    break
-            allRefs.update(noteRefs)
-        # loop through media folder
-        unused = []
-        if local is None:
-            files = os.listdir(mdir)
-        else:
-            files = local
-        renamedFiles = False
-        dirFound = False
+        """Return (missingFiles, unusedFiles, warnings). The references come
+        from the collection's index of them, and the files from the media
+        folder, or the names in LOCAL if given."""
+        refs = self._checkRefs()
         warnings = []
-        for file in files:
-            if not local:
-                if not os.path.isfile(file):
-                    # ignore directories
-                    dirFound = True
-                    continue
-            if file.startswith("_"):
-                # leading _ says to ignore file
-                continue
-
-            if self.hasIllegal(file):
-                name = file.encode(sys.getfilesystemencoding(), errors="replace")
-                name = str(name, sys.getfilesystemencoding())
-                warnings.append(
-                    _("Invalid file name, please rename: %s") % name)
-                continue
-
-            nfcFile = unicodedata.normalize("NFC", file)
-            # we enforce NFC fs encoding on non-macs
-            if not isMac and not local:
-                if file != nfcFile:
-                    # delete if we already have the NFC form, otherwise rename
-                    if os.path.exists(nfcFile):
-                        os.unlink(file)
-                        renamedFiles = True
-                    else:
-                        os.rename(file, nfcFile)
-                        renamedFiles = True
-                    file = nfcFile
-            # compare
-            if nfcFile not in allRefs:
-                unused.append(file)
-            else:
-                allRefs.discard(nfcFile)
-        # if we renamed any files to nfc format, we must rerun the check
-        # to make sure the renamed files are not marked as unused
-        if renamedFiles:
-            return self.check(local=local)
-        nohave = [x for x in allRefs if not x.startswith("_")]
         # make sure the media DB is valid
         try:
             self.findChanges()
         except DBError:
             self._deleteDB()
+            self.findChanges()
+        if local is None:
+            files = self._checkFiles(warnings)
+        else:
+            files = self._checkNames(local, warnings)
+        # latex images are made when a card is shown, so make any that
+        # aren't there yet
+        latex = set(x for x in refs - files if x.startswith("latex-"))
+        if latex and local is None:
+            self._buildLatex(latex)
+            self.findChanges()
+            files = self._checkFiles([])
+        # and don't report the ones latex couldn't make
+        nohave = [x for x in refs - files
+                  if not x.startswith("_") and x not in latex]
+        unused = [x for x in files - refs if not x.startswith("_")]
+        return (nohave, unused, warnings)
 
+    def _checkRefs(self):
+        "The files referred to, after making sure they're in NFC form."
+        refs = self.col.mediaRefs.names()
+        bad = [x for x in refs if x != unicodedata.normalize("NFC", x)]
+        if bad:
+            for nid in self.col.mediaRefs.notesWith(bad):
+                self._normalizeNoteRefs(nid)
+            refs = self.col.mediaRefs.names()
+        return refs
+
+    def _checkFiles(self, warnings):
+        """The NFC names of the files in the media folder, noting any
+        folders or invalid names in WARNINGS. This includes the files
+        findChanges() doesn't track, like those over 100MB."""
+        files = set()
+        dirFound = False
+        with os.scandir(self.dir()) as it:
+            for f in it:
+                if f.is_dir():
+                    # ignore directories
+                    dirFound = True
+                elif self.hasIllegal(f.name):
+                    self._illegalWarning(f.name, warnings)
+                else:
+                    files.add(unicodedata.normalize("NFC", f.name))
         if dirFound:
             warnings.append(
                 _("Anki does not support files in subfolders of the collection.media folder."))
-        return (nohave, unused, warnings)
+        return files
+
+    def _checkNames(self, names, warnings):
+        "The NFC forms of NAMES, less any invalid ones."
+        files = set()
+        for name in names:
+            if self.hasIllegal(name):
+                self._illegalWarning(name, warnings)
+                continue
+            files.add(unicodedata.normalize("NFC", name))
+        return files
+
+    def _illegalWarning(self, name, warnings):
+        name = name.encode(sys.getfilesystemencoding(), errors="replace")
+        name = str(name, sys.getfilesystemencoding())
+        warnings.append(_("Invalid file name, please rename: %s") % name)
+
+    def _buildLatex(self, fnames):
+        "Make the latex images FNAMES, from the notes that refer to them."
+        for nid in self.col.mediaRefs.notesWith(fnames):
+            mid, flds = self.col.db.first(
+                "select mid, flds from notes where id = ?", nid)
+            self.filesInStr(mid, flds)
 
     def _normalizeNoteRefs(self, nid):
         note = self.col.getNote(nid)
@@ -417,9 +454,23 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     ##########################################################################
 
     def findChanges(self):
-        "Scan the media folder if it's changed, and note any changes."
-        if self._changed():
+        "Note any changes to the media folder since the last call."
+        names = self._watcher.changes() if self._watcher else None
+        if names is None:
             self._logChanges()
+        elif names:
+            self._logChanges(names)
+
+    def startWatching(self):
+        """Have findChanges() only look at the files the OS reports as
+        changed, instead of scanning the folder. True if it can."""
+        from anki.mediawatch import MediaWatcher
+        watcher = MediaWatcher(self.dir())
+        if not watcher.start():
+            return False
+        self._watcher = watcher
+        self._watching = True
+        return True
 
     def haveDirty(self):
         return self.db.scalar("select 1 from media where dirty=1 limit 1")
@@ -431,86 +482,142 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         with open(path, "rb") as f:
             return checksum(f.read())
 
-    def _changed(self):
-        "Return dir mtime if it has changed since the last findChanges()"
-        # doesn't track edits, but user can add or remove a file to update
-        mod = self.db.scalar("select dirMod from meta")
-        mtime = self._mtime(self.dir())
-        if not self._isFAT32() and mod and mod == mtime:
-            return False
-        return mtime
-
-    def _logChanges(self):
-        (added, removed) = self._changes()
+    def _logChanges(self, names=None):
+        (added, removed, stats) = self._changes(names)
         media = []
-        for f, mtime in added:
-            media.append((f, self._checksum(f), mtime, 1))
+        for f, csum, mtime in added:
+            media.append((f, csum, mtime, 1))
         for f in removed:
             media.append((f, None, 0, 1))
         # update media db
         self.db.executemany("insert or replace into media values (?,?,?,?)",
                             media)
+        self.db.executemany("insert or replace into media_stat values (?,?,?,?)",
+                            stats)
+        self.db.executemany("delete from media_stat where fname = ?",
+                            [(f,) for f in removed])
+        # other clients use the folder's mtime to skip scanning
         self.db.execute("update meta set dirMod = ?", self._mtime(self.dir()))
         self.db.commit()
 
-    def _changes(self):
-        self.cache = {}
-        for (name, csum, mod) in self.db.execute(
-            "select fname, csum, mtime from media where csum is not null"):
-            # previous entries may not have been in NFC form
-            normname = unicodedata.normalize("NFC", name)
-            self.cache[normname] = [csum, mod, False]
+    def _changes(self, names=None):
+        """Return the files added or changed as (name, csum, mtime), the
+        names of those removed, and media_stat rows for the files
+        checksummed. Only NAMES are looked at if given, else the whole
+        folder. Files whose size, mtime and inode haven't changed since they
+        were last checksummed aren't read."""
+        known = self._knownFiles(names)
+        seen = set()
+        toHash = []
+        for name, st in self._scanFiles(names):
+            # ignore folders and thumbs.db
+            if stat.S_ISDIR(st.st_mode):
+                continue
+            if name.lower() == "thumbs.db":
+                continue
+            # and files with invalid chars
+            if self.hasIllegal(name):
+                continue
+            # empty files are invalid; clean them up and continue
+            sz = st.st_size
+            if not sz:
+                os.unlink(name)
+                continue
+            if sz > 100*1024*1024:
+                self.col.log("ignoring file over 100MB", name)
+                continue
+            # check encoding
+            normname = _nfc(name)
+            if not isMac:
+                if name != normname:
+                    # wrong filename encoding which will cause sync errors
+                    if os.path.exists(normname):
+                        os.unlink(name)
+                    else:
+                        os.rename(name, normname)
+            else:
+                # on Macs we can access the file using any normalization
+                pass
+            seen.add(normname)
+            # unchanged since it was last checksummed?
+            ent = known.get(normname)
+            if ent and ent[1:] == (sz, st.st_mtime_ns, st.st_ino):
+                continue
+            toHash.append((normname, st, ent and ent[0]))
+        csums = self._checksums([(h[0], h[1].st_size) for h in toHash])
         added = []
-        removed = []
-        # loop through on-disk files
-        with os.scandir(self.dir()) as it:
-            for f in it:
-                # ignore folders and thumbs.db
-                if f.is_dir():
-                    continue
-                if f.name.lower() == "thumbs.db":
-                    continue
-                # and files with invalid chars
-                if self.hasIllegal(f.name):
-                    continue
-                # empty files are invalid; clean them up and continue
-                sz = f.stat().st_size
-                if not sz:
-                    os.unlink(f.name)
-                    continue
-                if sz > 100*1024*1024:
-                    self.col.log("ignoring file over 100MB", f.name)
-                    continue
-                # check encoding
-                normname = unicodedata.normalize("NFC", f.name)
-                if not isMac:
-                    if f.name != normname:
-                        # wrong filename encoding which will cause sync errors
-                        if os.path.exists(normname):
-                            os.unlink(f.name)
-                        else:
-                            os.rename(f.name, normname)
-                else:
-                    # on Macs we can access the file using any normalization
-                    pass
+        stats = []
+        for (name, st, oldsum), csum in zip(toHash, csums):
+            # new, or has a different checksum?
+            if csum != oldsum:
+                added.append((name, csum, int(st.st_mtime)))
+            stats.append((name, st.st_size, st.st_mtime_ns, st.st_ino))
+        # look for any known files that no longer exist on disk
+        removed = [name for name in known if name not in seen]
+        return added, removed, stats
+
+    def _checksums(self, files):
+        "Checksums of the (name, size) FILES, read on several threads."
+        batches = [[]]
+        size = 0
+        for name, sz in files:
+            if (len(batches[-1]) >= MEDIA_HASH_BATCH or
+                    size >= MEDIA_HASH_BATCH_SIZE):
+                batches.append([])
+                size = 0
+            batches[-1].append(name)
+            size += sz
+        def checksums(names):
+            return [self._checksum(name) for name in names]
+        if len(batches) == 1:
+            return checksums(batches[0])
+        with ThreadPoolExecutor(MEDIA_HASH_THREADS) as ex:
+            return [csum for batch in ex.map(checksums, batches)
+                    for csum in batch]
+
+    def _knownFiles(self, names=None):
+        "Name -> (csum, size, mtime, inode) of the files in the media table."
+        sql = """
+select m.fname, m.csum, s.size, s.mtime, s.ino from media m
+left join media_stat s using (fname) where m.csum is not null"""
+        if names is None:
+            rows = self.db.execute(sql)
+        else:
+            rows = []
+            for name in set(names) | set(
+                    unicodedata.normalize("NFC", n) for n in names):
+                rows.extend(self.db.execute(sql + " and m.fname = ?", name))
+        known = {}
+        for name, csum, size, mtime, ino in rows:
+            # previous entries may not have been in NFC form
+            known[_nfc(name)] = (csum, size, mtime, ino)
+        return known
+
+    def _scanFiles(self, names=None):
+        "Yield (name, stat) of NAMES that exist, or of the whole folder."
+        if names is None:
+            with os.scandir(self.dir()) as it:
+                for f in it:
+                    yield f.name, f.stat()
+            return
+        for name in names:
+            try:
+                yield name, os.stat(name)
+            except OSError:
+                # removed, or removed again
+                pass
 
-                # newly added?
-                mtime = int(f.stat().st_mtime)
-                if normname not in self.cache:
-                    added.append((normname, mtime))
-                else:
-                    # modified since last time?
-                    if mtime != self.cache[normname][1]:
-                        # and has different checksum?
-                        if self._checksum(normname) != self.cache[normname][0]:
-                            added.append((normname, mtime))
-                    # mark as used
-                    self.cache[normname][2] = True
-        # look for any entries in the cache that no longer exist on disk
-        for (k, v) in list(self.cache.items()):
-            if not v[2]:
-                removed.append(k)
-        return added, removed
+    def _recordStats(self, names):
+        "Note the stat of NAMES, whose checksums were just recorded."
+        stats = []
+        for name in names:
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            stats.append((name, st.st_size, st.st_mtime_ns, st.st_ino))
+        self.db.executemany("insert or replace into media_stat values (?,?,?,?)",
+                            stats)
 
     # Syncing-related
     ##########################################################################
@@ -536,6 +643,7 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         if os.path.exists(fname):
             os.unlink(fname)
         self.db.execute("delete from media where fname=?", fname)
+        self.db.execute("delete from media_stat where fname=?", fname)
 
     def mediaCount(self):
         return self.db.scalar(
@@ -547,6 +655,7 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
 
     def forceResync(self):
         self.db.execute("delete from media")
+        self.db.execute("delete from media_stat")
         self.db.execute("update meta set lastUsn=0,dirMod=0")
         self.db.commit()
         self.db.setAutocommit(True)
@@ -559,7 +668,25 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
 
     def mediaChangesZip(self):
         f = io.BytesIO()
-        z = zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED)
+        fnames = self.writeChangesZip(self.dirtyRows(), f)
+        return f.getvalue(), fnames
+
+    def dirtyRows(self, exclude=()):
+        "(fname, csum) of up to SYNC_ZIP_COUNT changes not in EXCLUDE."
+        rows = []
+        for fname, csum in self.db.execute(
+                "select fname, csum from media where dirty=1"):
+            if fname not in exclude:
+                rows.append((fname, csum))
+                if len(rows) == SYNC_ZIP_COUNT:
+                    break
+        return rows
+
+    def writeChangesZip(self, rows, fileobj):
+        """Write a zip of the changes in ROWS from dirtyRows() to FILEOBJ,
+        stopping at SYNC_ZIP_SIZE. Returns the names it holds. Doesn't use
+        the DB, so can be called from another thread."""
+        z = zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED)
 
         fnames = []
         # meta is list of (fname, zipname), where zipname of None
@@ -567,9 +694,7 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         meta = []
         sz = 0
 
-        for c, (fname, csum) in enumerate(self.db.execute(
-                        "select fname, csum from media where dirty=1"
-                        " limit %d"%SYNC_ZIP_COUNT)):
+        for c, (fname, csum) in enumerate(rows):
 
             fnames.append(fname)
             normname = unicodedata.normalize("NFC", fname)
@@ -588,17 +713,24 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
 
         z.writestr("_meta", json.dumps(meta))
         z.close()
-        return f.getvalue(), fnames
+        return fnames
 
     def addFilesFromZip(self, zipData):
         "Extract zip data; true if finished."
+        media = self.extractZip(zipData)
+        self.addExtracted(media)
+        return len(media)
+
+    def extractZip(self, zipData):
+        """Save the files in zipData, returning their rows for
+        addExtracted(). Doesn't use the DB, so can be called from another
+        thread."""
         f = io.BytesIO(zipData)
         z = zipfile.ZipFile(f, "r")
         media = []
         # get meta info first
         meta = json.loads(z.read("_meta").decode("utf8"))
         # then loop through all files
-        cnt = 0
         for i in z.infolist():
             if i.filename == "_meta":
                 # ignore previously-retrieved meta
@@ -614,8 +746,9 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
                     f.write(data)
                 # update db
                 media.append((name, csum, self._mtime(name), 0))
-                cnt += 1
-        if media:
-            self.db.executemany(
-                "insert or replace into media values (?,?,?,?)", media)
-        return cnt
+        return media
+
+    def addExtracted(self, media):
+        self.db.executemany(
+            "insert or replace into media values (?,?,?,?)", media)
+        self._recordStats(m[0] for m in media)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+An index of the media files each note refers to, so Check Media can compare
+it with the media folder instead of searching every note's fields.
+
+The references are kept in the media_refs table. A note's are updated when
+it's saved, and importing and syncing update the notes they wrote in bulk.
+Any other change to the notes' fields, eg by find & replace or an add-on,
+is caught by temporary triggers, which queue the note in media_refs_dirty
+to be looked at before the index is next read.
+
+Like the registry, the index records the collection's mod time at each
+save. If it doesn't match when the collection is opened, the notes were
+changed by a client that doesn't know about it, and it's rebuilt the first
+time it's needed. The fields are searched over several processes when
+there are enough notes.
+"""
+
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from anki.utils import isLin
+
+# notes sent to a worker at a time
+REFS_CHUNK = 1000
+# fewer notes than this are searched in this process
+PARALLEL_MIN = 5000
+
+class MediaRefs:
+
+    def __init__(self, col):
+        self.col = col
+        # true when the index matches the notes and the triggers are in place
+        self._ready = False
+
+    def _exists(self):
+        return self.col.db.scalar(
+            "select 1 from sqlite_master where name = 'media_refs_meta'")
+
+    def load(self):
+        "Start keeping the index up to date, if it matches the notes."
+        self._ready = False
+        if self._exists() and self.col.db.scalar(
+                "select mod from media_refs_meta") == self.col.mod:
+            self._addTriggers()
+            self._ready = True
+
+    def stamp(self, mod):
+        "Called when the col row is flushed with MOD."
+        if self._ready:
+            self.col.db.execute("update media_refs_meta set mod = ?", mod)
+
+    # Reading
+    ##########################################################################
+
+    def names(self):
+        "The names of all the files referred to."
+        self.update()
+        return set(self.col.db.list("select distinct fname from media_refs"))
+
+    def notesWith(self, fnames):
+        "The ids of the notes referring to FNAMES."
+        self.update()
+        nids = set()
+        for fname in fnames:
+            nids.update(self.col.db.list(
+                "select nid from media_refs where fname = ?", fname))
+        return sorted(nids)
+
+    # Updating
+    ##########################################################################
+
+    def update(self, nids=None):
+        """Bring the index up to date, or if NIDS are given, just with those
+        notes, which were just written."""
+        if not self._ready:
+            # if it's never been read, there's nothing to keep up to date
+            if nids is None:
+                self._rebuild()
+            return
+        if nids is None:
+            nids = self.col.db.list("select nid from media_refs_dirty")
+        if nids:
+            with self.col.db.idSet(nids) as snids:
+                refs = self._find("where id in %s" % snids, len(nids))
+                self.col.db.execute(
+                    "delete from media_refs where nid in %s" % snids)
+                self.col.db.execute(
+                    "delete from media_refs_dirty where nid in %s" % snids)
+            self._insert(refs)
+
+    def noteFlushed(self, note, fields):
+        "Called when NOTE was written with the joined FIELDS."
+        if not self._ready:
+            return
+        refs = _filesIn(self.col.media, note.mid, fields)
+        self.col.db.execute("delete from media_refs where nid = ?", note.id)
+        self._insert((fname, note.id) for fname in refs)
+        self.col.db.execute(
+            "delete from media_refs_dirty where nid = ?", note.id)
+
+    def _rebuild(self):
+        db = self.col.db
+        db.execute("""
+create table if not exists media_refs (
+    fname text not null,
+    nid integer not null,
+    primary key (fname, nid)
+) without rowid""")
+        db.execute("""
+create index if not exists ix_media_refs_nid on media_refs (nid)""")
+        db.execute("""
+create table if not exists media_refs_dirty (nid integer primary key)""")
+        if not self._exists():
+            db.execute("create table media_refs_meta (mod integer)")
+            db.execute("insert into media_refs_meta values (null)")
+        db.execute("delete from media_refs")
+        db.execute("delete from media_refs_dirty")
+        self._insert(self._find("", self.col.noteCount()))
+        self._ready = True
+        self.stamp(self.col.mod)
+        self._addTriggers()
+
+    def _find(self, where, count):
+        """(fname, nid) of the references of the notes matching WHERE, of
+        which there are about COUNT."""
+        refs = []
+        rows = self.col.db.execute("select id, mid, flds from notes " + where)
+        for nid, files in _filesInNotes(self.col, rows, count):
+            refs.extend((fname, nid) for fname in files)
+        return refs
+
+    def _insert(self, refs):
+        self.col.db.executemany(
+            "insert or ignore into media_refs values (?,?)", refs)
+
+    def _addTriggers(self):
+        # temp triggers aren't seen by other connections, which is why the
+        # index is stamped
+        self.col.db.execute("""
+create temp trigger if not exists media_refs_ins after insert on main.notes
+begin
+    insert or ignore into media_refs_dirty values (new.id);
+end""")
+        self.col.db.execute("""
+create temp trigger if not exists media_refs_upd after update on main.notes
+when new.id != old.id or new.mid != old.mid or new.flds is not old.flds
+begin
+    insert or ignore into media_refs_dirty values (new.id);
+end""")
+        self.col.db.execute("""
+create temp trigger if not exists media_refs_del after delete on main.notes
+begin
+    delete from media_refs where nid = old.id;
+end""")
+
+# Finding references
+##########################################################################
+
+def _filesIn(media, mid, flds):
+    if not media.col.models.get(mid):
+        # note points to invalid model
+        return []
+    return media.filesInStr(mid, flds, build=False)
+
+def _filesInNotes(col, rows, count, workers=None):
+    """Yield (nid, files) for the COUNT (nid, mid, flds) ROWS, using several
+    processes if there are enough of them."""
+    workers = workers or os.cpu_count() or 1
+    # forking is only safe on linux, and spawning would rerun the gui
+    if not isLin or workers < 2 or count < PARALLEL_MIN:
+        for nid, mid, flds in rows:
+            yield nid, _filesIn(col.media, mid, flds)
+        return
+    ex = ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("fork"),
+        initializer=_initWorker, initargs=(col.models.models,))
+    pending = deque()
+    try:
+        rows = iter(rows)
+        while True:
+            # keep every worker busy, without reading all the notes in
+            while len(pending) < workers * 2:
+                part = list(islice(rows, REFS_CHUNK))
+                if not part:
+                    break
+                pending.append(ex.submit(_filesInChunk, part))
+            if not pending:
+                break
+            for res in pending.popleft().result():
+                yield res
+    finally:
+        # if the caller stopped early
+        for future in pending:
+            future.cancel()
+        ex.shutdown(wait=True)
+
+# Workers
+##########################################################################
+
+class _RefsCollection:
+    "Enough of a collection for MediaManager.filesInStr()."
+
+    def __init__(self, models):
+        from anki.models import ModelManager
+        from anki.media import MediaManager
+        self.models = ModelManager(self)
+        self.models.models = models
+        self.media = MediaManager(self, True)
+
+_col = None
+
+def _initWorker(models):
+    global _col
+    _col = _RefsCollection(models)
+
+def _filesInChunk(rows):
+    return [(nid, _filesIn(_col.media, mid, flds)) for nid, mid, flds in rows]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Watching the media folder for changes with inotify, so the media manager
+only needs to look at the files that changed rather than scanning the
+folder. Linux only; start() returns False elsewhere, or if the kernel
+doesn't allow another watch.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import struct
+
+from anki.utils import isLin
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+         IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# wd, mask, cookie, length of the name that follows
+_event = struct.Struct("iIII")
+
+class MediaWatcher:
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._names = set()
+        # true until the first call to changes(), and after events were lost
+        self._lost = True
+
+    def start(self):
+        "Start watching. False if inotify isn't available."
+        if not isLin:
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return False
+        if fd < 0:
+            return False
+        if libc.inotify_add_watch(fd, os.fsencode(self.path), _MASK) < 0:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def changes(self):
+        """The names of the files changed since the last call, or None if
+        they're not known, eg because the kernel's queue overflowed, and the
+        whole folder needs to be scanned."""
+        if self._fd is None:
+            return None
+        self._read()
+        names, lost = self._names, self._lost
+        self._names = set()
+        self._lost = False
+        if lost:
+            return None
+        return names
+
+    def _read(self):
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return
+            off = 0
+            while off < len(data):
+                wd, mask, cookie, size = _event.unpack_from(data, off)
+                off += _event.size
+                name = data[off:off+size].rstrip(b"\0")
+                off += size
+                if mask & IN_Q_OVERFLOW:
+                    self._lost = True
+                elif mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # the folder itself went away, so nothing more will be
+                    # reported
+                    self._lost = True
+                    self.close()
+                    return
+                elif name:
+                    self._names.add(os.fsdecode(name))
@@ -76,10 +76,13 @@ class ModelManager:
 
     def __init__(self, col):
         self.col = col
+        # ids of changed models, see anki.registry
+        self._dirty = set()
 
     def load(self, json_):
         "Load registry from JSON."
         self.changed = False
+        self._dirty = set()
         self.models = json.loads(json_)
 
     def save(self, m=None, templates=False):
@@ -90,15 +93,36 @@ class ModelManager:
             self._updateRequired(m)
             if templates:
                 self._syncTemplates(m)
-        self.changed = True
+            self._markDirty(m)
+        else:
+            self.changed = True
+            self.col._notes.clear()
+            self.col._cards.clear()
+            self.col._searches.clear()
         runHook("newModel")
 
+    def _markDirty(self, m):
+        # loaded notes have the old field map, cards the old rendering, and
+        # searches by field or card type may match different cards
+        self.col._notes.clear()
+        self.col._cards.clear()
+        self.col._searches.clear()
+        if self.models.get(str(m['id'])) is m:
+            self._dirty.add(str(m['id']))
+        else:
+            self.changed = True
+
     def flush(self):
         "Flush the registry if any models were changed."
         if self.changed:
             self.col.db.execute("update col set models = ?",
                                  json.dumps(self.models))
+            self.col.registry.clear(("model",))
             self.changed = False
+            self._dirty = set()
+        elif self._dirty:
+            self.col.registry.write(("model", id) for id in self._dirty)
+            self._dirty = set()
 
     # Retrieving and creating models
     #############################################################
@@ -177,7 +201,8 @@ select id from cards where nid in (select id from notes where mid = ?)""",
         self.ensureNameUnique(m)
         self.models[str(m['id'])] = m
         # mark registry changed, but don't bump mod time
-        self.save()
+        self._markDirty(m)
+        runHook("newModel")
 
     def _setID(self, m):
         while 1:
@@ -503,9 +528,9 @@ select id from notes where mid = ?)""" % " ".join(map),
             a.append("ankiflag")
             b.append("")
         data = [1, 1, m['id'], 1, t['ord'], "", joinFields(a), 0]
-        full = self.col._renderQA(data)['q']
+        full = self.col._renderQA(data, answer=False)['q']
         data = [1, 1, m['id'], 1, t['ord'], "", joinFields(b), 0]
-        empty = self.col._renderQA(data)['q']
+        empty = self.col._renderQA(data, answer=False)['q']
         # if full and empty are the same, the template is invalid and there is
         # no way to satisfy it
         if full == empty:
@@ -517,7 +542,7 @@ select id from notes where mid = ?)""" % " ".join(map),
             tmp[i] = ""
             data[6] = joinFields(tmp)
             # if no field content appeared, field is required
-            if "ankiflag" not in self.col._renderQA(data)['q']:
+            if "ankiflag" not in self.col._renderQA(data, answer=False)['q']:
                 req.append(i)
         if req:
             return type, req
@@ -529,7 +554,7 @@ select id from notes where mid = ?)""" % " ".join(map),
             tmp[i] = "1"
             data[6] = joinFields(tmp)
             # if not the same as empty, this field can make the card non-blank
-            if self.col._renderQA(data)['q'] != empty:
+            if self.col._renderQA(data, answer=False)['q'] != empty:
                 req.append(i)
         return type, req
 
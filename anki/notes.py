@@ -8,6 +8,10 @@ from anki.utils import fieldChecksum, intTime, \
 
 class Note:
 
+    # the collection keeps many notes around, see anki.identitymap
+    __slots__ = ("col", "id", "guid", "mid", "mod", "usn", "tags", "fields",
+                 "flags", "data", "scm", "newlyAdded", "_model", "_fmap")
+
     def __init__(self, col, model=None, id=None):
         assert not (model and id)
         self.col = col
@@ -75,9 +79,11 @@ from notes where id = ?""", self.id)
                 self.mod, self.usn, tags,
                 fields, sfld, csum, self.flags,
                 self.data, self.id)
+        self.col.mediaRefs.noteFlushed(self, fields)
 
         self.col.tags.register(self.tags)
         self._postFlush()
+        self.col._notes.flushed(self)
 
     def joinedFields(self):
         return joinFields(self.fields)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+The decks, deck options, models and tags are stored as JSON in the col row,
+and rewriting a whole column because one deck's counts changed is slow on
+large collections. So the managers track which objects they've changed, and
+only those are written, to the registry table, keyed by kind and id. When
+the collection is closed, or a manager changes too much to keep track of
+(eg when syncing), the registry is folded back into the col row, which is
+all that other clients and the sync protocol ever see.
+
+The table is only used when registry_meta matches the col row's mod time,
+so if another client saves the collection without knowing about it, the
+leftover changes are dropped instead of overwriting newer ones.
+"""
+
+import json
+
+# kind -> (manager, attribute holding the objects)
+_kinds = {
+    "deck": ("decks", "decks"),
+    "dconf": ("decks", "dconf"),
+    "model": ("models", "models"),
+    "tag": ("tags", "tags"),
+}
+
+class Registry:
+
+    def __init__(self, col):
+        self.col = col
+
+    def _exists(self):
+        return self.col.db.scalar(
+            "select 1 from sqlite_master where name = 'registry_meta'")
+
+    def _objects(self, kind):
+        manager, attr = _kinds[kind]
+        return getattr(getattr(self.col, manager), attr)
+
+    # Loading
+    ##########################################################################
+
+    def load(self):
+        "Apply any changes not yet folded into the col row."
+        if not self._exists():
+            return
+        if self.col.db.scalar("select mod from registry_meta") != self.col.mod:
+            # the col row was saved by someone else
+            self.col.db.execute("delete from registry")
+            return
+        for kind, key, data in self.col.db.execute(
+                "select kind, key, data from registry"):
+            objects = self._objects(kind)
+            if data is None:
+                objects.pop(key, None)
+            else:
+                objects[key] = json.loads(data)
+        self.col.decks._tree = None
+
+    # Saving
+    ##########################################################################
+
+    def write(self, keys):
+        "Write the objects with (kind, key) KEYS, or their removal."
+        self.col.db.execute("""
+create table if not exists registry (
+    kind text not null,
+    key text not null,
+    data text,
+    primary key (kind, key)
+) without rowid""")
+        if not self._exists():
+            self.col.db.execute("create table registry_meta (mod integer)")
+            self.col.db.execute("insert into registry_meta values (?)",
+                                self.col.mod)
+        rows = []
+        for kind, key in keys:
+            obj = self._objects(kind).get(key)
+            rows.append((kind, key, None if obj is None else json.dumps(obj)))
+        self.col.db.executemany(
+            "insert or replace into registry values (?,?,?)", rows)
+
+    def clear(self, kinds):
+        "Called when the objects of KINDS have been written to the col row."
+        if self._exists():
+            self.col.db.execute(
+                "delete from registry where kind in (%s)" % ",".join(
+                    "'%s'" % k for k in kinds))
+
+    def stamp(self, mod):
+        "Called when the col row is flushed with MOD."
+        if self._exists():
+            self.col.db.execute("update registry_meta set mod = ?", mod)
+
+    def compact(self):
+        """Have the next save write any changes to the col row instead, and
+        drop the table."""
+        exists = self._exists()
+        if exists:
+            self.col.db.execute("drop table registry")
+            self.col.db.execute("drop table registry_meta")
+        for manager in "decks", "models", "tags":
+            manager = getattr(self.col, manager)
+            if exists or manager._dirty:
+                manager.changed = True
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Rendering the question and answer of many cards at once, spread over
+several processes.
+
+The rows from Collection._qaData() are sent to the workers in chunks, and
+each worker renders them with Collection._renderQA() on a stand-in
+collection, which has a copy of the models and deck names but no database.
+The filters rendering runs (mungeFields, mungeQA and the fmod_ field
+modifiers) are pickled and installed in the workers too. If one of them
+can't be pickled, eg an add-on's lambda, all the cards are rendered in this
+process instead. So is any single card the worker fails on, eg because
+its LaTeX needs an image built.
+"""
+
+import os
+import pickle
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import anki.hooks
+from anki.lang import _
+from anki.utils import isLin
+
+# cards sent to a worker at a time
+RENDER_CHUNK = 500
+# fewer cards than this are rendered in this process
+PARALLEL_MIN = 5000
+
+def renderQA(col, rows, count, workers=None, chunk=None):
+    """Yield col._renderQA(row) for each of the COUNT ROWS, in order,
+    using WORKERS processes if there are enough of them."""
+    workers = workers or os.cpu_count() or 1
+    chunk = chunk or RENDER_CHUNK
+    hooks = None
+    # forking is only safe on linux, and spawning would rerun the gui
+    if isLin and workers > 1 and count >= PARALLEL_MIN:
+        hooks = _pickledFilters()
+    if hooks is None:
+        for row in rows:
+            yield col._renderQA(row)
+        return
+    decks = dict((id, g['name']) for id, g in col.decks.decks.items())
+    ex = ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("fork"),
+        initializer=_initWorker, initargs=(col.models.models, decks, hooks))
+    pending = deque()
+    try:
+        rows = iter(rows)
+        while True:
+            # keep every worker busy, without reading all the rows in
+            while len(pending) < workers * 2:
+                part = list(islice(rows, chunk))
+                if not part:
+                    break
+                pending.append((part, ex.submit(_renderChunk, part)))
+            if not pending:
+                break
+            part, future = pending.popleft()
+            for row, qa in zip(part, future.result()):
+                yield qa if qa is not None else col._renderQA(row)
+    finally:
+        # if the caller stopped early
+        for part, future in pending:
+            future.cancel()
+        ex.shutdown(wait=True)
+
+def _filterNames():
+    return [name for name in anki.hooks._hooks
+            if name in ("mungeFields", "mungeQA") or name.startswith("fmod_")]
+
+def _pickledFilters():
+    "The filters used when rendering, pickled, or None if they can't be."
+    try:
+        return pickle.dumps(dict(
+            (name, anki.hooks._hooks[name]) for name in _filterNames()))
+    except Exception:
+        return None
+
+# Workers
+##########################################################################
+
+class _Decks:
+
+    def __init__(self, names):
+        self.names = names
+
+    def name(self, did, default=False):
+        return self.names.get(str(did)) or _("[no deck]")
+
+class _RenderCollection:
+    "Enough of a collection for _renderQA() and the built-in filters."
+
+    def __init__(self, models, decks):
+        from anki.models import ModelManager
+        self.models = ModelManager(self)
+        self.models.models = models
+        self.decks = _Decks(decks)
+
+_col = None
+_filters = None
+
+def _initWorker(models, decks, hooks):
+    global _col, _filters
+    from anki.collection import _Collection
+    import anki.latex
+    _RenderCollection._renderQA = _Collection._renderQA
+    _RenderCollection._flagNameFromCardFlags = _Collection._flagNameFromCardFlags
+    # images are built by the main process, one at a time
+    anki.latex._buildImg = _buildImg
+    _filters = hooks
+    _installFilters()
+    _col = _RenderCollection(models, decks)
+
+def _installFilters():
+    filters = pickle.loads(_filters)
+    for name in _filterNames():
+        if name not in filters:
+            del anki.hooks._hooks[name]
+    anki.hooks._hooks.update(filters)
+
+def _buildImg(col, latex, fname, model):
+    raise Exception("latex image needed")
+
+def _renderChunk(rows):
+    "Render ROWS, with None for any that need the main process."
+    res = []
+    for row in rows:
+        try:
+            res.append(_col._renderQA(row))
+        except Exception:
+            res.append(None)
+            # runFilter() drops a filter that raises
+            _installFilters()
+    return res
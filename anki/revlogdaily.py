@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+The revlog_daily table holds the review log summed per day, deck, type,
+ease, maturity and whether the review was on time, so the statistics can
+read a few hundred rows instead of every review.
+
+It is derived data. The schedulers, sync and the importer add their reviews
+to it as they log them; anything else that changes the revlog (another
+client, undo of an old review) is detected by comparing a fingerprint of the
+revlog. Days are numbered in the collection's day cutoff, so changing the
+rollover hour makes it stale too.
+
+The deck is the card's when the review was added, and isn't updated as
+cards are moved or removed, so only the whole collection statistics use
+the table.
+
+A stale table is rebuilt when the collection is being changed anyway: on
+the day rolling over, at the end of a sync and by Check Database. The
+statistics only read it, and fall back to the revlog until then.
+"""
+
+# ms in a day
+DAY = 86400000
+
+class RevlogDaily:
+
+    def __init__(self, col):
+        self.col = col
+        # day cutoff offset in ms, or None if the table hasn't been built
+        self._offset = False
+
+    # Reading
+    ##########################################################################
+
+    def today(self, build=True):
+        """Build or rebuild the table if needed, and return the number of
+        the current day. Rows with day > today - n are in the last n days.
+        If BUILD is false, return None instead of building it."""
+        cut = int(self.col.sched.dayCutoff)
+        offset = cut % 86400 * 1000
+        meta = self.col.db.first(
+            "select offset, revlogs, maxid from revlog_daily_meta") \
+            if self._isBuilt() else None
+        if not meta or meta[0] != offset or tuple(meta[1:]) != self._fingerprint():
+            if not build:
+                return None
+            self._rebuild(offset)
+        return cut // 86400
+
+    # Updating
+    ##########################################################################
+
+    def add(self, rid):
+        "Add review RID, which has just been logged."
+        self.addIds([rid])
+
+    def addIds(self, ids):
+        "Add the newly inserted reviews IDS."
+        if not ids or not self._isBuilt():
+            return
+        with self.col.db.idSet(ids) as sids:
+            self.col.db.execute(
+                self._summarySql(self._offset, "where r.id in %s" % sids) + """
+on conflict (day, did, type, ease, mature, ontime) do update set
+cnt = cnt + excluded.cnt, time = time + excluded.time""")
+        self.col.db.execute(
+            "update revlog_daily_meta set revlogs = revlogs + ?, "
+            "maxid = max(coalesce(maxid, 0), ?)", len(ids), max(ids))
+
+    def merge(self, rows):
+        "Insert revlog ROWS that aren't already present, and add them."
+        rows = list(rows)
+        if not rows:
+            return
+        with self.col.db.idSet(r[0] for r in rows) as sids:
+            have = set(self.col.db.list(
+                "select id from revlog where id in " + sids))
+        self.col.db.executemany(
+            "insert or ignore into revlog values (?,?,?,?,?,?,?,?,?,?,?)", rows)
+        self.addIds(list(set(r[0] for r in rows) - have))
+        # the ids came from elsewhere, so may be ahead of ours
+        self.col._revlogId = None
+
+    def remove(self, rid):
+        "Remove review RID, which is about to be deleted from the revlog."
+        if not self._isBuilt():
+            return
+        row = self.col.db.first("""
+select %s, coalesce(c.did, 0), r.type, r.ease, r.lastIvl >= 21, r.due = r.day, r.time
+from revlog r left join cards c on c.id = r.cid where r.id = ?""" % (
+                self._daySql(self._offset)), rid)
+        if not row:
+            return
+        self.col.db.execute("""
+update revlog_daily set cnt = cnt - 1, time = time - ? where
+day = ? and did = ? and type = ? and ease = ? and mature = ? and ontime = ?""",
+            row[-1], *row[:-1])
+        self.col.db.execute(
+            "delete from revlog_daily where day = ? and cnt = 0", row[0])
+        self.col.db.execute(
+            "update revlog_daily_meta set revlogs = revlogs - 1, "
+            "maxid = (select max(id) from revlog where id != ?)", rid)
+
+    def invalidate(self):
+        "Force a rebuild the next time the table is read."
+        if self._isBuilt():
+            self.col.db.execute("delete from revlog_daily_meta")
+
+    # Building
+    ##########################################################################
+
+    def _isBuilt(self):
+        if self._offset is False:
+            if self.col.db.scalar(
+                    "select 1 from sqlite_master where name = 'revlog_daily_meta'"):
+                self._offset = self.col.db.scalar(
+                    "select offset from revlog_daily_meta")
+            else:
+                self._offset = None
+        return self._offset is not None
+
+    def _fingerprint(self):
+        return tuple(self.col.db.first(
+            "select count(), max(id) from revlog"))
+
+    def _daySql(self, offset):
+        # the day a review falls in, ie the next cutoff after it
+        return "(r.id - %d + %d) / %d" % (offset, DAY - 1, DAY)
+
+    def _summarySql(self, offset, where):
+        return """
+insert into revlog_daily
+select %s, coalesce(c.did, 0), r.type, r.ease, r.lastIvl >= 21, r.due = r.day,
+count(), sum(r.time)
+from revlog r left join cards c on c.id = r.cid %s
+group by 1, 2, 3, 4, 5, 6""" % (self._daySql(offset), where)
+
+    def _rebuild(self, offset):
+        self.col.db.execute("""
+create table if not exists revlog_daily (
+    day integer not null,
+    did integer not null,
+    type integer not null,
+    ease integer not null,
+    mature integer not null,
+    ontime integer not null,
+    cnt integer not null,
+    time integer not null,
+    primary key (day, did, type, ease, mature, ontime)
+) without rowid""")
+        # older versions also fingerprinted the cards table
+        self.col.db.execute("drop table if exists revlog_daily_meta")
+        self.col.db.execute("""
+create table revlog_daily_meta (
+    offset integer not null,
+    revlogs integer not null,
+    maxid integer
+)""")
+        self.col.db.execute("delete from revlog_daily")
+        self.col.db.execute(self._summarySql(offset, "where true"))
+        self.col.db.execute(
+            "insert into revlog_daily_meta values (?,?,?)",
+            offset, *self._fingerprint())
+        self._offset = offset
@@ -660,17 +660,8 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _logLrn(self, card, ease, conf, leaving, type, lastLeft):
         lastIvl = -(self._delayForGrade(conf, lastLeft))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.left))
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                ivl, lastIvl, card.factor, card.timeTaken(), type, 0, self.today)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self.col.logReview(card.id, ease, ivl, lastIvl, card.factor,
+                           card.timeTaken(), type, 0, self.today)
 
     def removeLrn(self, ids=None):
         "Remove cards from the learning queues."
@@ -855,18 +846,8 @@ select id from cards where did in %s and queue = 2 and due <= ? limit ?)"""
             card.odue = 0
 
     def _logRev(self, card, ease, delay, due):
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                -delay or card.ivl, card.lastIvl, card.factor, card.timeTaken(),
-                1, due, self.today)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self.col.logReview(card.id, ease, -delay or card.ivl, card.lastIvl,
+                           card.factor, card.timeTaken(), 1, due, self.today)
 
     # Interval management
     ##########################################################################
@@ -1143,6 +1124,10 @@ did = ?, queue = %s, due = ?, usn = ? where id = ?""" % queue, data)
         unburied = self.col.conf.get("lastUnburied", 0)
         if unburied < self.today:
             self.unburyCards()
+        # the review summaries are rebuilt here if stale, not when the stats
+        # are looked at
+        if oldToday is not None and oldToday != self.today:
+            self.col.revlogDaily.today()
 
     def _checkDay(self):
         # check if the day has rolled over
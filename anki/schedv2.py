@@ -705,17 +705,8 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _logLrn(self, card, ease, conf, leaving, type, lastLeft):
         lastIvl = -(self._delayForGrade(conf, lastLeft))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.left))
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                ivl, lastIvl, card.factor, card.timeTaken(), type, 0, self.today)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self.col.logReview(card.id, ease, ivl, lastIvl, card.factor,
+                           card.timeTaken(), type, 0, self.today)
 
     def _lrnForDeck(self, did):
         cnt = self.col.db.scalar(
@@ -882,18 +873,8 @@ select id from cards where did in %s and queue = 2 and due <= ? limit ?)"""
         self._removeFromFiltered(card)
 
     def _logRev(self, card, ease, delay, type, due):
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                -delay or card.ivl, card.lastIvl, card.factor, card.timeTaken(),
-                type, 0, self.today)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self.col.logReview(card.id, ease, -delay or card.ivl, card.lastIvl,
+                           card.factor, card.timeTaken(), type, 0, self.today)
 
     # Interval management
     ##########################################################################
@@ -1221,6 +1202,10 @@ where id = ?
         if unburied < self.today:
             self.unburyCards()
             self.col.conf['lastUnburied'] = self.today
+        # the review summaries are rebuilt here if stale, not when the stats
+        # are looked at
+        if oldToday is not None and oldToday != self.today:
+            self.col.revlogDaily.today()
 
     def _checkDay(self):
         # check if the day has rolled over
@@ -1626,6 +1611,7 @@ where queue < 0""" % (intTime(), self.col.usn()))
     # up or down
     def _remapLearningAnswers(self, sql):
         self.col.db.execute("update revlog set %s and type in (0,2)" % sql)
+        self.col.revlogDaily.invalidate()
 
     def moveToV1(self):
         self._emptyAllFiltered()
@@ -7,8 +7,10 @@ import itertools
 from operator import itemgetter
 from heapq import *
 import datetime
+import json
 
 from anki.schedulers import register_scheduler
+from anki.fairqueue import FairQueue
 from anki.utils import ids2str, intTime, fmtTimeSpan
 from anki.lang import _
 from anki.consts import *
@@ -97,6 +99,8 @@ class Scheduler:
         card.mod = intTime()
         card.usn = self.col.usn()
         card.flushSched()
+        if self.col.journal:
+            self.col.journal.answered(card)
 
     def _answerCard(self, card, ease):
         if self._previewingCard(card):
@@ -232,61 +236,65 @@ order by due""" % self._deckLimit(),
     # Deck list
     ##########################################################################
 
-    def deckDueList(self):
+    def deckDueList(self, newLimits=None):
         "Returns [deckname, did, rev, lrn, new]"
         self._checkDay()
         self.col.decks.checkIntegrity()
         decks = self.col.decks.all()
         decks.sort(key=itemgetter('name'))
-        lims = {}
+        counts = self._dueCountsForDecks()
+        parents = self.col.decks._hierarchy().parents
+        confs = {}
+        # reviews are reported for the whole subtree, so total them bottom
+        # up; children sort after their parents
+        subtree_rev = {deck['id']: counts.get((deck['id'], 2), 0) for deck in decks}
+        for deck in reversed(decks):
+            pids = parents[deck['id']]
+            if pids:
+                subtree_rev[pids[-1]] += subtree_rev[deck['id']]
         data = []
-        childMap = self.col.decks.childMap()
-        new_for_decks = self._newForDecks()
-        learn_for_decks = self._lrnForDecks()
-        rev_for_decks = self._revForDecks()
         for deck in decks:
-            nlim, new = self._get_number_of_new_cards(new_for_decks, deck)
-            # learning
-            lrn = self._get_number_of_learning_cards(learn_for_decks, deck)
-            # reviews
-            rlim, rev = self._get_number_of_revision_cards(rev_for_decks, deck, childMap)
-            # save to list
-            data.append([deck['name'], deck['id'], rev, lrn, new])
-            # add deck as a parent
-            lims[deck['name']] = [nlim, rlim]
+            did = deck['id']
+            if deck['dyn']:
+                conf = None
+                nlim = self.dynReportLimit
+                rlim = self.reportLimit
+            else:
+                if deck['conf'] not in confs:
+                    confs[deck['conf']] = self.col.decks.getConf(deck['conf'])
+                conf = confs[deck['conf']]
+                nlim = max(0, conf['new']['perDay'] - deck['newToday'][1])
+                rlim = max(0, conf['rev']['perDay'] - deck['revToday'][1])
+            if newLimits is not None:
+                newLimits[did] = None if deck['dyn'] else nlim
+            new = min(nlim, self.reportLimit, counts.get((did, 0), 0))
+            lrn = min(self.reportLimit,
+                      counts.get((did, 1), 0) + counts.get((did, 3), 0))
+            rev = min(rlim, self.reportLimit, subtree_rev[did])
+            data.append([deck['name'], did, rev, lrn, new])
         return data
 
-    def _get_number_of_new_cards(self, new_for_decks, deck):
-        new_cards_limit = self._deckNewLimitSingle(deck)
-        if not new_cards_limit:
-            return 0, 0
-        new_cards_limit = min(self.reportLimit, new_cards_limit)
-        return new_cards_limit, min(new_cards_limit, new_for_decks.get(deck['id'], 0))
-
-    def _get_number_of_learning_cards(self, learning_for_decks, deck):
-        learning = learning_for_decks[0].get(deck['id'], 0) + learning_for_decks[1].get(deck['id'], 0)
-        return min(learning, self.reportLimit)
-
-    def _get_number_of_revision_cards(self, revision_for_decks, deck, childMap):
-        revision_card_limit = min(self._deckRevLimitSingle(deck, parentLimit=None), self.reportLimit)
-        revision_cards = 0
-        for child_did in [deck['id']] + self.col.decks.childDids(deck['id'], childMap):
-            revision_cards += revision_for_decks.get(child_did, 0)
-        return revision_card_limit, min(revision_cards, revision_card_limit)
+    def _dueCountsForDecks(self):
+        "{(did, queue): count} of cards due now, for every deck."
+        return {(did, queue): count for did, queue, count in self.col.db.execute("""
+        select did, queue, count() from cards where
+        queue = 0 or (queue = 1 and due < ?) or (queue in (2, 3) and due <= ?)
+        group by did, queue""", intTime() + self.col.conf['collapseTime'], self.today)}
 
     def deckDueTree(self):
-        return self._groupChildren(self.deckDueList())
+        newLimits = {}
+        return self._groupChildren(self.deckDueList(newLimits), newLimits)
 
-    def _groupChildren(self, grps):
+    def _groupChildren(self, grps, newLimits=None):
         # first, split the group names into components
         for g in grps:
             g[0] = g[0].split("::")
         # and sort based on those components
         grps.sort(key=itemgetter(0))
         # then run main function
-        return self._groupChildrenMain(grps)
+        return self._groupChildrenMain(grps, newLimits or {})
 
-    def _groupChildrenMain(self, grps):
+    def _groupChildrenMain(self, grps, newLimits):
         tree = []
         # group and recurse
         def key(grp):
@@ -309,16 +317,20 @@ order by due""" % self._deckLimit(),
                     # set new string to tail
                     c[0] = c[0][1:]
                     children.append(c)
-            children = self._groupChildrenMain(children)
+            children = self._groupChildrenMain(children, newLimits)
             # tally up children counts
             for ch in children:
                 lrn += ch[3]
                 new += ch[4]
             # limit the counts to the deck's limits
-            conf = self.col.decks.confForDid(did)
-            deck = self.col.decks.get(did)
-            if not conf['dyn']:
-                new = max(0, min(new, conf['new']['perDay']-deck['newToday'][1]))
+            if did in newLimits:
+                nlim = newLimits[did]
+            else:
+                conf = self.col.decks.confForDid(did)
+                deck = self.col.decks.get(did)
+                nlim = None if conf['dyn'] else conf['new']['perDay']-deck['newToday'][1]
+            if nlim is not None:
+                new = max(0, min(new, nlim))
             tree.append((head, did, rev, lrn, new, children))
         return tuple(tree)
 
@@ -431,10 +443,6 @@ did = ? and queue = 0 limit ?)""", did, lim)
                 lim = min(rem, lim)
         return lim
 
-    def _newForDecks(self):
-        return {did: count for did, count in self.col.db.execute("""
-        select count(), did from cards group by did""")}
-
     def _deckNewLimitSingle(self, g):
         "Limit for deck without parent limits."
         if g['dyn']:
@@ -735,26 +743,8 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _logLrn(self, card, ease, conf, leaving, type, lastLeft):
         lastIvl = -(self._delayForGrade(conf, lastLeft))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.left))
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                ivl, lastIvl, card.factor, card.timeTaken(), type, 0, self.today)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
-
-    def _lrnForDecks(self):
-        cnts = {did: count for did, count in self.col.db.execute("""
-        select did, count() from cards where queue = 1 and due < ? group by did
-        """, intTime() + self.col.conf['collapseTime'])}
-        rest = {did: count for did, count in self.col.db.execute("""
-        select did, count() from cards where queue = 3 and due <= ? group by did""",
-            self.today)}
-        return cnts, rest
+        self.col.logReview(card.id, ease, ivl, lastIvl, card.factor,
+                           card.timeTaken(), type, 0, self.today)
 
     # Reviews
     ##########################################################################
@@ -769,10 +759,6 @@ did = ? and queue = 3 and due <= ? limit ?""",
         c = self.col.decks.confForDid(deck['id'])
         return max(0, c['rev']['perDay'] - deck['revToday'][1])
 
-    def _revForDecks(self):
-        return {did: count for did, count in self.col.db.execute("""
-        select did, count() from cards where queue = 2 and due <= ? group by did""", self.today)}
-
     def _resetRevCount(self):
         lim = self._currentRevLimit()
         self.revCount = self.col.db.scalar("""
@@ -783,6 +769,8 @@ did in %s and queue = 2 and due <= ? limit %d)""" % (
     def _resetRev(self):
         self._resetRevCount()
         self._revQueue = []
+        # kept between refills, so the decks stay evenly spread across them
+        self._revFairQueue = FairQueue()
         self._decks_penetrated = False
 
     def _set_rev_queue(self):
@@ -815,121 +803,83 @@ did in %s and queue = 2 and due <= ? limit %d)""" % (
             return self._set_rev_queue()
 
     def _get_rev_queue_per_subdeck(self, sort_by, penetration):
-        if penetration > 1024 * 1024:
+        decks_limits = {}
+        for did in self.col.decks.active():
+            lim = self._deckRevLimit(self.col.decks.get(did, default=False))
+            if lim:
+                decks_limits[int(did)] = lim
+        if not decks_limits:
             return []
 
-        deck_list = ids2str(self.col.decks.active())
-        rev_queue = []
-
+        # priority classes: 0=due today, 1=almost forgotten, 2=rest
+        classes = []
         if PRIORITIZE_TODAY:
-            dueToToday = self.col.db.all("""
-        select id, did from cards where
-        did in %s and queue = 2 and round(due) = ?
-        %s limit ?""" % (deck_list, sort_by),
-                                         self.today, penetration)
-            rev_queue.extend(dueToToday)
-            penetration -= len(dueToToday)
-
+            classes.append("when round(due) = :today then 0")
         if PRIORITIZE_ALMOST_FORGOTTEN:
-            if not rev_queue:
-                excluded_ids = ids2str([-1])
-            else:
-                excluded_ids = ids2str([el[0] for el in rev_queue])
-
-            dueToAlmostForgotten = self.col.db.all("""
-        select id, did from cards where
-        did in %s and id not in %s and queue = 2 and due > ? - ivl and due <= ?
-        order by (? - due) / ivl limit ?""" % (deck_list, excluded_ids),
-                                                   self.today, self.today, self.today,
-                                                   penetration)
-            rev_queue.extend(dueToAlmostForgotten)
-            penetration -= len(dueToAlmostForgotten)
-
-        if not rev_queue:
-            excluded_ids = ids2str([-1])
-        else:
-            excluded_ids = ids2str([el[0] for el in rev_queue])
-        dueToRest = self.col.db.all("""
-        select id, did from cards where
-        did in %s and id not in %s and queue = 2 and due <= ?
-        %s limit ?""" % (deck_list, excluded_ids, sort_by),
-                                    self.today, penetration)
-        rev_queue.extend(dueToRest)
-
+            classes.append("when due > :today - ivl then 1")
+        pclass = "case %s else 2 end" % " ".join(classes) if classes else "2"
+        order = "pclass, case pclass when 1 then (:today - due) / ivl end, %s" % (
+            sort_by[len("order by "):])
+
+        # the window enforces each deck's own limit in sql, so the cursor
+        # only yields cards which may still be blocked by a parent deck
+        cur = self.col.db.execute("""
+        with lims(did, lim) as (
+            select cast(key as integer), value from json_each(:lims))
+        select id, did from (
+            select *, row_number() over (partition by did order by %s) rn
+            from (select c.*, %s pclass, lims.lim from cards c
+                  join lims on c.did = lims.did
+                  where c.queue = 2 and c.due <= :today))
+        where rn <= lim
+        order by %s""" % (order, pclass, order),
+                                  today=self.today, lims=json.dumps(decks_limits))
+
+        decks_used_limits = {}
+        decks_parents = {}
+        parents = {}
         limited_rev_queue = []
-        decks = {deck['id']: deck for deck in self.col.decks.all()}
-        decks_used_limits = {did: 0 for did in decks.keys()}
-        decks_limits = {did: self._deckRevLimit(d) for did, d in decks.items()}
-        for item in rev_queue:
+        for item in cur:
             did = item[1]
-            if decks_limits[did] <= decks_used_limits[did]:
-                continue
-
-            over_limit = False
-            for parent in self.col.decks.parents(did):
-                if decks_limits[parent['id']] <= decks_used_limits[parent['id']]:
-                    over_limit = True
-                    break
-            if over_limit:
+            if did not in parents:
+                decks_parents[did] = self.col.decks.parents(did)
+                parents[did] = [p['id'] for p in decks_parents[did]]
+                for pid in parents[did]:
+                    if pid not in decks_limits:
+                        decks_limits[pid] = self._deckRevLimit(self.col.decks.get(pid))
+            if any(decks_limits[pid] <= decks_used_limits.get(pid, 0)
+                   for pid in parents[did]):
                 continue
 
-            limited_rev_queue.append(item)
-            decks_used_limits[did] += 1
-            for parent in self.col.decks.parents(did):
-                decks_used_limits[parent['id']] += 1
-
-        if not limited_rev_queue and rev_queue:
-            return self._get_rev_queue_per_subdeck(sort_by, penetration * 2)[:penetration]
+            limited_rev_queue.append(tuple(item))
+            for pid in parents[did]:
+                decks_used_limits[pid] = decks_used_limits.get(pid, 0) + 1
+            if len(limited_rev_queue) >= penetration:
+                break
+        cur.close()
 
-        return self._scatter_fairly_cards_from_different_decks(limited_rev_queue)
+        return self._scatter_fairly_cards_from_different_decks(
+            limited_rev_queue, decks_parents)
 
     @staticmethod
-    def scatter_fairly_cards_from_different_decks(limited_rev_queue, all_decks, decks_parents):
-        decks_cards = {deck['id']: [] for deck in all_decks}
-        for pos, (card_id, deck_id) in enumerate(limited_rev_queue):
-            decks_cards[deck_id].append((pos, card_id))
-            for parent in decks_parents[deck_id]:
-                decks_cards[parent['id']].append((pos, card_id))
-
-        used_cards = set()
-        deck_cards_already_used = {deck['id']: 0 for deck in all_decks}
-        fair_rev_queue = []
-        for i in range(len(limited_rev_queue)):
-            curr_max_points = 0
-            curr_card_id = None
-
-            for deck_id in decks_cards.keys():
-                while decks_cards[deck_id] and decks_cards[deck_id][0][1] in used_cards:
-                    deck_cards_already_used[deck_id] += 1
-                    decks_cards[deck_id].pop(0)
-
-                if not decks_cards[deck_id]:
-                    continue
-
-                pos_difference = abs(i - decks_cards[deck_id][0][0])
-                points_position_changed = 1 - ((pos_difference ** 2) / (pos_difference ** 2 + len(limited_rev_queue)))
-
-                distribution_whole = (deck_cards_already_used[deck_id] + len(decks_cards[deck_id])) / len(
-                    limited_rev_queue)
-                distribution_current = 0 if i == 0 else deck_cards_already_used[deck_id] / i
-
-                if distribution_current < distribution_whole:
-                    distribution_points = 1 - (distribution_current / (distribution_whole * 2))
-                else:
-                    distribution_points = distribution_whole / (distribution_current * 2)
-
-                total_points = points_position_changed * distribution_points
-                if total_points > curr_max_points:
-                    curr_max_points = total_points
-                    curr_card_id = decks_cards[deck_id][0][1]
-
-            fair_rev_queue.append(curr_card_id)
-            used_cards.add(curr_card_id)
-        return fair_rev_queue
-
-    def _scatter_fairly_cards_from_different_decks(self, limited_rev_queue):
-        decks_parents = {deck['id']: self.col.decks.parents(deck['id']) for deck in self.col.decks.all()}
-        return self.scatter_fairly_cards_from_different_decks(limited_rev_queue, self.col.decks.all(), decks_parents)
+    def scatter_fairly_cards_from_different_decks(limited_rev_queue, all_decks=None,
+                                                  decks_parents=None, queue=None):
+        """Order the (cid, did) LIMITED_REV_QUEUE so each deck, and each
+        parent deck in DECKS_PARENTS (did -> ancestor decks), is spread
+        evenly through it; see FairQueue. ALL_DECKS is accepted for older
+        callers, but only the decks with cards matter. If QUEUE is given,
+        the cards are added to that FairQueue, so the decks' earlier cards
+        count towards their share."""
+        parents = dict((did, [p['id'] for p in ps])
+                       for did, ps in (decks_parents or {}).items())
+        if queue is None:
+            queue = FairQueue()
+        queue.extend(limited_rev_queue, parents)
+        return list(queue)
+
+    def _scatter_fairly_cards_from_different_decks(self, limited_rev_queue, decks_parents):
+        return self.scatter_fairly_cards_from_different_decks(
+            limited_rev_queue, None, decks_parents, self._revFairQueue)
 
     def _deckRevLimit(self, d):
         if not d: return 0  # invalid deck selected?
@@ -1116,18 +1066,9 @@ select id from cards where did in %s and queue = 2 and due <= ? limit ?)"""
 
     @staticmethod
     def logRev(col, card, ease, delay, type, due):
-        def log():
-            col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, col.usn(), ease,
-                card.ivl if delay is None else delay, card.lastIvl, card.factor, card.timeTaken(),
-                type, due, Scheduler.daysSinceCreation(col))
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        col.logReview(card.id, ease, card.ivl if delay is None else delay,
+                      card.lastIvl, card.factor, card.timeTaken(), type, due,
+                      Scheduler.daysSinceCreation(col))
 
     # Interval management
     ##########################################################################
@@ -1440,6 +1381,10 @@ where id = ?
         if unburied < self.today:
             self.unburyCards()
             self.col.conf['lastUnburied'] = self.today
+        # the review summaries are rebuilt here if stale, not when the stats
+        # are looked at
+        if oldToday is not None and oldToday != self.today:
+            self.col.revlogDaily.today()
 
     def _checkDay(self):
         # check if the day has rolled over
@@ -1600,24 +1545,27 @@ end)
     def suspendCards(self, ids):
         "Suspend cards."
         self.col.log(ids)
-        self.col.db.execute(
-            "update cards set queue=-1,mod=?,usn=? where id in "+
-            ids2str(ids), intTime(), self.col.usn())
+        with self.col.db.idSet(ids) as sids:
+            self.col.db.execute(
+                "update cards set queue=-1,mod=?,usn=? where id in "+
+                sids, intTime(), self.col.usn())
 
     def unsuspendCards(self, ids):
         "Unsuspend cards."
         self.col.log(ids)
-        self.col.db.execute(
-            ("update cards set %s,mod=?,usn=? "
-            "where queue = -1 and id in %s") % (self._restoreQueueSnippet, ids2str(ids)),
-            intTime(), self.col.usn())
+        with self.col.db.idSet(ids) as sids:
+            self.col.db.execute(
+                ("update cards set %s,mod=?,usn=? "
+                "where queue = -1 and id in %s") % (self._restoreQueueSnippet, sids),
+                intTime(), self.col.usn())
 
     def buryCards(self, cids, manual=True):
         queue = manual and -3 or -2
         self.col.log(cids)
-        self.col.db.execute("""
-update cards set queue=?,mod=?,usn=? where id in """+ids2str(cids),
-                            queue, intTime(), self.col.usn())
+        with self.col.db.idSet(cids) as scids:
+            self.col.db.execute("""
+update cards set queue=?,mod=?,usn=? where id in """+scids,
+                                queue, intTime(), self.col.usn())
 
     def buryNote(self, nid):
         "Bury all cards for note until next session."
@@ -1690,9 +1638,10 @@ and (queue=0 or (queue=2 and due<=?))""",
     def forgetCards(self, ids):
         "Put cards at the end of the new queue."
         self.remFromDyn(ids)
-        self.col.db.execute(
-            "update cards set type=0,queue=0,ivl=0,due=0,odue=0,factor=?"
-            " where id in "+ids2str(ids), STARTING_FACTOR)
+        with self.col.db.idSet(ids) as sids:
+            self.col.db.execute(
+                "update cards set type=0,queue=0,ivl=0,due=0,odue=0,factor=?"
+                " where id in "+sids, STARTING_FACTOR)
         pmax = self.col.db.scalar(
             "select max(due) from cards where type=0") or 0
         # takes care of mod + usn
@@ -1717,16 +1666,16 @@ usn=:usn,mod=:mod,factor=:fact where id=:id""",
 
     def resetCards(self, ids):
         "Completely reset cards for export."
-        sids = ids2str(ids)
-        # we want to avoid resetting due number of existing new cards on export
-        nonNew = self.col.db.list(
-            "select id from cards where id in %s and (queue != 0 or type != 0)"
-            % sids)
-        # reset all cards
-        self.col.db.execute(
-            "update cards set reps=0,lapses=0,odid=0,odue=0,queue=0"
-            " where id in %s" % sids
-        )
+        with self.col.db.idSet(ids) as sids:
+            # we want to avoid resetting due number of existing new cards on export
+            nonNew = self.col.db.list(
+                "select id from cards where id in %s and (queue != 0 or type != 0)"
+                % sids)
+            # reset all cards
+            self.col.db.execute(
+                "update cards set reps=0,lapses=0,odid=0,odue=0,queue=0"
+                " where id in %s" % sids
+            )
         # and forget any non-new cards, changing their due numbers
         self.forgetCards(nonNew)
         self.col.log(ids)
@@ -1735,7 +1684,6 @@ usn=:usn,mod=:mod,factor=:fact where id=:id""",
     ##########################################################################
 
     def sortCards(self, cids, start=1, step=1, shuffle=False, shift=False):
-        scids = ids2str(cids)
         now = intTime()
         nids = []
         nidsSet = set()
@@ -1754,24 +1702,25 @@ usn=:usn,mod=:mod,factor=:fact where id=:id""",
         for c, nid in enumerate(nids):
             due[nid] = start+c*step
         high = start+c*step
-        # shift?
-        if shift:
-            low = self.col.db.scalar(
-                "select min(due) from cards where due >= ? and type = 0 "
-                "and id not in %s" % scids,
-                start)
-            if low is not None:
-                shiftby = high - low + 1
-                self.col.db.execute("""
+        with self.col.db.idSet(cids) as scids:
+            # shift?
+            if shift:
+                low = self.col.db.scalar(
+                    "select min(due) from cards where due >= ? and type = 0 "
+                    "and id not in %s" % scids,
+                    start)
+                if low is not None:
+                    shiftby = high - low + 1
+                    self.col.db.execute("""
 update cards set mod=?, usn=?, due=due+? where id not in %s
 and due >= ? and queue = 0""" % scids, now, self.col.usn(), shiftby, low)
-        # reorder cards
-        d = []
-        for id, nid in self.col.db.execute(
-            "select id, nid from cards where type = 0 and id in "+scids):
-            d.append(dict(now=now, due=due[nid], usn=self.col.usn(), cid=id))
-        self.col.db.executemany(
-            "update cards set due=:due,mod=:now,usn=:usn where id = :cid", d)
+            # reorder cards
+            d = []
+            for id, nid in self.col.db.execute(
+                "select id, nid from cards where type = 0 and id in "+scids):
+                d.append(dict(now=now, due=due[nid], usn=self.col.usn(), cid=id))
+            self.col.db.executemany(
+                "update cards set due=:due,mod=:now,usn=:usn where id = :cid", d)
 
     def randomizeCards(self, did):
         cids = self.col.db.list("select id from cards where did = ?", did)
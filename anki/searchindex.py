@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+A full-text index of the notes' fields, so text and field: searches only
+look at the notes containing the text rather than scanning them all.
+
+The index is an FTS5 table with the trigram tokenizer, which matches any
+run of 3 or more characters, ignoring case. It's kept in a separate file
+attached to the collection, so the collection itself stays readable by
+clients without FTS5, and temporary triggers on the notes table keep it up
+to date however the notes are changed. The index only narrows a search
+down: the LIKE and regex checks the Finder has always done are still run on
+the notes it returns, so the results are the same as without it. Text
+matched by a large share of the notes isn't worth narrowing down, and is
+searched by scanning as before.
+
+The file records the collection's mod time at each save. If it doesn't
+match when the collection is opened, the notes were changed without the
+triggers, and the index is rebuilt the first time it's needed.
+"""
+
+import os
+
+from anki.db import DBError
+
+# don't narrow searches by runs shorter than this, as the trigram
+# tokenizer can't match them
+MIN_RUN = 3
+# only narrow searches matching at most this share of the notes; checking
+# a longer list of ids is slower than scanning
+MAX_SHARE = 0.05
+
+def indexPath(col):
+    return col.path + "-search"
+
+class SearchIndex:
+
+    def __init__(self, col):
+        self.col = col
+        self.path = indexPath(col)
+        # true when the index matches the notes and the triggers are in place
+        self._ready = False
+
+    def attach(self):
+        """Attach the index to the collection's connection. Must be called
+        outside a transaction. False if SQLite can't build the index."""
+        created = not os.path.exists(self.path)
+        self.col.db.execute("attach database ? as search", self.path)
+        try:
+            self.col.db.execute("""
+create virtual table if not exists search.notes_fts
+using fts5(sfld, flds, tokenize='trigram')""")
+        except DBError:
+            # no fts5, or sqlite older than 3.34
+            self.col.db.execute("detach database search")
+            if created:
+                os.unlink(self.path)
+            return False
+        self.col.db.execute(
+            "create table if not exists search.search_meta (mod integer)")
+        return True
+
+    def load(self):
+        "Start keeping the index up to date, if it matches the notes."
+        self._ready = False
+        if self.col.db.scalar("select mod from search_meta") == self.col.mod:
+            self._addTriggers()
+            self._ready = True
+
+    def stamp(self, mod):
+        "Called when the col row is flushed with MOD."
+        if self._ready:
+            self.col.db.execute("delete from search_meta")
+            self.col.db.execute("insert into search_meta values (?)", mod)
+
+    # Building
+    ##########################################################################
+
+    def _addTriggers(self):
+        # temp triggers can write to other databases, and aren't seen by
+        # other connections
+        self.col.db.execute("""
+create temp trigger if not exists search_notes_ins after insert on main.notes
+begin
+    insert or replace into notes_fts (rowid, sfld, flds)
+    values (new.id, new.sfld, new.flds);
+end""")
+        self.col.db.execute("""
+create temp trigger if not exists search_notes_upd after update on main.notes
+when new.id != old.id or new.sfld is not old.sfld or new.flds is not old.flds
+begin
+    delete from notes_fts where rowid = old.id;
+    insert or replace into notes_fts (rowid, sfld, flds)
+    values (new.id, new.sfld, new.flds);
+end""")
+        self.col.db.execute("""
+create temp trigger if not exists search_notes_del after delete on main.notes
+begin
+    delete from notes_fts where rowid = old.id;
+end""")
+
+    def _rebuild(self):
+        self.col.db.execute("delete from notes_fts")
+        self.col.db.execute("""
+insert into notes_fts (rowid, sfld, flds) select id, sfld, flds from notes""")
+        self._ready = True
+        self.stamp(self.col.mod)
+        self._addTriggers()
+
+    # Searching
+    ##########################################################################
+
+    def candidates(self, pattern, column=None):
+        """The ids of the notes which may match the LIKE PATTERN (escaped
+        with a backslash), in COLUMN if given, or None if the index can't
+        narrow it down. Builds the index if it's out of date."""
+        runs = ['"%s"' % r.replace('"', '""') for r in _likeRuns(pattern)
+                if len(r) >= MIN_RUN]
+        if not runs:
+            return None
+        if not self._ready:
+            self._rebuild()
+        expr = " AND ".join(runs)
+        if column:
+            expr = "%s : (%s)" % (column, expr)
+        limit = int(self.col.noteCount() * MAX_SHARE)
+        nids = self.col.db.list(
+            "select rowid from search.notes_fts where notes_fts match ? "
+            "limit ?", expr, limit + 1)
+        if len(nids) > limit:
+            return None
+        return nids
+
+def _likeRuns(pattern):
+    "The literal text between the wildcards of LIKE PATTERN."
+    runs = []
+    run = ""
+    escaped = False
+    for c in pattern:
+        if escaped:
+            run += c
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in "%_":
+            runs.append(run)
+            run = ""
+        else:
+            run += c
+    runs.append(run)
+    return runs
@@ -2,15 +2,20 @@
 # Copyright: Ankitects Pty Ltd and contributors
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
+import os
+import copy
 import time
 import datetime
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from statistics import quantiles
 from collections import Counter
 
+from anki.db import DB
 from anki.utils import fmtTimeSpan, ids2str
 from anki.lang import _, ngettext
 from anki.advanced_stats.TrueRetention import todayStats_new
+from anki.advanced_stats import columns
 
 DEFAULT_ROLLOVER = 4
 
@@ -91,6 +96,16 @@ class CardStats:
 # Collection stats
 ##########################################################################
 
+class _ReaderCollection:
+    "The collection as seen by a stats worker: its own DB, the rest shared."
+
+    def __init__(self, col, db):
+        self._col = col
+        self.db = db
+
+    def __getattr__(self, name):
+        return getattr(self._col, name)
+
 colYoung = "#7c7"
 colMature = "#070"
 colOld = "#030"
@@ -107,6 +122,9 @@ colSusp = "#ff0"
 
 class CollectionStats:
 
+    # read per-day aggregates from revlog_daily rather than the revlog
+    useDaily = True
+
     def __init__(self, col):
         self.col = col
         self._stats = None
@@ -114,25 +132,141 @@ class CollectionStats:
         self.width = 600
         self.height = 200
         self.wholeCollection = False
+        # revlog columns and revlog_daily's current day, or False if it
+        # can't be used, shared by the sections of a report; see report()
+        self._revlog = None
+        self._today = None
 
     # assumes jquery & plot are available in document
     def report(self, type=0):
         # 0=days, 1=weeks, 2=months
         self.type = type
+        txt = self.reportHeader()
+        self._revlog = self._loadRevlog()
+        self._today = self._dailyToday()
+        try:
+            for section in self.sections():
+                txt += section(self)
+        finally:
+            self._revlog = None
+            self._today = None
+        return "<center>%s</center>" % txt
+
+    def _reader(self, db):
+        "A copy of these stats which reads from DB."
+        stats = copy.copy(self)
+        stats.col = _ReaderCollection(self.col, db)
+        return stats
+
+    def reportHeader(self):
         from .statsbg import bg
+        return self.css % bg
+
+    def sections(self):
+        "Functions which return the HTML of each section of the report."
         from .advanced_stats.graphs import ProgressGraphs
-        txt = self.css % bg
-        txt += self._section(self.todayStats())
-        txt += self._section(self.dueGraph())
-        txt += self.repsGraphs()
-        txt += self._section(self.introductionGraph())
-        txt += self._section(self.ivlGraph())
-        txt += self._section(self.hourGraph())
-        txt += self._section(self.easeGraph())
-        txt += self._section(ProgressGraphs(self))
-        txt += self._section(self.cardGraph())
-        txt += self._section(self.footer())
-        return "<center>%s</center>" % txt
+        return [
+            lambda s: s._section(s.todayStats()),
+            lambda s: s._section(s.dueGraph()),
+            lambda s: s.repsGraphs(),
+            lambda s: s._section(s.introductionGraph()),
+            lambda s: s._section(s.ivlGraph()),
+            lambda s: s._section(s.hourGraph()),
+            lambda s: s._section(s.easeGraph()),
+            lambda s: s._section(ProgressGraphs(s)),
+            lambda s: s._section(s.cardGraph()),
+            lambda s: s._section(s.footer()),
+        ]
+
+    def reportSections(self, type=0, workers=None):
+        """Build the sections of report() in parallel, each on its own
+        read-only connection. Returns an iterator of (index, html) in the
+        order the sections finish; the page is reportHeader() followed by
+        the sections in index order.
+
+        The collection is saved first so the readers see every change, and
+        the iterator may be consumed on another thread."""
+        self.type = type
+        self._today = self._dailyToday()
+        self.col.save()
+        return self._iterSections(workers)
+
+    def _iterSections(self, workers):
+        sections = self.sections()
+        if not os.path.exists(self.col.path):
+            # eg an in-memory collection
+            try:
+                self._revlog = self._loadRevlog()
+                for n, section in enumerate(sections):
+                    yield n, section(self)
+            finally:
+                self._revlog = None
+                self._today = None
+            return
+        def run(section):
+            db = DB(self.col.path, readonly=True)
+            try:
+                return section(self._reader(db))
+            finally:
+                db.close()
+        try:
+            db = DB(self.col.path, readonly=True)
+            try:
+                self._revlog = self._reader(db)._loadRevlog()
+            finally:
+                db.close()
+            with ThreadPoolExecutor(workers or min(len(sections), os.cpu_count() or 1)) as pool:
+                futures = {pool.submit(run, section): n
+                           for n, section in enumerate(sections)}
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+        finally:
+            self._revlog = None
+            self._today = None
+
+    def _loadRevlog(self):
+        "Load the revlog rows the report needs once, if numpy is available."
+        if not columns.available():
+            return None
+        period = self._periodDays()
+        if period:
+            # the widest window any section looks at
+            since = (self.col.sched.dayCutoff-((period+2)*86400))*1000
+        else:
+            since = None
+        return columns.RevlogColumns(self.col.db, self._revlogLimit(), since)
+
+    def _daily(self):
+        """(current day, list of deck limits) for reading revlog_daily, or
+        None if it's not used. A card's deck is only recorded as it was when
+        the table was built, and removing or moving cards doesn't change the
+        table, so the deck limited stats always read the revlog."""
+        if not self.wholeCollection:
+            return None
+        today = self._today
+        if today is None:
+            # not part of a report
+            today = self._dailyToday()
+        if today is False:
+            return None
+        return today, []
+
+    def _dailyToday(self):
+        """revlog_daily's current day, or False if it's not used. A report
+        works this out before starting, as the table is read with the
+        collection's connection, which the section threads can't use."""
+        if not self.useDaily:
+            return False
+        # it's not rebuilt here, as looking at the stats shouldn't modify
+        # the collection; the revlog is read instead until it is
+        today = self.col.revlogDaily.today(build=False)
+        return False if today is None else today
+
+    def _revlogSince(self, since):
+        "The loaded revlog columns, if they hold every review after SINCE."
+        if self._revlog is not None and self._revlog.covers(since):
+            return self._revlog
+        return None
 
     def _section(self, txt):
         return "<div class=section>%s</div>" % txt
@@ -487,6 +621,33 @@ from cards %s
 group by day_calculated order by day_calculated""" % lim, cut=self.col.sched.dayCutoff,tf=tf, chunk=chunk)
 
     def _done(self, num=7, chunk=1):
+        if self.type == 0:
+            tf = 60.0 # minutes
+        else:
+            tf = 3600.0 # hours
+        daily = self._daily()
+        if daily:
+            today, lims = daily
+            if num is not None:
+                lims.append("day > %d" % (today - num*chunk))
+            lim = "where " + " and ".join(lims) if lims else ""
+            return self.col.db.all("""
+select
+(day - :today)/:chunk as day_calculated,
+sum(case when type = 0 then cnt else 0 end), -- lrn count
+sum(case when type = 1 and not mature then cnt else 0 end), -- yng count
+sum(case when type = 1 and mature then cnt else 0 end), -- mtr count
+sum(case when type = 2 then cnt else 0 end), -- lapse count
+sum(case when type = 3 then cnt else 0 end), -- cram count
+sum(case when type = 0 then time/1000.0 else 0 end)/:tf, -- lrn time
+-- yng + mtr time
+sum(case when type = 1 and not mature then time/1000.0 else 0 end)/:tf,
+sum(case when type = 1 and mature then time/1000.0 else 0 end)/:tf,
+sum(case when type = 2 then time/1000.0 else 0 end)/:tf, -- lapse time
+sum(case when type = 3 then time/1000.0 else 0 end)/:tf -- cram time
+from revlog_daily %s
+group by day_calculated order by day_calculated""" % lim,
+                                today=today, tf=tf, chunk=chunk)
         lims = []
         if num is not None:
             lims.append("id > %d" % (
@@ -498,10 +659,6 @@ group by day_calculated order by day_calculated""" % lim, cut=self.col.sched.day
             lim = "where " + " and ".join(lims)
         else:
             lim = ""
-        if self.type == 0:
-            tf = 60.0 # minutes
-        else:
-            tf = 3600.0 # hours
         return self.col.db.all("""
 select
 (cast((id/1000.0 - :cut) / 86400.0 as int))/:chunk as day_calculated,
@@ -523,8 +680,19 @@ group by day_calculated order by day_calculated""" % lim,
                             chunk=chunk)
 
     def _daysStudied(self):
-        lims = []
         num = self._periodDays()
+        daily = self._daily()
+        if daily:
+            today, lims = daily
+            if num:
+                lims.append("day > %d" % (today - num))
+            lim = "where " + " and ".join(lims) if lims else ""
+            return self.col.db.first("""
+select count(), abs(min(day_calculated)) from (select
+day - :today + 1 as day_calculated
+from revlog_daily %s
+group by day_calculated)""" % lim, today=today)
+        lims = []
         if num:
             lims.append(
                 "id > %d" %
@@ -667,16 +835,34 @@ select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
                 "</td></tr></table></center>")
 
     def _eases(self):
-        lims = []
-        lim = self._revlogLimit()
-        if lim:
-            lims.append(lim)
         if self.type == 0:
             days = 30
         elif self.type == 1:
             days = 365
         else:
             days = None
+        if self.col.isFirstVersionSchedulerUsed():
+            ease4repl = "3"
+        else:
+            ease4repl = "ease"
+        daily = self._daily()
+        if daily:
+            today, lims = daily
+            if days is not None:
+                lims.append("day > %d" % (today - days))
+            lim = "where " + " and ".join(lims) if lims else ""
+            return self.col.db.all("""
+select (case
+when type in (0,2) then 0
+when not mature then 1
+else 2 end) as thetype,
+(case when type in (0,2) and ease = 4 then %s else ease end), sum(cnt) from revlog_daily %s
+group by thetype, ease
+order by thetype, ease""" % (ease4repl, lim))
+        lims = []
+        lim = self._revlogLimit()
+        if lim:
+            lims.append(lim)
         if days is not None:
             lims.append("id > %d" % (
                 (self.col.sched.dayCutoff-(days*86400))*1000))
@@ -684,10 +870,6 @@ select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
             lim = "where " + " and ".join(lims)
         else:
             lim = ""
-        if self.col.isFirstVersionSchedulerUsed():
-            ease4repl = "3"
-        else:
-            ease4repl = "ease"
         return self.col.db.all("""
 select (case
 when type in (0,2) then 0
@@ -756,9 +938,15 @@ order by thetype, ease""" % (ease4repl, lim))
             rolloverHour = sd.hour
         else:
             rolloverHour = self.col.conf.get("rollover", DEFAULT_ROLLOVER)
+        since = None
         pd = self._periodDays()
         if pd:
-            lim += " and id > %d" % ((self.col.sched.dayCutoff-(86400*pd))*1000)
+            since = (self.col.sched.dayCutoff-(86400*pd))*1000
+            lim += " and id > %d" % since
+        revlog = self._revlogSince(since)
+        if revlog is not None:
+            return revlog.hour_retention(
+                self.col.sched.dayCutoff-(rolloverHour*3600), since)
         return self.col.db.all("""
 select
 23 - ((cast((:cut - id/1000) / 3600.0 as int)) %% 24) as hour,
@@ -961,7 +1149,10 @@ $(function () {
         if lim:
             lim = " where " + lim
         if by == 'review':
-            t = self.col.db.scalar("select id from revlog %s order by id limit 1" % lim)
+            if self._revlogSince(None) is not None:
+                t = self._revlog.first_id()
+            else:
+                t = self.col.db.scalar("select id from revlog %s order by id limit 1" % lim)
         elif by == 'add':
             lim = "where did in %s" % ids2str(self.col.decks.active())
             t = self.col.db.scalar("select id from cards %s order by id limit 1" % lim)
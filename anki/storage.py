@@ -11,11 +11,12 @@ from anki.lang import _
 from anki.utils import intTime, isWin
 from anki.db import DB
 from anki.collection import _Collection
+import anki.journal
 from anki.consts import *
 from anki.stdmodels import addBasicModel, addClozeModel, addForwardReverse, \
     addForwardOptionalReverse, addBasicTypingModel
 
-def Collection(path, lock=True, server=False, log=False):
+def Collection(path, lock=True, server=False, log=False, searchIndex=False):
     "Open a new or existing collection. Path must be unicode."
     assert path.endswith(".anki2")
     path = os.path.abspath(path)
@@ -37,7 +38,7 @@ def Collection(path, lock=True, server=False, log=False):
         db.execute("pragma journal_mode = wal")
     db.setAutocommit(False)
     # add db to col and do any remaining upgrades
-    col = _Collection(db, server, log)
+    col = _Collection(db, server, log, searchIndex)
     if ver < SCHEMA_VERSION:
         _upgrade(col, ver)
     elif ver > SCHEMA_VERSION:
@@ -50,6 +51,9 @@ def Collection(path, lock=True, server=False, log=False):
         addForwardReverse(col)
         addBasicModel(col)
         col.save()
+    else:
+        # answers journaled after the last save
+        anki.journal.replay(col)
     if lock:
         col.lock()
     return col
@@ -3,14 +3,18 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import io
-import gzip
 import random
+import zlib
 import requests
 import json
 import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from anki.db import DB, DBError
-from anki.utils import ids2str, intTime, platDesc, checksum, devMode
+from anki.utils import intTime, platDesc, checksum, devMode
 from anki.consts import *
 from anki.utils import versionWithBuild
 from .hooks import runHook
@@ -21,15 +25,50 @@ from .lang import ngettext
 HTTP_TIMEOUT = 90
 HTTP_PROXY = None
 HTTP_BUF_SIZE = 64*1024
+# bytes of cards, notes and revlog entries sent at a time to begin with
+SYNC_CHUNK_BYTES = 256*1024
+# the limits the size adapts within
+SYNC_CHUNK_MIN = 32*1024
+SYNC_CHUNK_MAX = 4*1024*1024
+# seconds a chunk's round trip should take
+SYNC_CHUNK_SECS = 2.0
+# the size of a deletion in a chunk
+SYNC_GRAVE_BYTES = 16
 
 # Incremental syncing
 ##########################################################################
 
+class ChunkSizer:
+    """The size in bytes of the chunks sent to the server. After each round
+    trip it moves towards the size that would have taken SYNC_CHUNK_SECS,
+    at most halving or doubling at a time."""
+
+    def __init__(self):
+        self.bytes = SYNC_CHUNK_BYTES
+
+    def update(self, sent, secs):
+        "Called after a chunk of SENT bytes took SECS to apply."
+        if sent < self.bytes / 2:
+            # the last chunk of a table, which says more about latency
+            # than throughput
+            return
+        want = sent / max(secs, 0.001) * SYNC_CHUNK_SECS
+        want = min(max(want, self.bytes / 2), self.bytes * 2)
+        self.bytes = int(min(max(want, SYNC_CHUNK_MIN), SYNC_CHUNK_MAX))
+
+def _rowBytes(row):
+    "Roughly the size of ROW once encoded as JSON."
+    size = 2
+    for v in row:
+        size += len(v) + 4 if isinstance(v, str) else 6
+    return size
+
 class Syncer:
 
     def __init__(self, col, server=None):
         self.col = col
         self.server = server
+        self.sizer = ChunkSizer()
 
     def sync(self):
         "Returns 'noChanges', 'fullSync', 'success', etc"
@@ -87,7 +126,11 @@ class Syncer:
         lgraves = self.removed()
         while lgraves:
             gchunk, lgraves = self._gravesChunk(lgraves)
+            t = time.time()
             self.server.applyGraves(chunk=gchunk)
+            self.sizer.update(
+                sum(len(ids) for ids in gchunk.values()) * SYNC_GRAVE_BYTES,
+                time.time() - t)
 
         # then apply server deletions here
         self.remove(rrem)
@@ -111,7 +154,9 @@ class Syncer:
             runHook("sync", "stream")
             chunk = self.chunk()
             self.col.log("client chunk", chunk)
+            t = time.time()
             self.server.applyChunk(chunk=chunk)
+            self.sizer.update(self.chunkBytes, time.time() - t)
             if chunk['done']:
                 break
         # step 5: sanity check
@@ -131,7 +176,7 @@ class Syncer:
         return "success"
 
     def _gravesChunk(self, graves):
-        lim = 250
+        lim = max(1, self.sizer.bytes // SYNC_GRAVE_BYTES)
         chunk = dict(notes=[], cards=[], decks=[])
         for cat in "notes", "cards", "decks":
             if lim and graves[cat]:
@@ -217,6 +262,9 @@ class Syncer:
     def finish(self, mod=None):
         self.col.ls = mod
         self.col._usn = self.maxUsn + 1
+        if not self.col.server:
+            # reviews from elsewhere may have left the summaries stale
+            self.col.revlogDaily.today()
         # ensure we save the mod time even if no changes made
         self.col.db.mod = True
         self.col.save(mod=mod)
@@ -247,15 +295,22 @@ select id, guid, mid, mod, %d, tags, flds, '', '', flags, data
 from notes where %s""" % d)
 
     def chunk(self):
+        "The next rows to send, up to the sizer's size in bytes."
         buf = dict(done=False)
-        lim = 250
-        while self.tablesLeft and lim:
+        lim = self.sizer.bytes
+        # the size of the chunk, for the sizer
+        self.chunkBytes = 0
+        while self.tablesLeft and self.chunkBytes < lim:
             curTable = self.tablesLeft[0]
             if not self.cursor:
                 self.cursor = self.cursorForTable(curTable)
-            rows = self.cursor.fetchmany(lim)
-            fetched = len(rows)
-            if fetched != lim:
+            rows = []
+            for row in self.cursor:
+                rows.append(row)
+                self.chunkBytes += _rowBytes(row)
+                if self.chunkBytes >= lim:
+                    break
+            else:
                 # table is empty
                 self.tablesLeft.pop(0)
                 self.cursor = None
@@ -264,7 +319,6 @@ from notes where %s""" % d)
                     "update %s set usn=? where usn=-1"%curTable,
                     self.maxUsn)
             buf[curTable] = rows
-            lim -= fetched
         if not self.tablesLeft:
             buf['done'] = True
         return buf
@@ -383,36 +437,40 @@ from notes where %s""" % d)
     ##########################################################################
 
     def mergeRevlog(self, logs):
-        self.col.db.executemany(
-            "insert or ignore into revlog values (?,?,?,?,?,?,?,?,?)",
-            logs)
-
-    def newerRows(self, data, table, modIdx):
-        ids = (r[0] for r in data)
-        lmods = {}
-        for id, mod in self.col.db.execute(
-            "select id, mod from %s where id in %s and %s" % (
-                table, ids2str(ids), self.usnLim())):
-            lmods[id] = mod
-        update = []
-        for r in data:
-            if r[0] not in lmods or lmods[r[0]] < r[modIdx]:
-                update.append(r)
+        self.col.revlogDaily.merge(logs)
+
+    def mergeRows(self, data, table):
+        """Write the rows of TABLE in DATA, except those with local changes
+        at least as new. Returns the ids written."""
         self.col.log(table, data)
-        return update
+        if not data:
+            return []
+        # the rows are loaded into a temp table, and compared with a join
+        tmp = "sync_" + table
+        db = self.col.db
+        # a rollback may have discarded the table
+        db.execute("create temp table if not exists %s as "
+                   "select * from main.%s where 0" % (tmp, table))
+        try:
+            db.executemany("insert into temp.%s values (%s)" % (
+                tmp, ",".join("?" * len(data[0]))), data)
+            db.execute("""
+delete from temp.{tmp} where exists (select 1 from main.{table} l
+where l.id = {tmp}.id and l.mod >= {tmp}.mod and {lim})""".format(
+                tmp=tmp, table=table, lim=self.usnLim()))
+            db.execute("insert or replace into main.%s select * from temp.%s"
+                       % (table, tmp))
+            return db.list("select id from temp.%s" % tmp)
+        finally:
+            db.execute("delete from temp.%s" % tmp)
 
     def mergeCards(self, cards):
-        self.col.db.executemany(
-            "insert or replace into cards values "
-            "(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            self.newerRows(cards, "cards", 4))
+        self.mergeRows(cards, "cards")
 
     def mergeNotes(self, notes):
-        rows = self.newerRows(notes, "notes", 3)
-        self.col.db.executemany(
-            "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
-            rows)
-        self.col.updateFieldCache([f[0] for f in rows])
+        nids = self.mergeRows(notes, "notes")
+        self.col.updateFieldCache(nids)
+        self.col.mediaRefs.update(nids)
 
     # Col config
     ##########################################################################
@@ -446,14 +504,16 @@ class AnkiRequestsClient:
         headers['User-Agent'] = self._agentName()
         return self.session.get(url, stream=True, headers=headers, timeout=self.timeout, verify=self.verify)
 
-    def streamContent(self, resp):
+    def streamContent(self, resp, fileobj=None):
+        "The body of RESP, or if FILEOBJ is given, write it there instead."
         resp.raise_for_status()
 
-        buf = io.BytesIO()
+        buf = fileobj or io.BytesIO()
         for chunk in resp.iter_content(chunk_size=HTTP_BUF_SIZE):
             runHook("httpRecv", len(chunk))
             buf.write(chunk)
-        return buf.getvalue()
+        if not fileobj:
+            return buf.getvalue()
 
     def _agentName(self):
         from anki import version
@@ -472,6 +532,27 @@ class _MonitoringFile(io.BufferedReader):
         runHook("httpSend", len(data))
         return data
 
+class _ChunkReader(io.RawIOBase):
+    "A file reading the bytes yielded by CHUNKS."
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            try:
+                self._buf = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
 # HTTP syncing tools
 ##########################################################################
 
@@ -515,42 +596,56 @@ class HttpSyncer:
                 ('Content-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' %
                 (key, value)).encode("utf8"))
         # payload as raw data or json
-        rawSize = 0
         if fobj:
             # header
             buf.write(bdry + b"\r\n")
             buf.write(b"""\
 Content-Disposition: form-data; name="data"; filename="data"\r\n\
 Content-Type: application/octet-stream\r\n\r\n""")
-            # write file into buffer, optionally compressing
+        # connection headers
+        headers = {
+            'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY.decode("utf8"),
+        }
+        body = self._postBody(buf.getvalue(), fobj, comp, bdry)
+
+        if fobj is None or isinstance(fobj, io.BytesIO):
+            # small payloads are sent in one go, with their length
+            body = b"".join(body)
+            headers['Content-Length'] = str(len(body))
+            return headers, io.BytesIO(body)
+        # while files are compressed as they're sent, so the collection isn't
+        # held in memory, and the length isn't known in advance
+        return headers, _ChunkReader(body)
+
+    def _postBody(self, head, fobj, comp, bdry):
+        "Yield HEAD, then FOBJ, optionally compressing it as it's read."
+        yield head
+        size = len(head)
+        rawSize = 0
+        if fobj:
             if comp:
-                tgt = gzip.GzipFile(mode="wb", fileobj=buf, compresslevel=comp)
-            else:
-                tgt = buf
+                # the same format as gzip.GzipFile writes
+                z = zlib.compressobj(comp, zlib.DEFLATED, 16+zlib.MAX_WBITS)
             while 1:
                 data = fobj.read(65536)
                 if not data:
-                    if comp:
-                        tgt.close()
                     break
                 rawSize += len(data)
-                tgt.write(data)
-            buf.write(b"\r\n")
-        buf.write(bdry + b'--\r\n')
-        size = buf.tell()
-        # connection headers
-        headers = {
-            'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY.decode("utf8"),
-            'Content-Length': str(size),
-        }
-        buf.seek(0)
-
-        if size >= 100*1024*1024 or rawSize >= 250*1024*1024:
-            raise Exception("Collection too large to upload to AnkiWeb.")
-
-        return headers, buf
+                if comp:
+                    data = z.compress(data)
+                size += len(data)
+                if size >= 100*1024*1024 or rawSize >= 250*1024*1024:
+                    raise Exception("Collection too large to upload to AnkiWeb.")
+                if data:
+                    yield data
+            if comp:
+                yield z.flush()
+            yield b"\r\n"
+        yield bdry + b'--\r\n'
 
-    def req(self, method, fobj=None, comp=6, badAuthRaises=True):
+    def req(self, method, fobj=None, comp=6, badAuthRaises=True, dest=None):
+        """The response's body, or if DEST is given, write it to that file
+        instead."""
         headers, body = self._buildPostData(fobj, comp)
 
         r = self.client.post(self.syncURL()+method, data=body, headers=headers)
@@ -558,7 +653,7 @@ Content-Type: application/octet-stream\r\n\r\n""")
             return False
         self.assertOk(r)
 
-        buf = self.client.streamContent(r)
+        buf = self.client.streamContent(r, dest)
         return buf
 
 # Incremental sync over HTTP
@@ -640,12 +735,22 @@ class FullSyncer(HttpSyncer):
         runHook("sync", "download")
         localNotEmpty = self.col.db.scalar("select 1 from cards")
         self.col.close()
-        cont = self.req("download")
         tpath = self.col.path + ".tmp"
-        if cont == "upgradeRequired":
+        # the file is written as it's received, checking its header and
+        # length along the way
+        try:
+            with open(tpath, "wb") as f:
+                check = _CollectionFile(f)
+                self.req("download", dest=check)
+            if check.body != b"upgradeRequired":
+                check.finish()
+        except Exception:
+            os.unlink(tpath)
+            raise
+        if check.body == b"upgradeRequired":
+            os.unlink(tpath)
             runHook("sync", "upgradeRequired")
             return
-        open(tpath, "wb").write(cont)
         # check the received file is ok
         d = DB(tpath)
         assert d.scalar("pragma integrity_check") == "ok"
@@ -670,10 +775,56 @@ class FullSyncer(HttpSyncer):
             return False
         # apply some adjustments, then upload
         self.col.beforeUpload()
-        if self.req("upload", open(self.col.path, "rb")) != b"OK":
-            return False
+        with open(self.col.path, "rb") as f:
+            if self.req("upload", f) != b"OK":
+                return False
         return True
 
+class _CollectionFile:
+    """Writes a downloaded collection to FILE, checking it's an SQLite
+    database as it arrives, so a bad download fails early."""
+
+    # the database header's size, and its first bytes
+    HEADER_SIZE = 100
+    MAGIC = b"SQLite format 3\0"
+
+    def __init__(self, file):
+        self.file = file
+        self.head = b""
+        self.size = 0
+
+    def write(self, data):
+        if len(self.head) < self.HEADER_SIZE:
+            self.head += data[:self.HEADER_SIZE-len(self.head)]
+            if (len(self.head) >= len(self.MAGIC) and
+                    not self.head.startswith(self.MAGIC)):
+                # may be a short message from the server instead
+                if self.size + len(data) > self.HEADER_SIZE:
+                    raise Exception("Downloaded collection is not a database.")
+        self.size += len(data)
+        self.file.write(data)
+
+    @property
+    def body(self):
+        "The whole download, if it was too short to be a database."
+        if self.size < self.HEADER_SIZE:
+            return self.head
+        return None
+
+    def finish(self):
+        "Check the download is complete, according to its header."
+        if self.size < self.HEADER_SIZE or not self.head.startswith(self.MAGIC):
+            raise Exception("Downloaded collection is not a database.")
+        pageSize = int.from_bytes(self.head[16:18], "big")
+        if pageSize == 1:
+            pageSize = 65536
+        pages = int.from_bytes(self.head[28:32], "big")
+        # the page count is only valid if written by sqlite 3.7.0 or later,
+        # in which case the change counter matches the version-valid-for
+        valid = self.head[24:28] == self.head[92:96] and pages
+        if self.size % pageSize or (valid and self.size != pages * pageSize):
+            raise Exception("Downloaded collection is incomplete.")
+
 # Media syncing
 ##########################################################################
 #
@@ -686,6 +837,10 @@ class FullSyncer(HttpSyncer):
 
 class MediaSyncer:
 
+    # download and unpack several zips at once, and build the next zip to
+    # upload while the last one is sent
+    pipelined = True
+
     def __init__(self, col, server=None):
         self.col = col
         self.server = server
@@ -761,33 +916,51 @@ class MediaSyncer:
 
         updateConflict = False
         toSend = self.col.media.dirtyCount()
-        while True:
-            zip, fnames = self.col.media.mediaChangesZip()
-            if not fnames:
-                break
-
-            runHook("syncMsg", ngettext(
-                "%d media change to upload", "%d media changes to upload", toSend)
-                    % toSend)
-
-            processedCnt, serverLastUsn = self.server.uploadChanges(zip)
-            self.col.media.markClean(fnames[0:processedCnt])
-
-            self.col.log("processed %d, serverUsn %d, clientUsn %d" % (
-                processedCnt, serverLastUsn, lastUsn
-            ))
+        ex = ThreadPoolExecutor(1)
+        try:
+            nextZip = ex.submit(self._changesZip())
+            while True:
+                zip, fnames = nextZip.result()
+                if not fnames:
+                    zip.close()
+                    break
 
-            if serverLastUsn - processedCnt == lastUsn:
-                self.col.log("lastUsn in sync, updating local")
-                lastUsn = serverLastUsn
-                self.col.media.setLastUsn(serverLastUsn) # commits
-            else:
-                self.col.log("concurrent update, skipping usn update")
-                # commit for markClean
-                self.col.media.db.commit()
-                updateConflict = True
+                runHook("syncMsg", ngettext(
+                    "%d media change to upload", "%d media changes to upload", toSend)
+                        % toSend)
+
+                if self.pipelined:
+                    # the files being sent stay dirty until the server
+                    # replies, so leave them out of the next zip
+                    nextZip = ex.submit(self._changesZip(exclude=set(fnames)))
+                with zip:
+                    processedCnt, serverLastUsn = self.server.uploadChanges(zip)
+                self.col.media.markClean(fnames[0:processedCnt])
+                if self.pipelined and processedCnt < len(fnames):
+                    # the rest are still dirty but were left out of the
+                    # prepared zip, so start again with them
+                    nextZip.result()[0].close()
+                    nextZip = ex.submit(self._changesZip())
+                elif not self.pipelined:
+                    nextZip = ex.submit(self._changesZip())
+
+                self.col.log("processed %d, serverUsn %d, clientUsn %d" % (
+                    processedCnt, serverLastUsn, lastUsn
+                ))
+
+                if serverLastUsn - processedCnt == lastUsn:
+                    self.col.log("lastUsn in sync, updating local")
+                    lastUsn = serverLastUsn
+                    self.col.media.setLastUsn(serverLastUsn) # commits
+                else:
+                    self.col.log("concurrent update, skipping usn update")
+                    # commit for markClean
+                    self.col.media.db.commit()
+                    updateConflict = True
 
-            toSend -= processedCnt
+                toSend -= processedCnt
+        finally:
+            ex.shutdown(wait=True)
 
         if updateConflict:
             self.col.log("restart sync due to concurrent update")
@@ -801,8 +974,22 @@ class MediaSyncer:
             self.col.media.forceResync()
             return ret
 
+    def _changesZip(self, exclude=()):
+        """A function returning a temporary file with a zip of the next
+        changes not in EXCLUDE, and their names. The changes are read now,
+        so it can be run on another thread."""
+        rows = self.col.media.dirtyRows(exclude)
+        def build():
+            f = tempfile.TemporaryFile()
+            fnames = self.col.media.writeChangesZip(rows, f)
+            f.seek(0)
+            return f, fnames
+        return build
+
     def _downloadFiles(self, fnames):
         self.col.log("%d files to fetch"%len(fnames))
+        if self.pipelined:
+            return self._downloadPipelined(fnames)
         while fnames:
             top = fnames[0:SYNC_ZIP_COUNT]
             self.col.log("fetch %s"%top)
@@ -817,6 +1004,41 @@ class MediaSyncer:
                 "%d media file downloaded", "%d media files downloaded", n)
                     % n)
 
+    def _downloadPipelined(self, fnames):
+        # zips are downloaded and unpacked on other threads, and added to the
+        # DB here, in the order they were asked for
+        ex = ThreadPoolExecutor(SYNC_MEDIA_INFLIGHT)
+        pending = deque()
+        try:
+            while fnames or pending:
+                while fnames and len(pending) < SYNC_MEDIA_INFLIGHT:
+                    top = fnames[0:SYNC_ZIP_COUNT]
+                    fnames = fnames[SYNC_ZIP_COUNT:]
+                    self.col.log("fetch %s"%top)
+                    pending.append((top, ex.submit(self._fetchFiles, top)))
+                top, future = pending.popleft()
+                media = future.result()
+                self.col.media.addExtracted(media)
+                cnt = len(media)
+                self.downloadCount += cnt
+                self.col.log("received %d files"%cnt)
+                # the server may send fewer than asked for
+                fnames = top[cnt:] + fnames
+
+                n = self.downloadCount
+                runHook("syncMsg", ngettext(
+                    "%d media file downloaded", "%d media files downloaded", n)
+                        % n)
+        finally:
+            # don't fetch any more if stopping early
+            for top, future in pending:
+                future.cancel()
+            ex.shutdown(wait=True)
+
+    def _fetchFiles(self, fnames):
+        zipData = self.server.downloadFiles(files=fnames)
+        return self.col.media.extractZip(zipData)
+
 # Remote media syncing
 ##########################################################################
 
@@ -850,9 +1072,12 @@ class RemoteMediaServer(HttpSyncer):
         return self.req("downloadFiles", io.BytesIO(json.dumps(kw).encode("utf8")))
 
     def uploadChanges(self, zip):
+        "ZIP is the zip's data, or a file holding it."
+        if isinstance(zip, bytes):
+            zip = io.BytesIO(zip)
         # no compression, as we compress the zip file instead
         return self._dataOnly(
-            self.req("uploadChanges", io.BytesIO(zip), comp=0))
+            self.req("uploadChanges", zip, comp=0))
 
     # args: local
     def mediaSanity(self, **kw):
@@ -22,16 +22,24 @@ class TagManager:
 
     def __init__(self, col):
         self.col = col
+        # newly registered tags, see anki.registry
+        self._dirty = set()
 
     def load(self, json_):
         self.tags = json.loads(json_)
         self.changed = False
+        self._dirty = set()
 
     def flush(self):
         if self.changed:
             self.col.db.execute("update col set tags=?",
                                  json.dumps(self.tags))
+            self.col.registry.clear(("tag",))
             self.changed = False
+            self._dirty = set()
+        elif self._dirty:
+            self.col.registry.write(("tag", t) for t in self._dirty)
+            self._dirty = set()
 
     # Registering and fetching tags
     #############################################################
@@ -43,7 +51,7 @@ class TagManager:
             if t not in self.tags:
                 found = True
                 self.tags[t] = self.col.usn() if usn is None else usn
-                self.changed = True
+                self._dirty.add(t)
         if found:
             runHook("newTag")
 
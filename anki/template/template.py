@@ -1,4 +1,6 @@
 import re
+from collections import Counter
+from functools import lru_cache
 from anki.utils import stripHTML, stripHTMLMedia
 from anki.hooks import runFilter
 from anki.template import furigana; furigana.install()
@@ -6,6 +8,11 @@ from anki.template import hint; hint.install()
 
 clozeReg = r"(?si)\{\{(c)%s::(.*?)(::(.*?))?\}\}"
 
+# number of templates kept compiled
+TEMPLATE_CACHE = 1000
+# more distinct tags than this, and render_tags() gives up
+MAX_TAGS = 100
+
 modifiers = {}
 def modifier(symbol):
     """Decorator for associating a function with a Mustache tag modifier.
@@ -34,7 +41,19 @@ def get_or_attr(obj, name, default=None):
             return default
 
 
+@lru_cache(maxsize=None)
+def _regexps(otag, ctag):
+    tags = { 'otag': re.escape(otag), 'ctag': re.escape(ctag) }
+
+    section = r"%(otag)s[\#|^]([^\}]*)%(ctag)s(.+?)%(otag)s/\1%(ctag)s"
+    tag = r"%(otag)s(#|=|&|!|>|\{)?(.+?)\1?%(ctag)s+"
+    return re.compile(section % tags, re.M|re.S), re.compile(tag % tags)
+
+
 class Template:
+    # render through the cached parse of the template where possible
+    compiled = True
+
     # The regular expression used to find a #section
     section_re = None
 
@@ -57,24 +76,78 @@ class Template:
         template = template or self.template
         context = context or self.context
 
-        template = self.render_sections(template, context)
-        result = self.render_tags(template, context)
+        result = None
+        if self.compiled and self.otag == Template.otag:
+            result = self.render_compiled(template, context)
+        if result is None:
+            template = self.render_sections(template, context)
+            result = self.render_tags(template, context)
         if encoding is not None:
             result = result.encode(encoding)
         return result
 
     def compile_regexps(self):
         """Compiles our section and tag regular expressions."""
-        tags = { 'otag': re.escape(self.otag), 'ctag': re.escape(self.ctag) }
-
-        section = r"%(otag)s[\#|^]([^\}]*)%(ctag)s(.+?)%(otag)s/\1%(ctag)s"
-        self.section_re = re.compile(section % tags, re.M|re.S)
-
-        tag = r"%(otag)s(#|=|&|!|>|\{)?(.+?)\1?%(ctag)s+"
-        self.tag_re = re.compile(tag % tags)
+        self.section_re, self.tag_re = _regexps(self.otag, self.ctag)
+
+    def render_compiled(self, template, context):
+        """Render TEMPLATE in one pass over its cached parse, or return None
+        if that might not give the same result as render_sections() and
+        render_tags(), which rescan the text after every replacement."""
+        if "{{=" in template:
+            # changes the delimiters part way through
+            return None
+        try:
+            shown = tuple(bool(self.section_value(name, context))
+                          for name in _sectionNames(template))
+        except Exception:
+            return None
+        try:
+            tokens = _tokens(_renderSections(template, shown))
+        except KeyError:
+            # the expansion formed a new section
+            return None
+        if tokens is None:
+            return None
+        buf = []
+        done = {}
+        for tok in tokens:
+            if tok.__class__ is str:
+                buf.append(tok)
+                continue
+            tag, tag_type, tag_name = tok
+            rep = done.get(tag)
+            if rep is None:
+                try:
+                    rep = modifiers[tag_type](self, tag_name, context)
+                except (SyntaxError, KeyError):
+                    return "{{invalid template}}"
+                if not isinstance(rep, str) or "{" in rep or "}" in rep:
+                    # may form a new tag with the text around it
+                    return None
+                done[tag] = rep
+            buf.append(rep)
+        return "".join(buf)
+
+    def section_value(self, section_name, context):
+        "The value a section is shown or hidden by, if true or false."
+        # check for cloze
+        val = None
+        m = re.match(r"c[qa]:(\d+):(.+)", section_name)
+        if m:
+            # get full field text
+            txt = get_or_attr(context, m.group(2), None)
+            m = re.search(clozeReg%m.group(1), txt)
+            if m:
+                val = m.group(1)
+        else:
+            val = get_or_attr(context, section_name, None)
+        if val:
+            val = stripHTMLMedia(val).strip()
+        return val
 
-    def render_sections(self, template, context):
-        """Expands sections."""
+    def render_sections(self, template, context, shown=None):
+        """Expands sections. SHOWN maps names to values instead of CONTEXT."""
         while 1:
             match = self.section_re.search(template)
             if match is None:
@@ -83,22 +156,13 @@ class Template:
             section, section_name, inner = match.group(0, 1, 2)
             section_name = section_name.strip()
 
-            # check for cloze
-            val = None
-            m = re.match(r"c[qa]:(\d+):(.+)", section_name)
-            if m:
-                # get full field text
-                txt = get_or_attr(context, m.group(2), None)
-                m = re.search(clozeReg%m.group(1), txt)
-                if m:
-                    val = m.group(1)
+            if shown is None:
+                val = self.section_value(section_name, context)
             else:
-                val = get_or_attr(context, section_name, None)
+                val = shown[section_name]
 
             replacer = ''
             inverted = section[2] == "^"
-            if val:
-                val = stripHTMLMedia(val).strip()
             if (val and not inverted) or (not val and inverted):
                 replacer = inner
 
@@ -245,3 +309,42 @@ class Template:
             return
         self.compile_regexps()
         return ''
+
+
+# Compiled templates
+##########################################################################
+
+_sectionOpenRe = re.compile(r"\{\{[\#|^]([^\}]*)\}\}")
+
+@lru_cache(maxsize=TEMPLATE_CACHE)
+def _sectionNames(template):
+    "Names of the sections in TEMPLATE, in order."
+    return tuple(dict.fromkeys(
+        name.strip() for name in _sectionOpenRe.findall(template)))
+
+@lru_cache(maxsize=TEMPLATE_CACHE)
+def _renderSections(template, shown):
+    "TEMPLATE with its sections expanded, given which of them are SHOWN."
+    return Template(template).render_sections(
+        template, None, dict(zip(_sectionNames(template), shown)))
+
+@lru_cache(maxsize=TEMPLATE_CACHE)
+def _tokens(template):
+    """TEMPLATE split into text and (tag, type, name) tuples, or None if
+    render_tags() wouldn't replace the tags one by one where they are."""
+    tokens = []
+    last = 0
+    for m in Template(template).tag_re.finditer(template):
+        tag, tag_type, tag_name = m.group(0, 1, 2)
+        tokens.append(template[last:m.start()])
+        tokens.append((tag, tag_type, tag_name.strip()))
+        last = m.end()
+    tokens.append(template[last:])
+    counts = Counter(t[0] for t in tokens if t.__class__ is tuple)
+    if len(counts) >= MAX_TAGS:
+        return None
+    # a tag that's also part of another one is replaced in both
+    for tag, count in counts.items():
+        if template.count(tag) != count:
+            return None
+    return tokens
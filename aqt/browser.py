@@ -17,6 +17,7 @@ import aqt.forms
 from anki.utils import fmtTimeSpan, ids2str, htmlToTextLine, \
     isWin, intTime, \
     isMac, bodyClass
+from anki.cardrows import CardRows
 from aqt.utils import saveGeom, restoreGeom, saveSplitter, restoreSplitter, \
     saveHeader, restoreHeader, saveState, restoreState, getTag, \
     showInfo, askUser, tooltip, openHelp, showWarning, shortcut, mungeQA, \
@@ -41,21 +42,24 @@ class DataModel(QAbstractTableModel):
         self.activeCols = self.col.conf.get(
             "activeCols", ["noteFld", "template", "cardDue", "deck"])
         self.cards = []
-        self.cardObjs = {}
+        self.rows = CardRows(self.col)
+        # renders the question and answer columns after the rows are shown
+        self.qaTimer = QTimer(browser)
+        self.qaTimer.setSingleShot(True)
+        self.qaTimer.timeout.connect(self.onRenderQA)
+        # the rest of the last search's results, see search()
+        self._search = None
+        self._reading = False
 
     def getCard(self, index):
-        id = self.cards[index.row()]
-        if not id in self.cardObjs:
-            self.cardObjs[id] = self.col.getCard(id)
-        return self.cardObjs[id]
+        return self.col.getCard(self.cards[index.row()])
+
+    def getRow(self, index):
+        "The anki.cardrows.CardRow at INDEX, which is cheaper than the card."
+        return self.rows.row(self.cards, index.row())
 
     def refreshNote(self, note):
-        refresh = False
-        for c in note.cards():
-            if c.id in self.cardObjs:
-                del self.cardObjs[c.id]
-                refresh = True
-        if refresh:
+        if self.rows.invalidate(c.id for c in note.cards()):
             self.layoutChanged.emit()
 
     # Model interface
@@ -78,9 +82,7 @@ class DataModel(QAbstractTableModel):
             if self.activeCols[index.column()] not in (
                 "question", "answer", "noteFld"):
                 return
-            row = index.row()
-            c = self.getCard(index)
-            t = c.template()
+            t = self.rows.template(self.getRow(index))
             if not t.get("bfont"):
                 return
             f = QFont()
@@ -124,6 +126,13 @@ class DataModel(QAbstractTableModel):
     ######################################################################
 
     def search(self, txt):
+        if self._reading:
+            # we were called from the progress handler while the last search
+            # was being read; stop it, and search once it has unwound
+            self.col.db.interrupt()
+            self.browser.mw.progress.timer(0, lambda: self.search(txt), False)
+            return
+        self.cancelSearch()
         self.beginReset()
         t = time.time()
         # the db progress handler may cause a refresh, so we need to zero out
@@ -131,8 +140,11 @@ class DataModel(QAbstractTableModel):
         self.cards = []
         invalid = False
         try:
-            self.cards = self.col.findCards(txt, order=True)
+            # show the first page of results now, and the rest as they're read
+            self._search = self.col.iterFindCards(txt, order=True)
+            self.cards = list(next(self._search, []))
         except Exception as e:
+            self._search = None
             if str(e) == "invalidSearch":
                 self.cards = []
                 invalid = True
@@ -140,10 +152,55 @@ class DataModel(QAbstractTableModel):
                 raise
         #print "fetch cards in %dms" % ((time.time() - t)*1000)
         self.endReset()
+        if self._search:
+            self.browser.mw.progress.timer(0, self.onSearchPage, False)
 
         if invalid:
             showWarning(_("Invalid search - please check for typing mistakes."))
 
+    def onSearchPage(self):
+        if self._readPage():
+            self.browser.updateTitle()
+            self.browser.mw.progress.timer(0, self.onSearchPage, False)
+
+    def _readPage(self):
+        "Add the next page of search results. False when there are no more."
+        search = self._search
+        if not search:
+            return False
+        self._reading = True
+        try:
+            ids = next(search, None)
+        finally:
+            self._reading = False
+        if search is not self._search:
+            # replaced by another search in the meantime
+            return False
+        if not ids:
+            self._search = None
+            return False
+        start = len(self.cards)
+        self.beginInsertRows(QModelIndex(), start, start + len(ids) - 1)
+        self.cards.extend(ids)
+        self.endInsertRows()
+        if self.focusedCard in ids:
+            self.browser.form.tableView.selectRow(
+                start + ids.index(self.focusedCard))
+            self.focusedCard = None
+        return True
+
+    def finishSearch(self):
+        "Read the rest of the results of the last search."
+        while self._readPage():
+            pass
+        self.browser.updateTitle()
+
+    def cancelSearch(self):
+        "Stop reading the results of the last search."
+        if self._search:
+            self._search.close()
+            self._search = None
+
 
     def reset(self):
         self.beginReset()
@@ -155,7 +212,7 @@ class DataModel(QAbstractTableModel):
         self.browser.mw.progress.start()
         self.saveSelection()
         self.beginResetModel()
-        self.cardObjs = {}
+        self.rows.clear()
 
     def endReset(self):
         t = time.time()
@@ -167,6 +224,7 @@ class DataModel(QAbstractTableModel):
         self.browser.editor.saveNow(self._reverse)
 
     def _reverse(self):
+        self.finishSearch()
         self.beginReset()
         self.cards.reverse()
         self.endReset()
@@ -230,20 +288,21 @@ class DataModel(QAbstractTableModel):
         return self.activeCols[column]
 
     def columnData(self, index):
-        row = index.row()
         col = index.column()
         type = self.columnType(col)
-        c = self.getCard(index)
-        if type == "question":
-            return self.question(c)
-        elif type == "answer":
-            return self.answer(c)
+        c = self.getRow(index)
+        if type in ("question", "answer"):
+            qa = self.rows.qa(self.cards, index.row())
+            if not qa:
+                # render it once the visible rows are shown
+                self.qaTimer.start(0)
+                return ""
+            return qa[0] if type == "question" else qa[1]
         elif type == "noteFld":
-            f = c.note()
-            return htmlToTextLine(f.fields[self.col.models.sortIdx(f.model())])
+            return htmlToTextLine(self.rows.sortField(c))
         elif type == "template":
-            t = c.template()['name']
-            if c.model()['type'] == MODEL_CLOZE:
+            t = self.rows.template(c)['name']
+            if self.rows.model(c)['type'] == MODEL_CLOZE:
                 t += " %d" % (c.ord+1)
             return t
         elif type == "cardDue":
@@ -256,9 +315,9 @@ class DataModel(QAbstractTableModel):
                 t = "(" + t + ")"
             return t
         elif type == "noteCrt":
-            return time.strftime("%Y-%m-%d", time.localtime(c.note().id/1000))
+            return time.strftime("%Y-%m-%d", time.localtime(c.nid/1000))
         elif type == "noteMod":
-            return time.strftime("%Y-%m-%d", time.localtime(c.note().mod))
+            return time.strftime("%Y-%m-%d", time.localtime(c.nmod))
         elif type == "cardMod":
             return time.strftime("%Y-%m-%d", time.localtime(c.mod))
         elif type == "cardReps":
@@ -266,9 +325,9 @@ class DataModel(QAbstractTableModel):
         elif type == "cardLapses":
             return str(c.lapses)
         elif type == "noteTags":
-            return " ".join(c.note().tags)
+            return " ".join(c.tags.split())
         elif type == "note":
-            return c.model()['name']
+            return self.rows.model(c)['name']
         elif type == "cardIvl":
             if c.type == 0:
                 return _("(new)")
@@ -288,20 +347,14 @@ class DataModel(QAbstractTableModel):
             # normal deck
             return self.browser.mw.col.decks.name(c.did)
 
-    def question(self, c):
-        return htmlToTextLine(c.q(browser=True))
-
-    def answer(self, c):
-        if c.template().get('bafmt'):
-            # they have provided a template, use it verbatim
-            c.q(browser=True)
-            return htmlToTextLine(c.a())
-        # need to strip question from answer
-        q = self.question(c)
-        a = htmlToTextLine(c.a())
-        if a.startswith(q):
-            return a[len(q):].strip()
-        return a
+    def onRenderQA(self):
+        rows = self.rows.renderPending(self.cards)
+        if rows:
+            self.dataChanged.emit(
+                self.index(min(rows), 0),
+                self.index(max(rows), len(self.activeCols) - 1))
+        if self.rows.hasPending():
+            self.qaTimer.start(0)
 
     def nextDue(self, c, index):
         if c.odid:
@@ -322,9 +375,7 @@ class DataModel(QAbstractTableModel):
         if type != "noteFld":
             return False
 
-        row = index.row()
-        c = self.getCard(index)
-        nt = c.note().model()
+        nt = self.rows.model(self.getRow(index))
         return nt['flds'][self.col.models.sortIdx(nt)]['rtl']
 
 # Line painter
@@ -350,7 +401,7 @@ class StatusDelegate(QItemDelegate):
     def paint(self, painter, option, index):
         self.browser.mw.progress.blockUpdates = True
         try:
-            c = self.model.getCard(index)
+            c = self.model.getRow(index)
         except:
             # in the the middle of a reset; return nothing so this row is not
             # rendered until we have a chance to reset the model
@@ -362,9 +413,10 @@ class StatusDelegate(QItemDelegate):
             option.direction = Qt.RightToLeft
 
         col = None
-        if c.userFlag() > 0:
-            col = flagColours[c.userFlag()]
-        elif c.note().hasTag("Marked"):
+        flag = c.flags & 0b111
+        if flag > 0:
+            col = flagColours[flag]
+        elif self.browser.col.tags.inList("Marked", c.tags.split()):
             col = COLOUR_MARKED
         elif c.queue == -1:
             col = COLOUR_SUSPENDED
@@ -506,6 +558,7 @@ class Browser(QMainWindow):
 
     def _closeWindow(self):
         self._cancelPreviewTimer()
+        self.model.cancelSearch()
         self.editor.cleanup()
         saveSplitter(self.form.splitter, "editor3")
         saveGeom(self, "editor")
@@ -1895,6 +1948,7 @@ update cards set usn=?, mod=?, did=? where id in """ + scids,
                   QItemSelectionModel.Rows)
 
     def onLastCard(self):
+        self.model.finishSearch()
         sm = self.form.tableView.selectionModel()
         idx = sm.currentIndex()
         self._moveCur(
@@ -1917,6 +1971,7 @@ update cards set usn=?, mod=?, did=? where id in """ + scids,
         self.form.tableView.setFocus()
 
     def focusCid(self, cid):
+        self.model.finishSearch()
         try:
             row = self.model.cards.index(cid)
         except:
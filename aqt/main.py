@@ -14,6 +14,7 @@ from threading import Thread
 from send2trash import send2trash
 from aqt.qt import *
 from anki import Collection
+from anki.journal import AnswerJournal
 from anki.utils import isWin, isMac, intTime, splitFields, ids2str, \
     devMode
 from anki.hooks import runHook, addHook, runFilter
@@ -355,7 +356,12 @@ Debug info:
     def _loadCollection(self):
         cpath = self.pm.collectionPath()
 
-        self.col = Collection(cpath, log=True)
+        self.col = Collection(cpath, log=True,
+                              searchIndex=self.pm.profile.get("searchIndex", True))
+        if self.pm.profile.get("answerJournal"):
+            self.col.journal = AnswerJournal(self.col)
+        if self.pm.profile.get("watchMedia", True):
+            self.col.media.startWatching()
 
         self.setEnabled(True)
         self.progress.setupDB(self.col.db)
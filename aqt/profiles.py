@@ -51,6 +51,12 @@ profileConf = dict(
     # not exposed in gui
     deleteMedia=False,
     preserveKeyboard=True,
+    # journal answers and save every few of them
+    answerJournal=False,
+    # index note text for searching, in a file next to the collection
+    searchIndex=True,
+    # have the os report changes to the media folder, instead of scanning it
+    watchMedia=True,
     # syncing
     syncKey=None,
     syncMedia=True,
@@ -3,7 +3,7 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 from aqt.qt import *
-import os, time
+import os, time, json
 from aqt.utils import saveGeom, restoreGeom, maybeHideClose, addCloseShortcut, \
     tooltip, getSaveFile
 import aqt
@@ -23,6 +23,7 @@ class DeckStats(QDialog):
         self.form = aqt.forms.stats.Ui_Dialog()
         self.oldPos = None
         self.wholeCollection = False
+        self.thread = None
         self.setMinimumWidth(700)
         f = self.form
         f.setupUi(self)
@@ -44,6 +45,8 @@ class DeckStats(QDialog):
         self.activateWindow()
 
     def reject(self):
+        if self.thread:
+            self.thread.wait()
         saveGeom(self, self.name)
         aqt.dialogs.markClosed("DeckStats")
         QDialog.reject(self)
@@ -82,7 +85,45 @@ class DeckStats(QDialog):
         self.mw.progress.start(immediate=True, parent=self)
         stats = self.mw.col.stats()
         stats.wholeCollection = self.wholeCollection
-        self.report = stats.report(type=self.period)
-        self.form.web.stdHtml("<html><body>"+self.report+"</body></html>",
+        # show empty sections, and fill them in as they're built
+        self.header = stats.reportHeader()
+        self.sections = [""] * len(stats.sections())
+        self.report = None
+        body = self.header + "".join(
+            "<div id=section%d></div>" % n for n in range(len(self.sections)))
+        self.form.web.stdHtml("<html><body><center>"+body+"</center></body></html>",
                               js=["jquery.js", "jquery.canvaswrapper.js", "jquery.colorhelpers.js", "jquery.flot.js", "jquery.flot.uiConstants.js", "jquery.flot.browser.js", "jquery.flot.saturated.js", "jquery.flot.drawSeries.js", "jquery.flot.axislabels.js", "jquery.flot.logaxis.js", "jquery.flot.legend.js", "jquery.flot.pie.js"])
+        self.thread = StatsThread(stats.reportSections(type=self.period))
+        self.thread.section.connect(self.onSection)
+        self.thread.finished.connect(self.onFinished)
+        self.thread.start()
+
+    def onSection(self, n, html):
+        self.sections[n] = html
+        self.form.web.eval("$('#section%d').replaceWith(%s);" % (
+            n, json.dumps(html)))
+
+    def onFinished(self):
+        thread = self.thread
+        self.thread = None
         self.mw.progress.finish()
+        if thread.error:
+            raise thread.error
+        self.report = "<center>%s</center>" % (
+            self.header + "".join(self.sections))
+
+class StatsThread(QThread):
+
+    section = pyqtSignal(int, str)
+
+    def __init__(self, sections):
+        QThread.__init__(self)
+        self.sections = sections
+        self.error = None
+
+    def run(self):
+        try:
+            for n, html in self.sections:
+                self.section.emit(n, html)
+        except Exception as e:
+            self.error = e
@@ -0,0 +1,53 @@
+from anki.cardrows import CardRows
+from anki.utils import htmlToTextLine
+from tests.shared import getEmptyCol
+
+
+def _fill(col, count):
+    for i in range(count):
+        f = col.newNote()
+        f['Front'] = "<b>front</b> %d" % i
+        f['Back'] = "back %d" % i
+        col.addNote(f)
+    return sorted(col.db.list("select id from cards"))
+
+
+def test_rows_match_cards():
+    col = getEmptyCol()
+    ids = _fill(col, 25)
+    rows = CardRows(col, page=10, size=15)
+    for n, id in enumerate(ids):
+        r = rows.row(ids, n)
+        c = col.getCard(id)
+        for k in ("id", "nid", "did", "ord", "queue", "due", "mod", "flags"):
+            assert getattr(r, k) == getattr(c, k)
+        assert r.flds == c.note().joinedFields()
+        assert rows.sortField(r) == c.note()['Front']
+        assert len(rows._rows) <= 15
+
+
+def test_rows_read_a_page_at_a_time():
+    col = getEmptyCol()
+    ids = _fill(col, 25)
+    rows = CardRows(col, page=10)
+    rows.row(ids, 12)
+    assert set(rows._rows) == set(ids[10:20])
+    assert rows.invalidate([ids[15]])
+    assert ids[15] not in rows._rows
+    assert not rows.invalidate([ids[15], ids[22]])
+
+
+def test_qa_rendered_when_pending():
+    col = getEmptyCol()
+    ids = _fill(col, 5)
+    rows = CardRows(col)
+    assert rows.qa(ids, 1) is None
+    assert rows.qa(ids, 3) is None
+    # the most recently requested first
+    assert rows.renderPending(ids, count=1) == [3]
+    assert rows.renderPending(ids) == [1]
+    assert not rows.hasPending()
+    c = col.getCard(ids[3])
+    q = htmlToTextLine(c.q(browser=True))
+    a = htmlToTextLine(c.a())
+    assert rows.qa(ids, 3) == (q, a[len(q):].strip())
@@ -0,0 +1,73 @@
+import copy
+
+from tests.shared import getEmptyCol
+
+
+def add_note(col, front):
+    note = col.newNote()
+    note['Front'] = front
+    col.addNote(note)
+    return note
+
+
+def test_same_card_and_note_are_returned_until_the_db_changes():
+    # ARRANGE
+    col = getEmptyCol()
+    cid = add_note(col, "one").cards()[0].id
+    card = col.getCard(cid)
+
+    # ACT / ASSERT
+    assert col.getCard(cid) is card
+    assert col.getCard(cid).note() is col.getNote(card.nid)
+    card.due = 5
+    card.flush()
+    # still what's in the db
+    assert col.getCard(cid) is card
+    col.db.execute("update cards set due = 10 where id = ?", cid)
+    assert col.getCard(cid) is not card
+    assert col.getCard(cid).due == 10
+
+
+def test_reloaded_note_is_read_from_the_db():
+    # ARRANGE
+    col = getEmptyCol()
+    card = add_note(col, "one").cards()[0]
+    note = card.note()
+
+    # ACT
+    note['Front'] = "unsaved"
+    reloaded = card.note(reload=True)
+
+    # ASSERT
+    assert reloaded is not note
+    assert reloaded['Front'] == "one"
+    assert col.getNote(card.nid) is reloaded
+
+def test_undo_and_rollback_are_not_hidden_by_the_identity_map():
+    # ARRANGE
+    col = getEmptyCol()
+    add_note(col, "one")
+    col.reset()
+    card = col.sched.getCard()
+    queue = card.queue
+    col.save()
+
+    # ACT
+    col.sched.answerCard(card, 3)
+    col.undo()
+    col.getCard(card.id).did = 100
+
+    # ASSERT
+    assert col.getCard(card.id).queue == queue
+    col.rollback()
+    assert col.getCard(card.id).did == 1
+
+
+def test_cards_and_notes_have_no_dict():
+    col = getEmptyCol()
+    note = add_note(col, "one")
+    card = note.cards()[0]
+    assert not hasattr(card, "__dict__")
+    assert not hasattr(note, "__dict__")
+    assert copy.copy(card).id == card.id
+    assert "'nid'" in repr(card)
@@ -0,0 +1,58 @@
+from anki.utils import ids2str
+from tests.shared import getEmptyCol
+
+
+def test_long_id_lists_are_bound_as_parameters():
+    # ARRANGE
+    col = getEmptyCol()
+    ids = list(range(1, 101))
+    col.db.executemany("insert into graves values (?, ?, ?)", [(0, oid, 0) for oid in ids])
+
+    # ACT
+    sql, args, kwargs, write = col.db._prepare(
+        "select count() from graves where usn = ? and oid in %s and type = ?" % ids2str(ids),
+        (0, 0), {})
+    count = col.db.scalar(
+        "select count() from graves where usn = ? and oid in %s and type = ?" % ids2str(ids[:50]), 0, 0)
+    named = col.db.scalar(
+        "select count() from graves where oid not in %s and type = :type" % ids2str(ids[:50]), type=0)
+
+    # ASSERT
+    assert ids2str(ids) not in sql
+    assert args == [0, "[%s]" % ",".join(str(i) for i in ids), 0]
+    assert not write
+    assert count == 50
+    assert named == 50
+
+
+def test_write_detection():
+    col = getEmptyCol()
+    col.db.mod = False
+
+    col.db.execute("select 1")
+    assert not col.db.mod
+
+    col.db.execute("  update col set mod = mod")
+    assert col.db.mod
+
+
+def test_id_set_is_usable_after_in_and_released():
+    # ARRANGE
+    col = getEmptyCol()
+    ids = list(range(1, 1001))
+    col.db.executemany("insert into graves values (?, ?, ?)", [(0, oid, 0) for oid in ids])
+
+    # ACT
+    with col.db.idSet(ids[:500]) as sids:
+        count = col.db.scalar("select count() from graves where oid in %s" % sids)
+        with col.db.idSet(ids[:10]) as small:
+            small_count = col.db.scalar("select count() from graves where oid in %s" % small)
+    with col.db.idSet(ids[500:600]) as reused:
+        reused_count = col.db.scalar("select count() from graves where oid in %s" % reused)
+
+    # ASSERT
+    assert count == 500
+    assert small == ids2str(ids[:10])
+    assert small_count == 10
+    assert reused == sids
+    assert reused_count == 100
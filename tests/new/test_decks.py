@@ -25,4 +25,110 @@ def test_flatten():
 
     # ASSERT
     assert note1.cards()[0].did == parent_id
-    assert note2.cards()[0].did == parent_id
\ No newline at end of file
+    assert note2.cards()[0].did == parent_id
+
+def test_hierarchy_follows_add_rename_and_remove():
+    # ARRANGE
+    col = getEmptyCol()
+    parent_id = col.decks.id("deck1")
+    child_id = col.decks.id("deck1::child")
+    assert [p['id'] for p in col.decks.parents(child_id)] == [parent_id]
+
+    # ACT
+    grandchild_id = col.decks.id("deck1::child::grandchild")
+    col.decks.rename(col.decks.get(child_id), "deck2::child")
+    other_parent_id = col.decks.byName("deck2")['id']
+
+    # ASSERT
+    assert [p['id'] for p in col.decks.parents(grandchild_id)] == [other_parent_id, child_id]
+    assert col.decks.children(parent_id) == []
+    assert [did for name, did in col.decks.children(other_parent_id)] == [child_id, grandchild_id]
+    assert col.decks.childMap()[other_parent_id] == {child_id: {grandchild_id: {}}}
+
+    # ACT
+    col.decks.rem(child_id)
+
+    # ASSERT
+    assert col.decks.children(other_parent_id) == []
+    assert "deck2::child" not in col.decks.nameMap()
+    assert col.decks.id("DECK1", create=False) == parent_id
+
+
+
+def test_recreated_parent_adopts_orphaned_children():
+    # ARRANGE
+    col = getEmptyCol()
+    parent_id = col.decks.id("deck1")
+    child_id = col.decks.id("deck1::child")
+    col.decks.rem(parent_id, childrenToo=False)
+
+    # ACT
+    col.decks.checkIntegrity()
+    parent_id = col.decks.byName("deck1")['id']
+
+    # ASSERT
+    assert [did for name, did in col.decks.children(parent_id)] == [child_id]
+    assert col.decks.childMap()[parent_id] == {child_id: {}}
+    assert [p['id'] for p in col.decks.parents(child_id)] == [parent_id]
+
+def reopen(col, close):
+    from anki import Collection
+    path = col.path
+    if close:
+        col.close()
+    else:
+        # as if the program had crashed after saving
+        col.db.close()
+    return Collection(path)
+
+
+def test_changed_decks_are_saved_without_rewriting_the_col_row():
+    # ARRANGE
+    col = getEmptyCol()
+    did = col.decks.id("deck1")
+    col.save()
+    legacy = col.db.first("select decks, dconf, models, tags from col")
+
+    # ACT
+    deck = col.decks.get(did)
+    deck['revToday'] = [col.sched.today, 5]
+    col.decks.save(deck)
+    conf = col.decks.getConf(1)
+    conf['rev']['perDay'] = 123
+    col.decks.save(conf)
+    col.tags.register(["newtag"])
+    col.models.save(col.models.current())
+    col.save()
+
+    # ASSERT
+    assert col.db.first("select decks, dconf, models, tags from col") == legacy
+    col = reopen(col, close=False)
+    assert col.decks.get(did)['revToday'][1] == 5
+    assert col.decks.getConf(1)['rev']['perDay'] == 123
+    assert "newtag" in col.tags.all()
+    # closing folds the changes back into the col row
+    col = reopen(col, close=True)
+    assert not col.db.scalar("select 1 from sqlite_master where name = 'registry'")
+    assert col.decks.get(did)['revToday'][1] == 5
+    assert col.decks.getConf(1)['rev']['perDay'] == 123
+    assert "newtag" in col.tags.all()
+
+
+def test_registry_is_ignored_after_another_client_saves():
+    # ARRANGE
+    col = getEmptyCol()
+    did = col.decks.id("deck1")
+    col = reopen(col, close=True)
+    deck = col.decks.get(did)
+    deck['name'] = "renamed"
+    col.decks.save(deck)
+    col.save()
+
+    # ACT
+    # a client that only knows about the col row
+    col.db.execute("update col set mod = mod + 1")
+    col.db.commit()
+    col = reopen(col, close=False)
+
+    # ASSERT
+    assert col.decks.get(did)['name'] == "deck1"
@@ -0,0 +1,69 @@
+from anki.fairqueue import FairQueue
+
+
+def test_single_deck_keeps_order():
+    cards = [(cid, 1) for cid in range(1, 7)]
+
+    assert list(FairQueue(cards)) == list(range(1, 7))
+
+
+def test_cards_are_spread_by_deck_share():
+    # ARRANGE
+    cards = [(cid, 1) for cid in range(1, 7)] + [(cid, 2) for cid in range(7, 10)]
+
+    # ACT
+    results = list(FairQueue(cards))
+
+    # ASSERT
+    # every card is returned once and each deck keeps its own order
+    assert sorted(results) == list(range(1, 10))
+    assert [cid for cid in results if cid < 7] == list(range(1, 7))
+    assert [cid for cid in results if cid >= 7] == list(range(7, 10))
+    # the smaller deck is spread through the queue, not appended to it
+    assert results == [1, 7, 2, 3, 8, 4, 5, 9, 6]
+
+
+def test_extend_keeps_cards_already_handed_out():
+    # ARRANGE
+    queue = FairQueue([(1, 1), (2, 1), (3, 2)])
+    first = queue.pop()
+
+    # ACT
+    queue.extend([(4, 2), (5, 3)])
+    rest = list(queue)
+
+    # ASSERT
+    assert len(queue) == 0
+    assert sorted([first] + rest) == [1, 2, 3, 4, 5]
+    assert rest.index(3) < rest.index(4)
+
+
+def test_subdecks_are_spread_within_their_parent():
+    # ARRANGE
+    # decks 2 and 3 are subdecks of 1, deck 4 is on its own
+    cards = [(1, 2), (2, 3), (3, 4), (4, 4)]
+    parents = {2: [1], 3: [1]}
+
+    # ACT
+    flat = list(FairQueue(cards))
+    nested = list(FairQueue(cards, parents))
+
+    # ASSERT
+    # deck 1 and deck 4 take turns, rather than all three decks
+    assert flat == [3, 1, 2, 4]
+    assert nested == [1, 3, 2, 4]
+
+
+def test_cards_are_not_delayed_too_far():
+    # ARRANGE
+    # a small deck's cards all sort first
+    cards = [(cid, 1) for cid in range(10)] + [(cid, 2) for cid in range(10, 100)]
+
+    # ACT
+    results = list(FairQueue(cards))
+
+    # ASSERT
+    # evenly spread they'd take the whole queue, but none is handed out
+    # more than sqrt(100) places late
+    assert max(results.index(cid) - cid for cid in range(10)) <= 10
+    assert results.index(9) < 20
@@ -0,0 +1,208 @@
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+import anki.find
+import anki.searchindex
+from anki.utils import ids2str, joinFields
+from tests.shared import getEmptyCol, getEmptyDeckWith
+
+QUERIES = [
+    "dog", "DOG", "-dog", "dog cat", "dog or cat", "do*g", "d_g", "cat_",
+    "front:dog", "front:*dog*", "back:*cat", "back:c_t*", "front:ab",
+    "'the dog'", "zebra", "dog -back:*cat*", "\\*star", "ÉCOLE", "école",
+    "x\\_y", "\\_y",
+]
+
+FIELDS = [
+    ("the dog", "a cat"), ("DOG", "cats"), ("hot dog", "bobcat"),
+    ("doug", "ct"), ("*star", "x_y"), ("école", "école"), ("ab", "abc"),
+    ("<b>d</b>og", "scat"),
+]
+
+
+def _fill(col):
+    for front, back in FIELDS:
+        f = col.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        col.addNote(f)
+
+
+def _results(col):
+    return [sorted(col.db.list(
+        "select n.flds from cards c, notes n where c.nid = n.id and c.id in "
+        + ids2str(col.findCards(q)))) for q in QUERIES]
+
+
+@patch.object(anki.searchindex, "MAX_SHARE", 1)
+def test_index_matches_scan():
+    plain = getEmptyCol()
+    indexed = getEmptyDeckWith(searchIndex=True)
+    assert indexed.searchIndex
+    for col in plain, indexed:
+        _fill(col)
+    assert _results(indexed) == _results(plain)
+    # edit, delete and replace notes after the index was built
+    for col in plain, indexed:
+        nids = sorted(col.db.list("select id from notes"))
+        n = col.getNote(nids[0])
+        n['Front'] = "zebra"
+        n.flush()
+        col.remNotes([nids[1]])
+        flds, mid = col.db.first(
+            "select flds, mid from notes where id = ?", nids[2])
+        col.db.execute(
+            "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
+            nids[2], "guid", mid, 0, -1, "", joinFields(["cat", "dog"]),
+            "cat", 0, 0, "")
+        col.findReplace(nids, "cat", "dog")
+    assert _results(indexed) == _results(plain)
+
+
+@patch.object(anki.searchindex, "MAX_SHARE", 1)
+def test_index_rebuilt_when_stale():
+    col = getEmptyDeckWith(searchIndex=True)
+    _fill(col)
+    assert len(col.findCards("dog")) == 4
+    col.close()
+    col.reopen()
+    col.load()
+    assert col.searchIndex._ready
+    col.close()
+    # changed by another client
+    db = sqlite3.connect(col.path)
+    db.execute("update notes set flds = 'dog', sfld = 'dog'")
+    db.execute("update col set mod = mod + 1")
+    db.commit()
+    db.close()
+    col.reopen()
+    col.load()
+    assert not col.searchIndex._ready
+    assert len(col.findCards("dog")) == len(FIELDS)
+    # changes rolled back are removed from the index too
+    col.db.execute("update notes set flds = 'cat', sfld = 'cat'")
+    assert len(col.findCards("cat")) == len(FIELDS)
+    col.rollback()
+    assert col.findCards("cat") == []
+    col.db.execute("update notes set flds = 'cat', sfld = 'cat'")
+    assert len(col.findCards("cat")) == len(FIELDS)
+
+
+@patch.object(anki.searchindex, "MAX_SHARE", 0.2)
+def test_index_skipped_for_common_text():
+    col = getEmptyDeckWith(searchIndex=True)
+    _fill(col)
+    assert col.searchIndex.candidates("%dog%") is None
+    assert col.searchIndex.candidates("%école%") == col.db.list(
+        "select id from notes where flds like '%école%'")
+
+
+def test_repeated_search_is_cached():
+    col = getEmptyCol()
+    _fill(col)
+    with patch.object(anki.find.Finder, "_where", autospec=True,
+                      side_effect=anki.find.Finder._where) as where:
+        res = col.findCards("dog", order=True)
+        assert col.findCards("dog", order=True) == res
+        assert where.call_count == 1
+        # a write to the db invalidates it
+        n = col.getNote(col.db.scalar("select id from notes where sfld = 'doug'"))
+        n['Back'] = "dog"
+        n.flush()
+        assert len(col.findCards("dog", order=True)) == len(res) + 1
+        assert where.call_count == 2
+    # as does renaming a deck
+    assert len(col.findCards("deck:default")) == len(FIELDS)
+    col.decks.rename(col.decks.get(1), "foo")
+    with pytest.raises(Exception):
+        col.findCards("deck:default")
+
+
+def test_added_terms_narrow_cached_results():
+    col = getEmptyCol()
+    _fill(col)
+    col.conf['sortType'] = "noteFld"
+    pairs = [
+        ("dog", "dog cat"), ("dog", "dog -back:*cat*"), ("dog", "dog (cat or scat)"),
+        ("dog", "dog or cat"), ("(dog", "(dog cat)"), ("dog -", "dog -cat"),
+        ("-dog", "-dog ab"), ("deck:*", "deck:* ab"),
+        ("dog or ab", "dog or ab abc"), ("(dog or ab)", "(dog or ab) abc"),
+    ]
+    for prev, query in pairs:
+        for find in (lambda q: col.findCards(q, order=True), col.findNotes):
+            col._searches.clear()
+            full = find(query)
+            col._searches.clear()
+            find(prev)
+            assert find(query) == full
+    with patch.object(anki.find.Finder, "_where", autospec=True,
+                      side_effect=anki.find.Finder._where) as where:
+        tokens = lambda: where.call_args[0][1]
+        col.findCards("dog")
+        col.findCards("dog cat")
+        assert tokens() == ["cat"]
+        col.findCards("dog or cat")
+        assert tokens() == ["dog", "or", "cat"]
+        col.findCards("dog or cat ab")
+        assert tokens() == ["dog", "or", "cat", "ab"]
+        col.findCards("(dog or cat)")
+        col.findCards("(dog or cat) ab")
+        assert tokens() == ["ab"]
+
+
+def test_id_sets_dont_invalidate_caches():
+    col = getEmptyCol()
+    for i in range(30):
+        f = col.newNote()
+        f['Front'] = "dog %d" % i
+        col.addNote(f)
+    res = col.findCards("dog")
+    note = col.getNote(col.getCard(res[0]).nid)
+    # narrowing the results loads them into a temp table
+    with patch.object(col.db, "idSet", wraps=col.db.idSet) as idSet:
+        assert col.findCards("dog 1*") == col.findCards("dog front:*1*")
+        assert idSet.called
+    with patch.object(anki.find.Finder, "_where") as where:
+        assert col.findCards("dog") == res
+        assert not where.called
+    assert col.getNote(note.id) is note
+
+
+def test_iter_cards_streams_in_pages():
+    col = getEmptyCol()
+    _fill(col)
+    for backwards in (False, True):
+        col.conf['sortType'] = "cardDue"
+        col.conf['sortBackwards'] = backwards
+        col._searches.clear()
+        pages = list(col.iterFindCards("", order=True, page=3))
+        assert [len(p) for p in pages] == [3, 3, 2]
+        col._searches.clear()
+        assert sum(pages, []) == col.findCards("", order=True)
+    # a finished stream is cached
+    assert list(col.iterFindCards("", order=True, page=3)) == [sum(pages, [])]
+    with pytest.raises(Exception):
+        list(col.iterFindCards("deck:missing"))
+    # a stream the collection changed under isn't cached
+    col._searches.clear()
+    stream = col.iterFindCards("dog", page=2)
+    first = next(stream)
+    note = col.getCard(first[0]).note()
+    note['Front'] = "cat"
+    note.flush()
+    streamed = first + sum(stream, [])
+    assert first[0] not in col.findCards("dog")
+    assert len(col.findCards("dog")) == len(streamed) - 1
+
+
+def test_iter_cards_stops_when_interrupted():
+    col = getEmptyCol()
+    _fill(col)
+    pages = col.iterFindCards("", page=2)
+    assert len(next(pages)) == 2
+    col.db.interrupt()
+    assert list(pages) == []
+    # the connection is usable again once the statement has stopped
+    assert len(col.findCards("dog")) == 4
@@ -0,0 +1,136 @@
+import gzip
+import http.server
+import os
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from anki.sync import FullSyncer
+from anki.storage import Collection
+from tests.shared import getEmptyCol
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    "A stand-in for AnkiWeb's full sync."
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+        else:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.path, dict(self.headers), body))
+        if self.path.endswith("/upload"):
+            self.server.uploaded = _payload(body)
+            resp = b"OK"
+        else:
+            resp = self.server.download
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, *args):
+        pass
+
+
+def _payload(body):
+    "The data posted in BODY, uncompressed."
+    comp = b'name="c"\r\n\r\n1' in body
+    start = body.index(b"application/octet-stream\r\n\r\n") + 28
+    end = body.rindex(b"\r\n--Anki-sync-boundary--")
+    data = body[start:end]
+    return gzip.decompress(data) if comp else data
+
+
+@contextmanager
+def _server():
+    srv = http.server.HTTPServer(("127.0.0.1", 0), _Handler)
+    srv.requests = []
+    srv.download = b""
+    t = threading.Thread(target=srv.serve_forever)
+    t.start()
+    try:
+        yield srv
+    finally:
+        srv.shutdown()
+        t.join()
+        srv.server_close()
+
+
+def _syncer(col, server):
+    s = FullSyncer(col, "key", None, None)
+    s.syncURL = lambda: "http://127.0.0.1:%d/sync/" % server.server_port
+    return s
+
+
+def _addNotes(col, count):
+    for i in range(count):
+        f = col.newNote()
+        f['Front'] = "front %d" % i
+        f['Back'] = "back %d" % i * 50
+        col.addNote(f)
+    col.save()
+
+
+def test_upload_streams():
+    with _server() as server:
+        col = getEmptyCol()
+        _addNotes(col, 500)
+        assert _syncer(col, server).upload()
+        path, headers, body = server.requests[-1]
+        # the collection is compressed as it's sent
+        assert headers.get("Transfer-Encoding") == "chunked"
+        with open(col.path, "rb") as f:
+            assert server.uploaded == f.read()
+
+
+def test_download_streams():
+    with _server() as server:
+        src = getEmptyCol()
+        _addNotes(src, 500)
+        src.close()
+        with open(src.path, "rb") as f:
+            server.download = f.read()
+        col = getEmptyCol()
+        _addNotes(col, 1)
+        assert _syncer(col, server).download() is None
+        col = Collection(col.path)
+        assert col.noteCount() == 500
+        col.close()
+
+
+def test_download_checked():
+    with _server() as server:
+        src = getEmptyCol()
+        _addNotes(src, 100)
+        src.close()
+        with open(src.path, "rb") as f:
+            data = f.read()
+        col = getEmptyCol()
+        _addNotes(col, 1)
+        path = col.path
+        # cut short
+        server.download = data[:len(data)//2 + 1]
+        with pytest.raises(Exception):
+            _syncer(col, server).download()
+        # not a database
+        server.download = b"x" * 5000
+        with pytest.raises(Exception):
+            _syncer(Collection(path), server).download()
+        # the local collection is untouched
+        assert not os.path.exists(path + ".tmp")
+        col = Collection(path)
+        assert col.noteCount() == 1
+        # a message from the server
+        server.download = b"upgradeRequired"
+        assert _syncer(col, server).download() is None
+        col = Collection(path)
+        assert col.noteCount() == 1
+        col.close()
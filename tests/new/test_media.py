@@ -0,0 +1,100 @@
+import os
+from unittest import SkipTest
+from unittest.mock import patch
+
+from anki.media import MediaManager
+from tests.shared import getEmptyCol
+
+
+def _write(name, data):
+    with open(name, "w") as f:
+        f.write(data)
+
+
+def _hashed():
+    "Patch the media manager's checksums, to record the names read."
+    return patch.object(MediaManager, "_checksum", autospec=True,
+                        side_effect=MediaManager._checksum)
+
+
+def _names(mock):
+    "The names checksummed since MOCK was last reset."
+    return [args[1] for args, kwargs in mock.call_args_list]
+
+
+def _added(col):
+    return set(col.media.db.list(
+        "select fname from media where csum is not null and dirty=1"))
+
+
+@_hashed()
+def test_unchanged_files_not_read(hashed):
+    col = getEmptyCol()
+    for i in range(20):
+        _write("file%d.txt" % i, "data %d" % i)
+    col.media.findChanges()
+    assert hashed.call_count == 20
+    assert len(_added(col)) == 20
+    hashed.reset_mock()
+    col.media.findChanges()
+    assert not hashed.called
+    # an edit is noticed even though the folder's mtime doesn't change
+    col.media.markClean(["file3.txt"])
+    _write("file3.txt", "changed")
+    col.media.findChanges()
+    assert _names(hashed) == ["file3.txt"]
+    assert "file3.txt" in _added(col)
+    # as is a removal
+    os.unlink("file4.txt")
+    col.media.findChanges()
+    assert col.media.syncInfo("file4.txt") == (None, 1)
+
+
+@_hashed()
+def test_touched_file_not_readded(hashed):
+    col = getEmptyCol()
+    _write("foo.txt", "foo")
+    col.media.findChanges()
+    col.media.markClean(["foo.txt"])
+    hashed.reset_mock()
+    # a new mtime with the same contents is checksummed once, and isn't a
+    # change
+    os.utime("foo.txt", (1, 1))
+    col.media.findChanges()
+    col.media.findChanges()
+    assert _names(hashed) == ["foo.txt"]
+    assert not _added(col)
+
+
+@_hashed()
+def test_watcher(hashed):
+    col = getEmptyCol()
+    _write("foo.txt", "foo")
+    if not col.media.startWatching():
+        raise SkipTest("no inotify")
+    col.media.findChanges()
+    assert _names(hashed) == ["foo.txt"]
+    # after the first scan, only the files reported are looked at
+    with patch.object(MediaManager, "_scanFiles", autospec=True,
+                      side_effect=MediaManager._scanFiles) as scanned:
+        col.media.findChanges()
+        assert not scanned.called
+        _write("bar.txt", "bar")
+        os.unlink("foo.txt")
+        col.media.findChanges()
+        scanned.assert_called_once_with(col.media, {"bar.txt", "foo.txt"})
+    assert "bar.txt" in _added(col)
+    assert col.media.syncInfo("foo.txt") == (None, 1)
+    # reopening the collection watches the folder again, after a scan for
+    # what changed while it was closed
+    col.close()
+    _write(os.path.join(col.media.dir(), "baz.txt"), "baz")
+    col.reopen()
+    assert col.media._watcher
+    col.media.findChanges()
+    assert "baz.txt" in _added(col)
+    with patch.object(MediaManager, "_scanFiles", autospec=True,
+                      side_effect=MediaManager._scanFiles) as scanned:
+        col.media.findChanges()
+        assert not scanned.called
+    col.close()
@@ -0,0 +1,103 @@
+import os
+from unittest.mock import patch
+
+import anki.mediarefs
+from anki.mediarefs import _filesInNotes
+from tests.shared import getEmptyCol
+
+
+def _write(name, data="data"):
+    with open(name, "w") as f:
+        f.write(data)
+
+
+def _addNote(col, back):
+    note = col.newNote()
+    note['Front'] = "front"
+    note['Back'] = back
+    col.addNote(note)
+    return note
+
+
+def _rows(col):
+    return col.db.all("select id, mid, flds from notes order by id")
+
+
+def test_check():
+    col = getEmptyCol()
+    _write("used.png")
+    _write("unused.png")
+    _write("_ignored.png")
+    _addNote(col, "<img src='used.png'> [sound:missing.mp3]")
+    os.mkdir("folder")
+    nohave, unused, warnings = col.media.check()
+    assert nohave == ["missing.mp3"]
+    assert unused == ["unused.png"]
+    assert len(warnings) == 1
+    # the names in LOCAL are checked instead of the folder
+    nohave, unused, warnings = col.media.check(local=["used.png", "x.png"])
+    assert (nohave, unused, warnings) == (["missing.mp3"], ["x.png"], [])
+
+
+def test_check_untracked_files():
+    col = getEmptyCol()
+    # files over 100MB aren't synced, but are still there
+    with open("big.mp4", "wb") as f:
+        f.truncate(101*1024*1024)
+    _addNote(col, "[sound:big.mp4]")
+    assert col.media.check() == ([], [], [])
+    assert col.media.syncInfo("big.mp4") == (None, 0)
+
+
+def test_kept_up_to_date():
+    col = getEmptyCol()
+    note = _addNote(col, "<img src='a.png'>")
+    assert col.mediaRefs.names() == {"a.png"}
+    # the notes aren't searched again when nothing changed
+    with patch.object(anki.mediarefs, "_filesIn",
+                      side_effect=anki.mediarefs._filesIn) as searched:
+        assert col.mediaRefs.names() == {"a.png"}
+        assert not searched.called
+        # saving a note updates its references
+        note['Back'] = "<img src='b.png'>"
+        note.flush()
+        assert col.mediaRefs.names() == {"b.png"}
+        assert col.mediaRefs.notesWith(["b.png"]) == [note.id]
+        # as does changing the fields some other way
+        col.db.execute("update notes set flds = ? where id = ?",
+                       "front\x1f<img src='c.png'>", note.id)
+        searched.reset_mock()
+        assert col.mediaRefs.names() == {"c.png"}
+        assert searched.call_count == 1
+    col.remNotes([note.id])
+    assert col.mediaRefs.names() == set()
+
+
+def test_stale_index_rebuilt():
+    col = getEmptyCol()
+    note = _addNote(col, "<img src='a.png'>")
+    assert col.mediaRefs.names() == {"a.png"}
+    col.save()
+    col.reopen()
+    assert col.mediaRefs._ready
+    # a change saved by a client without the triggers
+    col.db.execute("drop trigger temp.media_refs_upd")
+    col.db.execute("update notes set flds = ? where id = ?",
+                   "front\x1f<img src='b.png'>", note.id)
+    col.db.execute("update col set mod = mod + 1")
+    col.db.commit()
+    col.load()
+    assert not col.mediaRefs._ready
+    assert col.mediaRefs.names() == {"b.png"}
+
+
+def test_parallel_matches_serial():
+    col = getEmptyCol()
+    for i in range(30):
+        _addNote(col, "<img src='%d.png'> [sound:%d.mp3]" % (i, i % 7))
+    serial = list(_filesInNotes(col, _rows(col), 30, workers=1))
+    with patch.object(anki.mediarefs, "PARALLEL_MIN", 0), \
+            patch.object(anki.mediarefs, "REFS_CHUNK", 4):
+        parallel = list(_filesInNotes(col, _rows(col), 30, workers=2))
+    assert parallel == serial
+    assert len(serial) == 30
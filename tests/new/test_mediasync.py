@@ -0,0 +1,151 @@
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+
+from anki.consts import SYNC_ZIP_COUNT
+from anki.sync import MediaSyncer
+from anki.utils import checksum
+from tests.shared import getEmptyCol
+
+
+class LocalMediaServer:
+    "Enough of AnkiWeb's media sync to sync against, kept in memory."
+
+    def __init__(self, files=None, zipSize=None, uploadLimit=None):
+        self.usn = 0
+        # fname -> data, or None if deleted
+        self.files = {}
+        # fname -> usn of its last change
+        self.changed = {}
+        self.zipSize = zipSize
+        # files taken from each uploaded zip, if not all of them
+        self.uploadLimit = uploadLimit
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.peak = 0
+        for fname, data in (files or {}).items():
+            self._apply(fname, data)
+
+    def _apply(self, fname, data):
+        self.usn += 1
+        self.files[fname] = data
+        self.changed[fname] = self.usn
+
+    def begin(self):
+        return dict(usn=self.usn)
+
+    def mediaChanges(self, lastUsn):
+        res = []
+        for fname, usn in sorted(self.changed.items(), key=lambda x: x[1]):
+            if usn > lastUsn:
+                data = self.files[fname]
+                res.append([fname, usn, data and checksum(data)])
+        return res
+
+    def downloadFiles(self, files):
+        with self.lock:
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+        # give other downloads a chance to start
+        time.sleep(0.01)
+        f = io.BytesIO()
+        z = zipfile.ZipFile(f, "w")
+        meta = {}
+        sz = 0
+        for c, fname in enumerate(files):
+            z.writestr(str(c), self.files[fname])
+            meta[str(c)] = fname
+            sz += len(self.files[fname])
+            if self.zipSize and sz >= self.zipSize:
+                break
+        z.writestr("_meta", json.dumps(meta))
+        z.close()
+        with self.lock:
+            self.inflight -= 1
+        return f.getvalue()
+
+    def uploadChanges(self, zip):
+        if not isinstance(zip, bytes):
+            zip = zip.read()
+        z = zipfile.ZipFile(io.BytesIO(zip))
+        meta = json.loads(z.read("_meta").decode("utf8"))
+        meta = meta[:self.uploadLimit]
+        for fname, zipname in meta:
+            self._apply(fname, z.read(zipname) if zipname else None)
+        return [len(meta), self.usn]
+
+    def mediaSanity(self, local):
+        present = len([d for d in self.files.values() if d is not None])
+        return "OK" if local == present else "mediaSanity"
+
+
+def _files(count):
+    return dict(("file%d.txt" % i, ("data %d" % i).encode("utf8") * 50)
+                for i in range(count))
+
+
+def _sync(col, server, pipelined):
+    syncer = MediaSyncer(col, server)
+    syncer.pipelined = pipelined
+    return syncer.sync()
+
+
+def _check(col, server):
+    for fname, data in server.files.items():
+        path = os.path.join(col.media.dir(), fname)
+        if data is None:
+            assert not os.path.exists(path)
+        else:
+            with open(path, "rb") as f:
+                assert f.read() == data
+    assert col.media.lastUsn() == server.usn
+    assert not col.media.haveDirty()
+
+
+def test_download_pipelined():
+    files = _files(SYNC_ZIP_COUNT * 5 + 3)
+    server = LocalMediaServer(files, zipSize=5000)
+    col = getEmptyCol()
+    assert _sync(col, server, True) == "OK"
+    _check(col, server)
+    assert col.media.mediaCount() == len(files)
+    assert server.peak > 1
+
+
+def test_download_serial():
+    server = LocalMediaServer(_files(SYNC_ZIP_COUNT * 3), zipSize=5000)
+    col = getEmptyCol()
+    assert _sync(col, server, False) == "OK"
+    _check(col, server)
+    assert server.peak == 1
+
+
+def test_upload():
+    for pipelined in True, False:
+        server = LocalMediaServer(_files(10))
+        col = getEmptyCol()
+        assert _sync(col, server, pipelined) == "OK"
+        # add many files and remove one locally
+        for i in range(SYNC_ZIP_COUNT * 3 + 1):
+            col.media.writeData("new%d.txt" % i, b"new %d" % i)
+        os.unlink(os.path.join(col.media.dir(), "file3.txt"))
+        assert _sync(col, server, pipelined) == "OK"
+        last = SYNC_ZIP_COUNT * 3
+        assert server.files["new%d.txt" % last] == b"new %d" % last
+        assert server.files["file3.txt"] is None
+        _check(col, server)
+        assert _sync(col, server, pipelined) == "noChanges"
+
+
+def test_upload_partly_processed():
+    for pipelined in True, False:
+        server = LocalMediaServer(uploadLimit=3)
+        col = getEmptyCol()
+        for i in range(7):
+            col.media.writeData("new%d.txt" % i, b"new %d" % i)
+        assert _sync(col, server, pipelined) == "OK"
+        assert len(server.files) == 7
+        _check(col, server)
@@ -0,0 +1,53 @@
+import os
+from unittest.mock import patch
+
+import anki.rendering
+from anki.hooks import addHook, remHook
+from tests.shared import getEmptyCol
+
+
+def _fill(col, count):
+    for i in range(count):
+        f = col.newNote()
+        f['Front'] = "front %d <b>x</b>" % i
+        f['Back'] = "back %d" % i
+        f.tags = ["t%d" % (i % 3)]
+        col.addNote(f)
+
+
+_parent = os.getpid()
+
+
+def _failOdd(html, type, fields, model, data, col):
+    if data[0] % 2 and os.getpid() != _parent:
+        raise Exception("needs the main process")
+    return html
+
+
+@patch.object(anki.rendering, "RENDER_CHUNK", 4)
+def test_parallel_render_matches_serial():
+    deck = getEmptyCol()
+    _fill(deck, 30)
+    serial = deck.renderQA(type="all")
+    with patch.object(anki.rendering, "PARALLEL_MIN", 0):
+        assert list(deck.iterRenderQA(type="all", workers=2)) == serial
+        # cards the workers fail on are rendered here
+        addHook("mungeQA", _failOdd)
+        try:
+            assert list(deck.iterRenderQA(type="all", workers=2)) == serial
+        finally:
+            remHook("mungeQA", _failOdd)
+
+
+@patch.object(anki.rendering, "PARALLEL_MIN", 0)
+def test_unpicklable_filters_render_serially():
+    deck = getEmptyCol()
+    _fill(deck, 5)
+    f = lambda html, *args: html + "!"
+    addHook("mungeQA", f)
+    try:
+        qa = list(deck.iterRenderQA(type="all", workers=2))
+    finally:
+        remHook("mungeQA", f)
+    assert len(qa) == 5
+    assert all(x['q'].endswith("!") for x in qa)
@@ -1,3 +1,4 @@
+import os
 from unittest.mock import patch
 
 from anki.consts import NEW_CARDS_RANDOM
@@ -494,3 +495,152 @@ def test_scatter_fairly_cards_from_different_decks_is_used(scatter_fairly_cards_
 
     # ASSERT
     assert [card.id for card in returned_cards] == card_ids
+
+
+def create_review_card_in_deck(collection, did, ivl, late=0):
+    card = create_late_learning_card(collection, ivl, late)
+    card.did = did
+    card.flush()
+    return card
+
+
+def test_rev_queue_respects_parent_deck_limits_in_one_pass():
+    # ARRANGE
+    collection = getEmptyCol()
+    top_id = collection.decks.id("top")
+    limited_id = collection.decks.id("top::limited")
+    child_id = collection.decks.id("top::limited::child")
+    other_id = collection.decks.id("top::other")
+    conf_id = collection.decks.confId("limited")
+    conf = collection.decks.getConf(conf_id)
+    conf['rev']['perDay'] = 2
+    collection.decks.updateConf(conf)
+    collection.decks.setConf(collection.decks.get(limited_id), conf_id)
+    limited_cards = [create_review_card_in_deck(collection, child_id, 10) for _ in range(4)]
+    other_cards = [create_review_card_in_deck(collection, other_id, 10) for _ in range(3)]
+    collection.decks.select(top_id)
+    collection.reset()
+
+    # ACT
+    queue = collection.sched._get_rev_queue_per_subdeck("order by due", 50)
+
+    # ASSERT
+    assert len([cid for cid in queue if cid in {c.id for c in limited_cards}]) == 2
+    assert {c.id for c in other_cards} <= set(queue)
+    assert len(queue) == 5
+
+
+def test_rev_queue_prioritizes_cards_due_today():
+    # ARRANGE
+    collection = getEmptyCol()
+    overdue = create_late_learning_card(collection, 100, 50)
+    today = create_learning_card(collection, 100)
+    collection.reset()
+
+    # ACT
+    queue = collection.sched._get_rev_queue_per_subdeck("order by due", 1)
+    both = collection.sched._get_rev_queue_per_subdeck("order by due", 2)
+
+    # ASSERT
+    assert queue == [today.id]
+    assert both == [today.id, overdue.id]
+
+
+def test_deck_due_tree_counts_subdecks():
+    # ARRANGE
+    collection = getEmptyCol()
+    parent_id = collection.decks.id("parent")
+    child_id = collection.decks.id("parent::child")
+    create_review_card_in_deck(collection, parent_id, 10)
+    create_review_card_in_deck(collection, child_id, 10)
+    create_review_card_in_deck(collection, child_id, 10)
+    new_card = create_new_card(collection)
+    new_card.did = child_id
+    new_card.flush()
+
+    # ACT
+    tree = collection.sched.deckDueTree()
+
+    # ASSERT
+    parent = [node for node in tree if node[1] == parent_id][0]
+    name, did, rev, lrn, new, children = parent
+    assert (rev, lrn, new) == (3, 0, 1)
+    assert children[0][:5] == ("child", child_id, 2, 0, 1)
+
+
+def test_answer_journal_replays_answers_after_a_crash():
+    # ARRANGE
+    from anki import Collection
+    from anki.journal import AnswerJournal
+    collection = getEmptyCol()
+    for _ in range(3):
+        create_learning_card(collection, 10)
+    create_new_card(collection)
+    collection.save()
+    collection.journal = AnswerJournal(collection, batch=100)
+    collection.reset()
+    for ease in (3, 1, 4):
+        card = collection.sched.getCard()
+        collection.sched.answerCard(card, ease)
+    card = collection.sched.getCard()
+    collection.sched.answerCard(card, 2)
+    collection.undo()
+    cards = collection.db.all("select * from cards order by id")
+    revlog = collection.db.all("select * from revlog order by id")
+    counts = collection.decks.get(1)['revToday']
+    assert len(revlog) == 3
+
+    # ACT
+    # lose everything since the last save
+    collection.journal._file.close()
+    collection.journal = None
+    path = collection.path
+    collection.db.rollback()
+    collection.db.close()
+    collection = Collection(path)
+
+    # ASSERT
+    assert collection.db.all("select * from cards order by id") == cards
+    assert collection.db.all("select * from revlog order by id") == revlog
+    assert collection.decks.get(1)['revToday'] == counts
+    assert not os.path.exists(path + "-answers")
+
+
+def test_answer_journal_saves_every_batch():
+    # ARRANGE
+    from anki.journal import AnswerJournal
+    collection = getEmptyCol()
+    for _ in range(3):
+        create_learning_card(collection, 10)
+    collection.save()
+    collection.journal = AnswerJournal(collection, batch=2)
+    collection.reset()
+
+    # ACT
+    for _ in range(2):
+        collection.sched.answerCard(collection.sched.getCard(), 3)
+
+    # ASSERT
+    assert not collection.db.mod
+    assert not os.path.exists(collection.path + "-answers")
+
+
+def test_revlog_ids_are_unique_without_waiting():
+    # ARRANGE
+    collection = getEmptyCol()
+    card = create_learning_card(collection, 10)
+    future = collection.nextRevlogId() + 1000
+    # logged by something other than the collection
+    collection.db.execute(
+        "insert into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
+        future + 1, card.id, 0, 3, 10, 5, 2500, 1000, 1, 0, 0)
+
+    # ACT
+    with patch('time.sleep') as sleep:
+        ids = [collection.logReview(card.id, 3, 10, 5, 2500, 1000, 1, 0, 0)
+               for _ in range(1500)]
+
+    # ASSERT
+    assert not sleep.called
+    assert len(set(ids)) == len(ids)
+    assert collection.db.scalar("select count() from revlog") == len(ids) + 1
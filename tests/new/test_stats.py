@@ -1,3 +1,5 @@
+from unittest.mock import patch
+
 from anki.stats import CollectionStats
 from tests.shared import getEmptyCol as _getEmptyCol
 from datetime import datetime
@@ -48,4 +50,176 @@ def test_days_studied_works_with_old_logs():
 
     # ASSERT
     # number of days should be 30
-    assert return_value[0] == 30
\ No newline at end of file
+    assert return_value[0] == 30
+
+def add_random_reviews(col, card, count, seed=1):
+    import random
+    rnd = random.Random(seed)
+    now = col.sched.dayCutoff * 1000
+    for n in range(count):
+        rid = now - rnd.randint(0, 400 * 86400 * 1000)
+        ivl = rnd.choice([-600, 1, 10, 30])
+        last_ivl = rnd.choice([-60, 1, 15, 25])
+        col.db.execute(
+            "insert or ignore into revlog values (?,?,?,?,?,?,?,?,?,?,?)",
+            rid, card.id + rnd.randint(0, 20), 0, rnd.randint(1, 4), ivl, last_ivl,
+            2500, rnd.randint(1, 60000), rnd.randint(0, 3), rnd.randint(0, 1), 0)
+
+
+def daily_sections(collection_stats):
+    from anki.advanced_stats.TrueRetention import statList
+    period = collection_stats._periodDays()
+    lim = collection_stats._revlogLimit()
+    if lim:
+        lim = " and " + lim
+    return (collection_stats._done(period, 7 if collection_stats.type else 1),
+            collection_stats._daysStudied(),
+            collection_stats._eases(),
+            statList(collection_stats, lim, 7))
+
+
+def test_revlog_columns_match_sql():
+    from anki.advanced_stats import columns
+    from anki.advanced_stats.compute import get_stats
+    import pytest
+    if not columns.available():
+        return
+    col = getEmptyCol()
+    card = create_learning_card(col, 1)
+    add_random_reviews(col, card, 2000)
+    collection_stats = CollectionStats(col)
+    collection_stats.wholeCollection = True
+    for type in (0, 1, 2):
+        collection_stats.type = type
+        sql = (collection_stats._hourRet(),
+               collection_stats._deckAge('review'))
+        collection_stats._revlog = collection_stats._loadRevlog()
+        cols = (collection_stats._hourRet(),
+                collection_stats._deckAge('review'))
+        revlog = collection_stats._revlog
+        collection_stats._revlog = None
+        flat = lambda rows: [v for r in rows for v in r]
+        assert flat(cols[0]) == pytest.approx(flat(sql[0]))
+        assert cols[1] == sql[1]
+        for num_buckets, bucket_size_days in ((31, 1), (52, 7), (None, 31)):
+            kwargs = dict(db_table=col.db, bucket_size_days=bucket_size_days,
+                          num_buckets=num_buckets, day_cutoff_seconds=col.sched.dayCutoff)
+            assert get_stats(revlog=revlog, **kwargs) == get_stats(**kwargs)
+
+
+def test_revlog_daily_matches_revlog():
+    import pytest
+    col = getEmptyCol()
+    card = create_learning_card(col, 1)
+    add_random_reviews(col, card, 2000)
+    assert col.revlogDaily.today() is not None
+    collection_stats = CollectionStats(col)
+    flat = lambda rows: [v for r in rows for v in r]
+    for whole in (True, False):
+        collection_stats.wholeCollection = whole
+        for type in (0, 1, 2):
+            collection_stats.type = type
+            daily = daily_sections(collection_stats)
+            collection_stats.useDaily = False
+            sql = daily_sections(collection_stats)
+            del collection_stats.useDaily
+            assert flat(daily[0]) == pytest.approx(flat(sql[0]))
+            assert tuple(daily[1]) == tuple(sql[1])
+            assert [tuple(r) for r in daily[2]] == [tuple(r) for r in sql[2]]
+            assert daily[3] == sql[3]
+
+
+def test_revlog_daily_follows_answers_and_undo():
+    col = getEmptyCol()
+    card = create_learning_card(col, 1)
+    create_learning_card(col, 1)
+    add_random_reviews(col, card, 100)
+    col.revlogDaily.today()
+    col.reset()
+    card = col.sched.getCard()
+    col.sched.answerCard(card, 3)
+    card = col.sched.getCard()
+    col.markReview(card)
+    col.sched.answerCard(card, 1)
+    col.undo()
+    # kept up to date without a rebuild
+    assert col.db.scalar("select revlogs from revlog_daily_meta") == 101
+    incremental = col.db.all("select * from revlog_daily order by 1, 2, 3, 4, 5, 6")
+    col.revlogDaily.invalidate()
+    col.revlogDaily.today()
+    assert col.db.all("select * from revlog_daily order by 1, 2, 3, 4, 5, 6") == incremental
+
+
+
+def test_revlog_daily_rebuilds():
+    from anki.revlogdaily import RevlogDaily
+    col = getEmptyCol()
+    card = create_learning_card(col, 1)
+    add_random_reviews(col, card, 100)
+    rebuild = RevlogDaily._rebuild
+    with patch.object(RevlogDaily, "_rebuild", autospec=True,
+                      side_effect=rebuild) as rebuilds:
+        # looking at the stats doesn't build it, or modify the collection
+        col.save()
+        CollectionStats(col).report()
+        assert not rebuilds.called
+        assert not col.db.mod
+        col.revlogDaily.today()
+        assert rebuilds.call_count == 1
+    # moving cards doesn't make it stale, as the deck limited stats don't
+    # read it
+    col.decks.setDeck([card.id], col.decks.id("other"))
+    assert col.revlogDaily.today(build=False) is not None
+    stats = CollectionStats(col)
+    assert stats._daily() is None
+    stats.wholeCollection = True
+    assert stats._daily() is not None
+    stats.wholeCollection = False
+    done = lambda: sum(r[1]+r[2]+r[3]+r[4]+r[5] for r in stats._done(None))
+    col.decks.select(col.decks.id("other"))
+    assert done() == col.db.scalar(
+        "select count() from revlog where cid = ?", card.id)
+    # nor does removing them
+    col.remCards([card.id])
+    assert col.revlogDaily.today(build=False) is not None
+    assert done() == 0
+
+def test_progress_stats_are_the_same_with_and_without_numpy():
+    from anki.advanced_stats import compute
+    if compute.np is None:
+        return
+    col = getEmptyCol()
+    card = create_learning_card(col, 1)
+    add_random_reviews(col, card, 2000, seed=2)
+    for num_buckets, bucket_size_days in ((31, 1), (52, 7), (None, 31)):
+        kwargs = dict(db_table=col.db, bucket_size_days=bucket_size_days,
+                      num_buckets=num_buckets, day_cutoff_seconds=col.sched.dayCutoff)
+        vectorised = compute.get_stats(**kwargs)
+        streamed = compute.get_stats(chunk_size=7, **kwargs)
+        with patch.object(compute, "np", None):
+            assert compute.get_stats(**kwargs) == vectorised == streamed
+    # the whole history has every kind of change
+    assert all(sum(n for _, n in vectorised[name]) for name in vectorised)
+
+
+def test_report_sections_match_report():
+    import re
+    col = getEmptyCol()
+    card = create_learning_card(col, 1)
+    add_random_reviews(col, card, 500)
+    collection_stats = CollectionStats(col)
+    # graph ids are numbered per process and the footer has the time
+    normalise = lambda html: re.sub(r"progress-\d+|Generated on [^<]*", "", html)
+    def check(type):
+        serial = collection_stats.report(type)
+        sections = dict(collection_stats.reportSections(type, workers=3))
+        parallel = "<center>%s</center>" % (collection_stats.reportHeader() + "".join(
+            sections[n] for n in range(len(collection_stats.sections()))))
+        assert normalise(parallel) == normalise(serial)
+    for type in (0, 1, 2):
+        check(type)
+    # with revlog_daily current, and built but stale
+    col.revlogDaily.today()
+    check(0)
+    col.revlogDaily.invalidate()
+    check(0)
@@ -0,0 +1,92 @@
+import json
+
+from anki.sync import ChunkSizer, Syncer, SYNC_CHUNK_MAX, SYNC_CHUNK_MIN
+from tests.shared import getEmptyCol
+
+
+def _addNotes(col, count, text="x"):
+    for i in range(count):
+        f = col.newNote()
+        f['Front'] = "%s %d" % (text, i)
+        f['Back'] = text * 20
+        col.addNote(f)
+
+
+def _syncer(col, maxUsn=5):
+    s = Syncer(col)
+    s.maxUsn = maxUsn
+    s.prepareToChunk()
+    return s
+
+
+def test_chunk_by_bytes():
+    col = getEmptyCol()
+    _addNotes(col, 300)
+    s = _syncer(col)
+    s.sizer.bytes = 20000
+    seen = dict(cards=[], notes=[])
+    chunks = 0
+    while True:
+        chunk = s.chunk()
+        chunks += 1
+        size = len(json.dumps(chunk))
+        if not chunk['done']:
+            # the estimate is close to what's sent
+            assert s.chunkBytes >= 20000
+            assert 0.7 < size / s.chunkBytes < 1.3
+        for t in seen:
+            seen[t].extend(r[0] for r in chunk.get(t, []))
+        if chunk['done']:
+            break
+    assert chunks > 2
+    assert sorted(seen['cards']) == sorted(col.db.list("select id from cards"))
+    assert sorted(seen['notes']) == sorted(col.db.list("select id from notes"))
+    assert not col.db.scalar("select 1 from notes where usn = -1")
+
+
+def test_merge_rows():
+    src = getEmptyCol()
+    _addNotes(src, 50, "remote")
+    rows = _syncer(src).chunk()
+    assert rows['done']
+    col = getEmptyCol()
+    s = _syncer(col)
+    s.mergeModels(src.models.all())
+    s.applyChunk(rows)
+    assert col.noteCount() == 50
+    assert col.findNotes("remote") == sorted(r[0] for r in rows['notes'])
+    # the field cache is updated
+    assert col.db.scalar("select count() from notes where sfld = ''") == 0
+    # local changes newer than the incoming rows are kept
+    nids = [r[0] for r in rows['notes']]
+    col.db.execute("update notes set flds = 'local\x1f', mod = mod + 10, "
+                   "usn = -1 where id = ?", nids[0])
+    # older ones, or those already sent, are overwritten
+    col.db.execute("update notes set flds = 'old\x1f', mod = mod - 10, "
+                   "usn = -1 where id = ?", nids[1])
+    col.db.execute("update notes set flds = 'sent\x1f', mod = mod + 10, "
+                   "usn = 3 where id = ?", nids[2])
+    s.mergeNotes(rows['notes'])
+    flds = dict(col.db.all("select id, flds from notes"))
+    assert flds[nids[0]] == "local\x1f"
+    assert flds[nids[1]].startswith("remote")
+    assert flds[nids[2]].startswith("remote")
+    assert col.db.scalar("select count() from temp.sync_notes") == 0
+
+
+def test_sizer_adapts():
+    s = ChunkSizer()
+    start = s.bytes
+    # fast round trips grow the chunks, at most doubling at a time
+    s.update(s.bytes, 0.01)
+    assert s.bytes == start * 2
+    for i in range(20):
+        s.update(s.bytes, 0.01)
+    assert s.bytes == SYNC_CHUNK_MAX
+    # slow ones shrink them
+    for i in range(20):
+        s.update(s.bytes, 60)
+    assert s.bytes == SYNC_CHUNK_MIN
+    # short chunks are ignored
+    s.update(10, 60)
+    assert s.bytes == SYNC_CHUNK_MIN
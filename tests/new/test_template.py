@@ -0,0 +1,57 @@
+import random
+
+from anki.template import Template, render
+from tests.shared import getEmptyCol
+
+TEMPLATES = [
+    "{{Front}}",
+    "{{Front}}<hr id=answer>{{Back}}",
+    "{{#Back}}has back: {{Back}}{{/Back}}{{^Back}}no back{{/Back}}",
+    "{{#Front}}{{#Back}}{{Front}} {{Back}}{{/Back}}{{/Front}}",
+    "{{text:Front}} {{type:Back}} {{hint:Back}} {{furigana:Front}}",
+    "{{{Front}}} {{Front}} {{!comment}}",
+    "{{cq-1:Text}} {{ca-2:Text}}",
+    "{{#cq:1:Text}}one{{/cq:1:Text}}{{^cq:2:Text}}no two{{/cq:2:Text}}",
+    "{{Missing}} {{mod:Front}} {{/Back}}",
+    "{{#Front}}unclosed",
+    "{{&Front}}",
+    "{{Front}}{{{Front}}}",
+    "{{=<% %>=}}<%Front%>",
+]
+
+VALUES = ["", "plain", "<b>bold</b>", "{{Back}}", "a{", "}b", "[sound:x.mp3]",
+          "{{c1::one}} {{c2::two::hint}}", "\\(x{{c1::y}}\\)"]
+
+
+def test_compiled_templates_render_the_same_as_rescanning():
+    rnd = random.Random(1)
+    for template in TEMPLATES:
+        for _ in range(30):
+            context = dict(Front=rnd.choice(VALUES), Back=rnd.choice(VALUES),
+                           Text=rnd.choice(VALUES[1:]))
+            Template.compiled = False
+            try:
+                expected = render(template, context)
+            finally:
+                Template.compiled = True
+            assert render(template, context) == expected, (template, context)
+
+
+def test_render_qa_is_unchanged_for_the_standard_models():
+    col = getEmptyCol()
+    rnd = random.Random(2)
+    for model in col.models.all():
+        col.models.setCurrent(model)
+        for _ in range(10):
+            note = col.newNote()
+            for name in note.keys():
+                note[name] = rnd.choice(VALUES[1:])
+            if col.addNote(note):
+                note.addTag("tag")
+                note.flush()
+    compiled = col.renderQA(type="all")
+    Template.compiled = False
+    try:
+        assert col.renderQA(type="all") == compiled
+    finally:
+        Template.compiled = True
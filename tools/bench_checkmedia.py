@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Time Check Media on a collection of notes that each refer to a file: the
+# first check, which builds the index of references, a check after editing
+# a few notes, the same with the media folder watched, and the old way of
+# searching every note's fields.
+#
+# Usage: PYTHONPATH=. tools/bench_checkmedia.py [note count]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+
+
+def timed(label, fn):
+    t = time.perf_counter()
+    ret = fn()
+    print("%-24s %8.3fs" % (label, time.perf_counter() - t))
+    return ret
+
+def fill(col, count):
+    mid = col.models.byName("Basic")['id']
+    notes = []
+    for nid in range(1, count + 1):
+        notes.append((nid, "g%d" % nid, mid,
+                      "front %d\x1f<img src='file%d.png'> [sound:s%d.mp3]" % (
+                          nid, nid, nid % 100)))
+        if nid % 2:
+            with open("file%d.png" % nid, "w") as f:
+                f.write("file %d" % nid)
+    col.db.executemany("""
+insert into notes values (?,?,?,0,-1,'',?,'',0,0,'')""", notes)
+    col.save()
+
+def searchAll(col):
+    refs = set()
+    for nid, mid, flds in col.db.execute("select id, mid, flds from notes"):
+        refs.update(col.media.filesInStr(mid, flds))
+    return refs
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    dir = tempfile.mkdtemp()
+    col = Collection(os.path.join(dir, "col.anki2"))
+    try:
+        fill(col, count)
+        print("%d notes" % count)
+        col.media.findChanges()
+        timed("search every note", lambda: searchAll(col))
+        nohave, unused, warnings = timed("first check", col.media.check)
+        assert len(nohave) == count // 2 + 100
+        timed("check, unchanged", col.media.check)
+        for nid in range(1, count + 1, count // 10):
+            note = col.getNote(nid)
+            note['Back'] += " edited"
+            note.flush()
+        timed("check, 10 edited", col.media.check)
+        if col.media.startWatching():
+            col.media.check()
+            timed("watched, unchanged", col.media.check)
+    finally:
+        col.close()
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Time how long the deck list counts take to compute on a large synthetic
+# collection, using Scheduler v3.
+#
+# Usage: PYTHONPATH=. tools/bench_deckdue.py [deck count] [card count]
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from anki import Collection
+import anki.collection
+import anki.schedv3
+
+
+def build(deck_count, card_count, fanout=8):
+    (fd, path) = tempfile.mkstemp(suffix=".anki2")
+    os.close(fd)
+    os.unlink(path)
+    anki.collection.defaultConf['usedScheduler'] = 'anki.schedv3.Scheduler'
+    anki.collection._Collection.defaultScheduler = 'anki.schedv3.Scheduler'
+    col = Collection(path)
+    names = {1: "bench"}
+    dids = [col.decks.id("bench")]
+    for i in range(2, deck_count + 1):
+        names[i] = names[(i - 2) // fanout + 1] + "::d%d" % i
+        dids.append(col.decks.id(names[i]))
+    rnd = random.Random(0)
+    today = col.sched.today
+
+    def cards():
+        for cid in range(1, card_count + 1):
+            queue = rnd.choice((0, 1, 2, 2, 2, 3))
+            if queue == 1:
+                due = int(time.time()) + rnd.randint(-600, 3600)
+            elif queue == 0:
+                due = cid
+            else:
+                due = today + rnd.randint(-30, 30)
+            yield (cid, cid, rnd.choice(dids), 0, 0, 0, queue, queue, due, 1,
+                   2500, 0, 0, 0, 0, 0, 0, "")
+    col.db.executemany(
+        "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+        cards())
+    col.save()
+    return col, path
+
+
+def main():
+    deck_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    card_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    t = time.perf_counter()
+    col, path = build(deck_count, card_count)
+    print("built %d decks / %d cards in %.1fs" % (
+        deck_count, card_count, time.perf_counter() - t))
+    try:
+        for run in range(3):
+            t = time.perf_counter()
+            col.sched.deckDueTree()
+            print("deckDueTree run %d: %.1fms" % (
+                run + 1, (time.perf_counter() - t) * 1000))
+    finally:
+        col.close()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Compare the scoring based review interleaving which Scheduler v3 used to
+# do with FairQueue, on synthetic deck trees.
+#
+# Usage: PYTHONPATH=. tools/bench_fairqueue.py [queue length] [deck count...]
+
+import random
+import sys
+import time
+
+from anki.fairqueue import FairQueue
+
+
+def scoring_scatter(limited_rev_queue, all_decks, decks_parents):
+    "The original Scheduler.scatter_fairly_cards_from_different_decks."
+    decks_cards = {deck['id']: [] for deck in all_decks}
+    for pos, (card_id, deck_id) in enumerate(limited_rev_queue):
+        decks_cards[deck_id].append((pos, card_id))
+        for parent in decks_parents[deck_id]:
+            decks_cards[parent['id']].append((pos, card_id))
+
+    used_cards = set()
+    deck_cards_already_used = {deck['id']: 0 for deck in all_decks}
+    fair_rev_queue = []
+    for i in range(len(limited_rev_queue)):
+        curr_max_points = 0
+        curr_card_id = None
+
+        for deck_id in decks_cards.keys():
+            while decks_cards[deck_id] and decks_cards[deck_id][0][1] in used_cards:
+                deck_cards_already_used[deck_id] += 1
+                decks_cards[deck_id].pop(0)
+
+            if not decks_cards[deck_id]:
+                continue
+
+            pos_difference = abs(i - decks_cards[deck_id][0][0])
+            points_position_changed = 1 - ((pos_difference ** 2) / (pos_difference ** 2 + len(limited_rev_queue)))
+
+            distribution_whole = (deck_cards_already_used[deck_id] + len(decks_cards[deck_id])) / len(
+                limited_rev_queue)
+            distribution_current = 0 if i == 0 else deck_cards_already_used[deck_id] / i
+
+            if distribution_current < distribution_whole:
+                distribution_points = 1 - (distribution_current / (distribution_whole * 2))
+            else:
+                distribution_points = distribution_whole / (distribution_current * 2)
+
+            total_points = points_position_changed * distribution_points
+            if total_points > curr_max_points:
+                curr_max_points = total_points
+                curr_card_id = decks_cards[deck_id][0][1]
+
+        fair_rev_queue.append(curr_card_id)
+        used_cards.add(curr_card_id)
+    return fair_rev_queue
+
+
+def synthetic_tree(deck_count, fanout=8):
+    "Return (all_decks, decks_parents) for a balanced deck tree."
+    all_decks = [{'id': did} for did in range(1, deck_count + 1)]
+    parent_of = {did: (did - 2) // fanout + 1 if did > 1 else None
+                 for did in range(1, deck_count + 1)}
+    decks_parents = {}
+    for did in parent_of:
+        parents = []
+        p = parent_of[did]
+        while p:
+            parents.insert(0, {'id': p})
+            p = parent_of[p]
+        decks_parents[did] = parents
+    return all_decks, decks_parents
+
+
+def timed(fn, *args):
+    t = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - t
+
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    deck_counts = [int(x) for x in sys.argv[2:]] or [10, 100, 1000, 5000]
+    rnd = random.Random(0)
+    print("%8s %8s %12s %12s" % ("decks", "cards", "scoring", "fairqueue"))
+    for deck_count in deck_counts:
+        all_decks, decks_parents = synthetic_tree(deck_count)
+        cards = [(cid, rnd.randint(1, deck_count)) for cid in range(length)]
+        old = timed(scoring_scatter, cards, all_decks, decks_parents)
+        parents = dict((did, [p['id'] for p in ps])
+                       for did, ps in decks_parents.items())
+        new = timed(lambda c: list(FairQueue(c, parents)), cards)
+        print("%8d %8d %10.1fms %10.1fms" % (deck_count, length, old*1000, new*1000))
+
+
+if __name__ == "__main__":
+    main()
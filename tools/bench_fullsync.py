@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Measure the peak memory Python allocates for a full sync upload and
+# download of collections of growing size, against a stand-in for AnkiWeb
+# running in another process. The upload is also timed with the collection
+# read into memory first, as every upload was before it was streamed.
+#
+# Usage: PYTHONPATH=. tools/bench_fullsync.py [largest size in MB]
+
+import http.server
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from anki import Collection
+from anki.sync import FullSyncer
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    "Discards uploads, and sends the file the server was started with."
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                self.skip(size)
+                self.rfile.readline()
+                if not size:
+                    break
+        else:
+            self.skip(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        if self.path.endswith("/upload"):
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"OK")
+            return
+        self.send_header("Content-Length", str(os.path.getsize(self.server.file)))
+        self.end_headers()
+        with open(self.server.file, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, 65536)
+
+    def skip(self, size):
+        while size:
+            size -= len(self.rfile.read(min(size, 65536)))
+
+    def log_message(self, *args):
+        pass
+
+def serve(file, port):
+    srv = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    srv.file = file
+    port.put(srv.server_address[1])
+    srv.serve_forever()
+
+def fill(col, mb):
+    "Add notes until the collection is about MB megabytes."
+    mid = col.models.byName("Basic")['id']
+    nid = 1
+    while os.path.getsize(col.path) < mb * 1024 * 1024:
+        notes = []
+        for i in range(1000):
+            nid += 1
+            # random text, so it doesn't compress away
+            text = os.urandom(512).hex()
+            notes.append((nid, "g%d" % nid, mid, text + "\x1f", text))
+        col.db.executemany("""
+insert into notes values (?,?,?,0,-1,'',?,?,0,0,'')""", notes)
+        col.db.executemany("""
+insert into cards values (?,?,1,0,0,-1,0,0,0,0,0,0,0,0,0,0,0,'')""",
+                           [(n[0], n[0]) for n in notes])
+        col.db.commit()
+    col.save()
+
+def syncer(col, port):
+    s = FullSyncer(col, "key", None, None)
+    s.syncURL = lambda: "http://127.0.0.1:%d/sync/" % port
+    return s
+
+def measure(fn):
+    "Peak MB allocated and seconds taken by FN."
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    t = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - t
+    return (tracemalloc.get_traced_memory()[1] - base) / 1024 / 1024, elapsed
+
+
+def main():
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    sizes = []
+    mb = 4
+    while mb <= largest:
+        sizes.append(mb)
+        mb *= 2
+    dir = tempfile.mkdtemp()
+    tracemalloc.start()
+    try:
+        for mb in sizes:
+            path = os.path.join(dir, "col%d.anki2" % mb)
+            col = Collection(path)
+            fill(col, mb)
+            col.close()
+            size = os.path.getsize(path) / 1024 / 1024
+            port = multiprocessing.Queue()
+            server = multiprocessing.Process(target=serve, args=(path, port))
+            server.start()
+            port = port.get()
+            try:
+                col = Collection(path)
+                s = syncer(col, port)
+                def buffered():
+                    with open(path, "rb") as f:
+                        assert s.req("upload", io.BytesIO(f.read())) == b"OK"
+                peak, elapsed = measure(buffered)
+                print("%6.1fMB upload buffered %8.1fMB peak %6.2fs" % (
+                    size, peak, elapsed))
+                def streamed():
+                    assert s.upload()
+                peak, elapsed = measure(streamed)
+                print("%6.1fMB upload streamed %8.1fMB peak %6.2fs" % (
+                    size, peak, elapsed))
+                dest = os.path.join(dir, "dest.anki2")
+                col = Collection(dest)
+                col.close()
+                col = Collection(dest)
+                peak, elapsed = measure(lambda: syncer(col, port).download())
+                assert os.path.getsize(dest) == os.path.getsize(path)
+                print("%6.1fMB download        %8.1fMB peak %6.2fs" % (
+                    size, peak, elapsed))
+                os.unlink(dest)
+            finally:
+                server.terminate()
+                server.join()
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    main()
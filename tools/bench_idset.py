@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Compare selecting cards with an ids2str() list against DB.idSet(), for
+# growing numbers of ids. Memory is the peak python allocation during the
+# query.
+#
+# Usage: PYTHONPATH=. tools/bench_idset.py [id count...]
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from anki.db import DB
+from anki.utils import ids2str
+
+
+def measure(fn):
+    tracemalloc.start()
+    t = time.perf_counter()
+    res = fn()
+    elapsed = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, elapsed, peak
+
+
+def main():
+    counts = [int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000]
+    (fd, path) = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    db = DB(path)
+    # plain literal lists, as the code did before
+    db.bindIdLists = False
+    db.execute("create table cards (id integer primary key, did integer)")
+    db.executemany("insert into cards values (?, 1)",
+                   ((i,) for i in range(max(counts) * 2)))
+    db.commit()
+    print("%9s %20s %20s" % ("ids", "ids2str", "idSet"))
+    try:
+        for count in counts:
+            ids = list(range(0, count * 2, 2))
+
+            def literal():
+                return db.scalar(
+                    "select count() from cards where id in " + ids2str(ids))
+
+            def idset():
+                with db.idSet(ids) as sids:
+                    return db.scalar(
+                        "select count() from cards where id in " + sids)
+
+            cells = []
+            for fn in (literal, idset):
+                try:
+                    res, elapsed, peak = measure(fn)
+                    assert res == count
+                    cells.append("%7.1fms %7.1fMB" % (elapsed * 1000, peak / 2**20))
+                except Exception as e:
+                    cells.append(type(e).__name__)
+            print("%9d %20s %20s" % (count, cells[0], cells[1]))
+    finally:
+        db.close()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
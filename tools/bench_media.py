@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Time findChanges() on a media folder of many small files: the first scan,
+# which checksums them all, a rescan after editing a few, and the same with
+# the folder watched.
+#
+# Usage: PYTHONPATH=. tools/bench_media.py [file count]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+
+
+def timed(label, fn):
+    t = time.perf_counter()
+    fn()
+    print("%-24s %8.3fs" % (label, time.perf_counter() - t))
+
+def edit(count):
+    for i in range(0, count, count // 10):
+        with open("file%d.txt" % i, "a") as f:
+            f.write("edited")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    dir = tempfile.mkdtemp()
+    col = Collection(os.path.join(dir, "col.anki2"))
+    try:
+        for i in range(count):
+            with open("file%d.txt" % i, "w") as f:
+                f.write("file %d " % i * 20)
+        print("%d files" % count)
+        timed("first scan", col.media.findChanges)
+        timed("rescan, unchanged", col.media.findChanges)
+        edit(count)
+        timed("rescan, 10 edited", col.media.findChanges)
+        if not col.media.startWatching():
+            print("can't watch the folder")
+            return
+        timed("watched, first scan", col.media.findChanges)
+        timed("watched, unchanged", col.media.findChanges)
+        edit(count)
+        timed("watched, 10 edited", col.media.findChanges)
+    finally:
+        col.close()
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Time renderQA(type="all") over a collection of basic, reversed, cloze and
+# vocabulary notes, rendering through the compiled templates and by rescanning the text
+# after each replacement as before, in this process and spread over all the CPUs.
+#
+# Usage: PYTHONPATH=. tools/bench_renderqa.py [note count]
+
+import os
+import sys
+import tempfile
+import time
+
+from anki import Collection
+from anki.template import Template
+from anki.utils import joinFields
+
+
+VOCAB_FIELDS = ("Word", "Reading", "Meaning", "Example", "Audio", "Image",
+                "Notes", "Source")
+VOCAB_QFMT = """<div class=word>{{Word}}</div>
+{{#Reading}}<div class=reading>{{furigana:Reading}}</div>{{/Reading}}
+{{#Audio}}{{Audio}}{{/Audio}}{{^Audio}}<i>no audio</i>{{/Audio}}"""
+VOCAB_AFMT = """{{FrontSide}}<hr id=answer>
+<div class=meaning>{{Meaning}}</div>
+{{#Example}}<div class=example>{{Example}}</div>{{/Example}}
+{{#Image}}<div class=image>{{Image}}</div>{{/Image}}
+{{#Notes}}<div class=notes>{{text:Notes}}</div>{{/Notes}}
+{{#Source}}<div class=source>{{Source}} &middot; {{Deck}} &middot; {{Tags}}</div>{{/Source}}"""
+
+def addVocabModel(col):
+    mm = col.models
+    m = mm.new("Vocab")
+    for name in VOCAB_FIELDS:
+        mm.addField(m, mm.newField(name))
+    t = mm.newTemplate("Recognition")
+    t['qfmt'] = VOCAB_QFMT
+    t['afmt'] = VOCAB_AFMT
+    mm.addTemplate(m, t)
+    mm.add(m)
+    return m
+
+def fill(col, count):
+    """Add COUNT notes, spread over the basic, reversed and cloze models and
+    a vocabulary model with more fields and conditional sections."""
+    models = [col.models.byName(name) for name in (
+        "Basic", "Basic (and reversed card)", "Cloze")] + [addVocabModel(col)]
+    samples = []
+    for m in models:
+        col.models.setCurrent(m)
+        note = col.newNote()
+        if m['name'] == "Cloze":
+            note['Text'] = "The {{c1::capital}} of <b>France</b> is {{c2::Paris::city}}"
+        elif m['name'] == "Vocab":
+            note['Word'] = "capital"
+            note['Reading'] = "capital[kapital]"
+            note['Meaning'] = "the city where a country's government sits"
+            note['Example'] = "Paris is the <b>capital</b> of France."
+            note['Notes'] = "<i>from Latin</i> caput, head"
+            note['Source'] = "Dictionary"
+        else:
+            note['Front'] = "The capital of <b>France</b>"
+            note['Back'] = "Paris [sound:paris.mp3]"
+        col.addNote(note)
+        samples.append((note, col.db.all(
+            "select ord from cards where nid = ?", note.id)))
+    nid = cid = col.db.scalar("select max(id) from cards") + 1
+    notes = []
+    cards = []
+    for n in range(count - len(samples)):
+        note, ords = samples[n % len(samples)]
+        nid += 1
+        notes.append((nid, "g%d" % nid, note.mid, joinFields(note.fields)))
+        for (ord,) in ords:
+            cid += 1
+            cards.append((cid, nid, ord))
+    col.db.executemany("""
+insert into notes values (?,?,?,0,-1,'tag',?,'',0,0,'')""", notes)
+    col.db.executemany("""
+insert into cards values (?,?,1,?,0,-1,0,0,0,0,0,0,0,0,0,0,0,'')""", cards)
+    col.save()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    (fd, path) = tempfile.mkstemp(suffix=".anki2")
+    os.close(fd)
+    os.unlink(path)
+    col = Collection(path)
+    try:
+        fill(col, count)
+        cards = col.cardCount()
+        results = {}
+        for compiled in (False, True):
+            for workers in (1, max(os.cpu_count(), 2)):
+                Template.compiled = compiled
+                t = time.perf_counter()
+                results[compiled, workers] = list(
+                    col.iterRenderQA(type="all", workers=workers))
+                elapsed = time.perf_counter() - t
+                print("%-10s %2d procs %6d notes %7d cards %8.2fs %8.1fus/card" % (
+                    "compiled" if compiled else "rescan", workers, count, cards,
+                    elapsed, elapsed / cards * 1e6))
+        first = list(results.values())[0]
+        assert all(r == first for r in results.values())
+    finally:
+        col.close()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Copyright: Ankitects Pty Ltd and contributors
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Time sending every card and note of a new collection to another one, as
+# the first incremental sync after importing does, with the chunks passed
+# through JSON as they would be over the wire. The time spent on the round
+# trips is estimated from the chunk count and a given latency and
+# bandwidth, once with chunks of about 250 rows as they were before being
+# sized by bytes, and once with the chunk size adapting.
+#
+# Usage: PYTHONPATH=. tools/bench_sync.py [note count] [latency ms] [Mbit/s]
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from anki import Collection
+from anki.sync import Syncer
+
+
+def fill(col, count):
+    mid = col.models.byName("Basic")['id']
+    notes = []
+    cards = []
+    for nid in range(1, count + 1):
+        notes.append((nid + 1500000000000, "g%d" % nid, mid,
+                      "front %d\x1fback %d with some more text" % (nid, nid)))
+        cards.append((nid + 1500000000000, nid + 1500000000000, nid))
+    col.db.executemany("""
+insert into notes values (?,?,?,0,-1,'',?,'',0,0,'')""", notes)
+    col.db.executemany("""
+insert into cards values (?,?,1,0,0,-1,0,0,?,0,0,0,0,0,0,0,0,'')""", cards)
+    col.save()
+
+def newCol(dir, name):
+    return Collection(os.path.join(dir, name))
+
+def run(src, dest, latency, bandwidth, rows=None):
+    """Send all of SRC to DEST, returning the seconds taken here, the
+    chunk count and the estimated seconds on the network."""
+    client = Syncer(src)
+    server = Syncer(dest)
+    client.maxUsn = server.maxUsn = 1
+    client.prepareToChunk()
+    server.mergeModels(src.models.all())
+    chunks = 0
+    net = 0
+    local = 0
+    while True:
+        t = time.perf_counter()
+        if rows:
+            # about the size of a chunk of ROWS rows of this collection
+            client.sizer.bytes = rows * 100
+        chunk = json.loads(json.dumps(client.chunk()))
+        server.applyChunk(chunk)
+        local += time.perf_counter() - t
+        secs = latency + client.chunkBytes / bandwidth
+        client.sizer.update(client.chunkBytes, secs)
+        net += secs
+        chunks += 1
+        if chunk['done']:
+            break
+    dest.save()
+    assert dest.noteCount() == src.noteCount()
+    return local, chunks, net
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 100) / 1000
+    bandwidth = (int(sys.argv[3]) if len(sys.argv) > 3 else 20) * 1e6 / 8
+    dir = tempfile.mkdtemp()
+    try:
+        for label, rows in ("250 rows", 250), ("adaptive", None):
+            src = newCol(dir, label + "src.anki2")
+            fill(src, count)
+            dest = newCol(dir, label + "dest.anki2")
+            local, chunks, net = run(src, dest, latency, bandwidth, rows)
+            print("%-9s %7d notes %6d chunks %8.2fs local %8.2fs network" % (
+                label, count, chunks, local, net))
+            src.close()
+            dest.close()
+    finally:
+        shutil.rmtree(dir)
+
+
+if __name__ == "__main__":
+    main()